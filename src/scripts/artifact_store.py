@@ -0,0 +1,312 @@
+# Crash-safe layout of the pipeline outputs
+# Every tool runs in a private staging folder (work_flow/staging/<host>/<pid>.<id>.<target>.<stage>),
+# and its outputs are moved into place with an atomic rename once the tool has finished, so a
+# killed run never leaves a half-written PDB where the next stage (or a resumed run) looks.
+# Files written by the pipeline itself go to a temporary file next to their final path first.
+#
+# Outputs are sharded by target and design, one folder per stage:
+#   work_flow/designs/<target>/<design>/rfdiffusion/<target>_scaffold_<design>.pdb (and .trb)
+#   work_flow/designs/<target>/<design>/protein_mpnn/<target>_scaffold_<design>.fa
+#   work_flow/designs/<target>/<design>/omegafold/<target>_<design>_<sample>.pdb
+# so no folder grows with the size of a screen beyond the designs of one target, and the
+# path of any output is known without listing a folder.
+#
+# Every committed file is recorded with its checksum and size in a manifest
+# (work_flow/artifacts.sqlite), which is also how a screen is enumerated without walking it.
+# The workers of a sharded run (sharded_run.py) each have their own manifest, merged into
+# artifacts.sqlite when the screen is done.
+# gc removes what interrupted runs left behind: staging folders of processes that are gone
+# (or older than --max-age for other hosts), temporary files, and manifest entries of files
+# that no longer exist. Files of the designs folder missing from the manifest (a crash between
+# the rename and the manifest write) are complete, they are added back to the manifest.
+#
+# Usage:
+#   python artifact_store.py gc --dry-run
+#   python artifact_store.py verify --target 7SH6      # checksums against the manifest
+#   python artifact_store.py list --target 7SH6 --stage omegafold
+import argparse
+import contextlib
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from workflow_index import file_checksum
+
+DEFAULT_ROOT = './work_flow'
+DESIGNS_DIR = 'designs'
+STAGING_DIR = 'staging'
+MANIFEST_NAME = 'artifacts.sqlite'
+# Staging folders of other hosts are only removed after this many seconds
+DEFAULT_MAX_AGE = 24 * 3600
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    path     TEXT PRIMARY KEY,
+    target   TEXT NOT NULL,
+    design   TEXT NOT NULL,
+    stage    TEXT NOT NULL,
+    checksum TEXT NOT NULL,
+    size     INTEGER NOT NULL,
+    created  REAL NOT NULL
+)
+"""
+_INDEX = "CREATE INDEX IF NOT EXISTS artifacts_target ON artifacts (target, design, stage)"
+
+
+def write_atomic(path, data):
+    """Write bytes or text to a temporary file next to path, then rename it over path."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ArtifactStore:
+    """
+    Sharded, atomically written outputs under root (work_flow), with a checksum manifest.
+    journal_mode as for WorkflowIndex: 'DELETE' for a manifest on a folder shared between hosts.
+    """
+
+    def __init__(self, root=DEFAULT_ROOT, manifest_name=MANIFEST_NAME, journal_mode='WAL'):
+        self.root = root
+        self.manifest_path = os.path.join(root, manifest_name)
+        self.journal_mode = journal_mode
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _manifest(self):
+        # Opened on first use, stages that only compute paths need no database
+        if self._db is None:
+            os.makedirs(self.root, exist_ok=True)
+            db = sqlite3.connect(self.manifest_path, check_same_thread=False, timeout=30)
+            with db:
+                db.execute(f"PRAGMA journal_mode={self.journal_mode}")
+                db.execute(_SCHEMA)
+                db.execute(_INDEX)
+            self._db = db
+        return self._db
+
+    def design_dir(self, target, design, stage):
+        return os.path.join(self.root, DESIGNS_DIR, target, str(design), stage)
+
+    def path(self, target, design, stage, filename):
+        """Final path of an output, whether it exists or not."""
+        return os.path.join(self.design_dir(target, design, stage), filename)
+
+    @contextlib.contextmanager
+    def staging(self, target, stage):
+        """Fresh folder for the outputs of one tool run, removed with whatever is left in it."""
+        folder = os.path.join(self.root, STAGING_DIR, socket.gethostname(),
+                              f"{os.getpid()}.{uuid.uuid4().hex[:8]}.{target}.{stage}")
+        os.makedirs(folder)
+        try:
+            yield folder
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def _record(self, path, target, design, stage, checksum, size):
+        with self._lock:
+            db = self._manifest()
+            with db:
+                db.execute("INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (os.path.relpath(path, self.root), target, str(design), stage, checksum, size, time.time()))
+
+    def commit(self, source, target, design, stage, filename=None):
+        """
+        Move a finished file (from a staging folder, on the same file system) to its final
+        path with an atomic rename and record it in the manifest. Returns the final path.
+        """
+        path = self.path(target, design, stage, filename or os.path.basename(source))
+        checksum, size = file_checksum(source), os.path.getsize(source)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(source, path)
+        self._record(path, target, design, stage, checksum, size)
+        return path
+
+    def write(self, target, design, stage, filename, data):
+        """Write bytes or text to the final path of an output atomically, returns the path."""
+        path = write_atomic(self.path(target, design, stage, filename), data)
+        self._record(path, target, design, stage, file_checksum(path), os.path.getsize(path))
+        return path
+
+    def entries(self, target=None, stage=None):
+        """Manifest entries (dicts with path, target, design, stage, checksum, size, created)."""
+        conditions, arguments = [], []
+        for column, value in (('target', target), ('stage', stage)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                arguments.append(value)
+        where = (" WHERE " + " AND ".join(conditions)) if conditions else ""
+        with self._lock:
+            rows = self._manifest().execute(
+                f"SELECT * FROM artifacts{where} ORDER BY target, design, stage, path", arguments).fetchall()
+        columns = ['path', 'target', 'design', 'stage', 'checksum', 'size', 'created']
+        return [{**dict(zip(columns, row)), 'path': os.path.join(self.root, row[0])} for row in rows]
+
+    def verify(self, target=None, remove=False):
+        """
+        Paths whose file is missing or no longer matches its checksum. With remove=True the
+        damaged files and their entries are removed, so the stages that made them run again.
+        """
+        damaged = []
+        for entry in self.entries(target):
+            if not os.path.exists(entry['path']):
+                damaged.append(entry['path'])
+            elif os.path.getsize(entry['path']) != entry['size'] or file_checksum(entry['path']) != entry['checksum']:
+                damaged.append(entry['path'])
+                if remove:
+                    os.remove(entry['path'])
+        if remove:
+            self._forget(damaged)
+        return damaged
+
+    def _forget(self, paths):
+        with self._lock:
+            db = self._manifest()
+            with db:
+                db.executemany("DELETE FROM artifacts WHERE path = ?",
+                               [(os.path.relpath(path, self.root),) for path in paths])
+
+    def gc(self, max_age=DEFAULT_MAX_AGE, dry_run=False):
+        """
+        Remove the leftovers of interrupted runs, see the top of the file.
+        Returns the counts of removed staging folders, temporary files, stale entries and adopted files.
+        """
+        counts = {'staging': 0, 'temporary': 0, 'stale_entries': 0, 'adopted': 0}
+        host = socket.gethostname()
+
+        staging_dir = os.path.join(self.root, STAGING_DIR)
+        for owner_host in sorted(os.listdir(staging_dir)) if os.path.isdir(staging_dir) else []:
+            for name in sorted(os.listdir(os.path.join(staging_dir, owner_host))):
+                folder = os.path.join(staging_dir, owner_host, name)
+                pid = name.split('.')[0]
+                if owner_host == host and pid.isdigit():
+                    # The process that made it on this host is gone
+                    orphaned = not _pid_alive(int(pid))
+                else:
+                    orphaned = time.time() - os.stat(folder).st_mtime > max_age
+                if orphaned:
+                    print(f"{'Would remove' if dry_run else 'Removing'} staging folder {folder}")
+                    if not dry_run:
+                        shutil.rmtree(folder, ignore_errors=True)
+                    counts['staging'] += 1
+
+        recorded = {entry['path']: entry for entry in self.entries()}
+        on_disk = set()
+        designs_dir = os.path.join(self.root, DESIGNS_DIR)
+        for folder, _, files in os.walk(designs_dir):
+            for filename in files:
+                path = os.path.join(folder, filename)
+                if '.tmp.' in filename:
+                    print(f"{'Would remove' if dry_run else 'Removing'} temporary file {path}")
+                    if not dry_run:
+                        os.remove(path)
+                    counts['temporary'] += 1
+                    continue
+                on_disk.add(path)
+                if path not in recorded:
+                    # designs/<target>/<design>/<stage>/<file>, renamed into place before the crash
+                    target, design, stage = os.path.relpath(folder, designs_dir).split(os.sep)[-3:]
+                    if not dry_run:
+                        self._record(path, target, design, stage, file_checksum(path), os.path.getsize(path))
+                    counts['adopted'] += 1
+
+        stale = [path for path in recorded if path not in on_disk]
+        counts['stale_entries'] = len(stale)
+        if stale and not dry_run:
+            self._forget(stale)
+        return counts
+
+    def merge(self, paths):
+        """
+        Copy the entries of other manifests (e.g. those of the workers of a sharded run) into
+        this one, the latest entry of a path wins. Returns the number of entries copied.
+        """
+        merged = 0
+        for path in paths:
+            source = sqlite3.connect(path, timeout=30)
+            try:
+                rows = source.execute("SELECT * FROM artifacts").fetchall()
+            finally:
+                source.close()
+            with self._lock:
+                db = self._manifest()
+                with db:
+                    for row in rows:
+                        cursor = db.execute(
+                            "INSERT OR REPLACE INTO artifacts SELECT ?, ?, ?, ?, ?, ?, ? WHERE NOT EXISTS "
+                            "(SELECT 1 FROM artifacts WHERE path = ? AND created >= ?)", (*row, row[0], row[6]))
+                        merged += cursor.rowcount
+        return merged
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+# Stores shared by the pipeline stages, one per root folder
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(root=DEFAULT_ROOT):
+    key = os.path.abspath(root)
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = ArtifactStore(root)
+        return _stores[key]
+
+
+def set_store(store):
+    """Make store the one get_store returns for its root, e.g. with the manifest of a worker."""
+    with _stores_lock:
+        _stores[os.path.abspath(store.root)] = store
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manifest, checks and clean-up of the pipeline outputs")
+    parser.add_argument('command', choices=['gc', 'verify', 'list'])
+    parser.add_argument('--root', default=DEFAULT_ROOT, help="work_flow folder")
+    parser.add_argument('--target', default=None)
+    parser.add_argument('--stage', default=None, help="list: only the outputs of this stage")
+    parser.add_argument('--max-age', type=float, default=DEFAULT_MAX_AGE,
+                        help="gc: seconds after which the staging folders of other hosts are removed")
+    parser.add_argument('--dry-run', action='store_true', help="gc: only show what would be removed")
+    parser.add_argument('--remove', action='store_true', help="verify: remove the damaged files")
+    args = parser.parse_args()
+
+    store = ArtifactStore(args.root)
+    if args.command == 'gc':
+        counts = store.gc(args.max_age, args.dry_run)
+        print(", ".join(f"{count} {what.replace('_', ' ')}" for what, count in counts.items()))
+    elif args.command == 'verify':
+        damaged = store.verify(args.target, args.remove)
+        for path in damaged:
+            print(f"Damaged or missing: {path}")
+        print(f"{len(damaged)} damaged or missing files")
+    else:
+        for entry in store.entries(args.target, args.stage):
+            print(f"{entry['target']}\t{entry['design']}\t{entry['stage']}\t{entry['size']}\t{entry['path']}")
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+# Batch mode for the RFdiffusion pipeline
+# Runs many (pdb_code, contig) targets through RFdiffusion -> ProteinMPNN -> OmegaFold -> TMalign
+# as a pipeline: every stage has its own queue and workers, so while target N is folded
+# by OmegaFold, target N+1 can be in ProteinMPNN and target N+2 in RFdiffusion. Every
+# RFdiffusion design and every ProteinMPNN sequence goes through the next stages on its own.
+#
+# Usage:
+#   python batch_pipeline.py targets.csv --number-proteins 4 --num-seq-per-target 8 --omegafold-workers 1
+#   python batch_pipeline.py targets.csv --routes rfdiffusion,evodiff   # both generators, one result set (see stages.py)
+#
+# The manifest is a CSV (with header) or a JSONL file with the columns/keys
+#   pdb_code, contig and optionally name (output folder name, defaults to the pdb code),
+#   number_proteins, num_seq_per_target and number_sequences (EvoDiff) overriding the command
+#   line values for the target
+#
+# With --filters (a JSON file of thresholds, or "default"), backbones and sequences failing
+# the cheap checks of design_filters.py are not folded, see work_flow/rejections.jsonl.
+import argparse
+import csv
+import json
+import os
+import time
+
+from pdb_fetch import download_many
+import pipeline_config
+from result_cache import ResultCache, DEFAULT_CACHE_DIR
+from results_store import ResultsStore, DEFAULT_STORE_PATH
+from run_report import RunReport
+from contigs import ContigError, parse_contig
+from scheduler import Scheduler
+from workflow_index import WorkflowIndex
+from rfdiffusion_pipeline import setup_folder, stream_targets
+from stages import DEFAULT_ROUTE, PLUGINS, ROUTES
+
+
+def read_manifest(manifest_path):
+    """
+    Read the targets of a batch run from a CSV or JSONL manifest.
+    Returns a list of dicts with the keys pdb_code, contig, name and, when given,
+    number_proteins and num_seq_per_target.
+    """
+    if manifest_path.endswith('.jsonl'):
+        with open(manifest_path) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    else:
+        with open(manifest_path, newline='') as f:
+            rows = list(csv.DictReader(f))
+
+    targets = []
+    seen_names = {}
+    for line_number, row in enumerate(rows, start=1):
+        pdb_code = (row.get('pdb_code') or '').strip()
+        contig = (row.get('contig') or '').strip()
+        if not pdb_code or not contig:
+            raise ValueError(f"Manifest entry {line_number} needs a pdb_code and a contig")
+        try:
+            parse_contig(contig)
+        except ContigError as err:
+            raise ValueError(f"Manifest entry {line_number}: {err}") from err
+
+        # The name is used for the output folders, so it must be unique in the batch
+        name = (row.get('name') or '').strip() or pdb_code
+        if name in seen_names:
+            seen_names[name] += 1
+            name = f"{name}_{seen_names[name]}"
+        else:
+            seen_names[name] = 0
+
+        target = {'pdb_code': pdb_code, 'contig': contig, 'name': name}
+        # Optional per-target number of designs and sequences
+        for key in ('number_proteins', 'num_seq_per_target', 'number_sequences'):
+            if row.get(key) not in (None, ''):
+                target[key] = int(row[key])
+        targets.append(target)
+
+    return targets
+
+
+def run_batch(targets, workers=None, cache=None, index=None, use_tmalign=False,
+              number_proteins=1, num_seq_per_target=1, fold_batch_size=1, fold_batch_wait=30.0,
+              report=None, scheduler=None, filters=None, store=None, routes=None):
+    """
+    Run all the targets through the pipeline stages.
+    workers maps a stage name to its number of workers, missing stages use the default of their plugin.
+    cache is an optional ResultCache shared by all the stages.
+    index is an optional WorkflowIndex, stages it records as done are skipped (resume).
+    use_tmalign scores the designs with the TMalign binary instead of in-process.
+    fold_batch_size > 1 folds the pending sequences in length buckets (see omegafold_batch.py).
+    report is an optional RunReport receiving the time, CPU and memory of every stage run.
+    scheduler is an optional Scheduler handing out the GPUs, cores and memory to the stage runs.
+    filters are optional DesignFilters, failing designs are rejected before folding.
+    store is an optional ResultsStore receiving every result as soon as it is scored.
+    routes are the routes of stages.py every target goes through, concurrently (default rfdiffusion).
+    Returns one dict per folded sequence (see stream_targets) with its status, scores and timings.
+    """
+    tic = time.time()
+
+    # Download all the native structures up front, concurrently
+    for pdb_code, result in download_many(target['pdb_code'] for target in targets).items():
+        if isinstance(result, Exception):
+            print(result)
+
+    results = []
+    for result in stream_targets(targets, number_proteins=number_proteins, num_seq_per_target=num_seq_per_target,
+                                 workers=workers, cache=cache, index=index, use_tmalign=use_tmalign,
+                                 fold_batch_size=fold_batch_size, fold_batch_wait=fold_batch_wait,
+                                 report=report, scheduler=scheduler, filters=filters, store=store, routes=routes):
+        print(f"[{result['name']}] design {result.get('design')} sequence {result.get('sample')}: {result['status']}")
+        results.append(result)
+
+    toc = time.time()
+    done = sum(1 for result in results if result['status'] == 'done')
+    rejected = sum(1 for result in results if result['status'] == 'rejected')
+    print("It took {:.2f} minutes to run {} targets ({} sequences done, {} rejected, {} failed)".format(
+        (toc - tic) / 60, len(targets), done, rejected, len(results) - done - rejected))
+    if routes is not None and len(routes) > 1:
+        for route in routes:
+            route_results = [result for result in results if result.get('route') == route]
+            print(f"{route}: {sum(1 for result in route_results if result['status'] == 'done')} "
+                  f"of {len(route_results)} sequences done")
+    if filters is not None:
+        print(f"Filters: {filters.summary()}")
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the RFdiffusion pipeline on a manifest of targets")
+    parser.add_argument('manifest', help="CSV or JSONL file with pdb_code, contig and optional name")
+    parser.add_argument('--root-dir', default=pipeline_config.root_dir(), help="Folder containing work_flow and the tools")
+    parser.add_argument('--results', default=None, help="JSONL file to write the results to")
+    parser.add_argument('--store', default=DEFAULT_STORE_PATH,
+                        help="SQLite results store the results are added to as they are scored (see results_store.py)")
+    parser.add_argument('--no-store', action='store_true', help="Do not write the results to the results store")
+    parser.add_argument('--number-proteins', type=int, default=1, help="RFdiffusion designs per target")
+    parser.add_argument('--num-seq-per-target', type=int, default=1, help="ProteinMPNN sequences per design")
+    parser.add_argument('--fold-batch-size', type=int, default=1,
+                        help="Fold up to this many pending sequences in one OmegaFold call (length bucketed)")
+    parser.add_argument('--fold-batch-wait', type=float, default=30.0,
+                        help="Seconds to wait for more sequences before folding a batch")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help="Folder of the result cache")
+    parser.add_argument('--cache-size-gb', type=float, default=100, help="Size limit of the result cache in GB")
+    parser.add_argument('--no-cache', action='store_true', help="Always run the tools, even for identical inputs")
+    parser.add_argument('--tmalign', action='store_true', help="Score the designs with the TMalign binary")
+    parser.add_argument('--report', default=None,
+                        help="JSONL file for the per-stage timings (default work_flow/reports/run_<time>.jsonl)")
+    parser.add_argument('--no-resume', action='store_true',
+                        help="Run every stage, even the ones recorded as done in work_flow/index.sqlite")
+    parser.add_argument('--routes', default=DEFAULT_ROUTE,
+                        help=f"Routes every target goes through, separated by commas, run concurrently "
+                             f"(some of {', '.join(ROUTES)}, see stages.py)")
+    for stage, plugin in PLUGINS.items():
+        parser.add_argument(f"--{stage.replace('_', '-')}-workers", type=int, default=None,
+                            help=f"Number of {stage} workers (default {plugin.workers}, "
+                                 f"or as many jobs as fit on the machine with --schedule)")
+    parser.add_argument('--schedule', action='store_true',
+                        help="Give every job a GPU, cores and memory of this machine (see scheduler.py)")
+    parser.add_argument('--gpus', default=None,
+                        help="With --schedule: number of GPUs or GPU ids separated by commas (default: detected)")
+    parser.add_argument('--cpus', type=int, default=None, help="With --schedule: CPU cores to use (default: all)")
+    parser.add_argument('--memory-gb', type=float, default=None, help="With --schedule: memory to use (default: all)")
+    parser.add_argument('--no-backfill', action='store_true',
+                        help="With --schedule: start the jobs strictly in priority order")
+    parser.add_argument('--filters', default=None,
+                        help="Reject designs before folding: JSON file of thresholds, or 'default' (see design_filters.py)")
+    args = parser.parse_args()
+    routes = args.routes.split(',')
+    unknown = [route for route in routes if route not in ROUTES]
+    if unknown:
+        parser.error(f"unknown routes {', '.join(unknown)}, expected some of {', '.join(ROUTES)}")
+
+    targets = read_manifest(os.path.abspath(args.manifest))
+    report_path = os.path.abspath(args.report) if args.report is not None else None
+    results_path = os.path.abspath(args.results) if args.results is not None else None
+    store_path = os.path.abspath(args.store)
+    filters_path = os.path.abspath(args.filters) if args.filters not in (None, 'default') else args.filters
+
+    os.chdir(args.root_dir)
+    setup_folder(args.root_dir)
+
+    cache = None
+    if not args.no_cache:
+        cache = ResultCache(args.cache_dir, max_bytes=int(args.cache_size_gb * 1024 ** 3))
+
+    index = None if args.no_resume else WorkflowIndex()
+    report = RunReport(report_path)
+    store = None if args.no_store else ResultsStore(store_path)
+    filters = None
+    if filters_path is not None:
+        # numpy is only needed by the filters and the scoring, not to start
+        from design_filters import load_filters
+        filters = load_filters(filters_path)
+
+    scheduler = None
+    if args.schedule:
+        gpus = args.gpus
+        if gpus is not None:
+            gpus = int(gpus) if gpus.isdigit() else gpus.split(',')
+        scheduler = Scheduler(gpus, args.cpus, args.memory_gb, backfill=not args.no_backfill)
+
+    workers = {}
+    for stage in {stage for route in routes for stage in ROUTES[route]}:
+        if scheduler is not None:
+            scheduler.stage_resources.setdefault(stage, PLUGINS[stage].resources)
+        workers[stage] = getattr(args, f"{stage}_workers")
+        if workers[stage] is None:
+            workers[stage] = scheduler.capacity(stage) if scheduler is not None else PLUGINS[stage].workers
+    results = run_batch(targets, workers, cache, index, args.tmalign,
+                        args.number_proteins, args.num_seq_per_target, args.fold_batch_size, args.fold_batch_wait,
+                        report, scheduler, filters, store, routes)
+
+    for result in results:
+        scores = (result['tm_score_1'], result['tm_score_2'], result['rmsd']) if result['status'] == 'done' else None
+        print(result['name'], result.get('design'), result.get('sample'), result['status'],
+              scores or result.get('error'))
+
+    if results_path is not None:
+        with open(results_path, 'w') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+
+    if scheduler is not None:
+        print(scheduler.summary())
+    print(f"Stage timings written to {report.path}, see python run_report.py {report.path}")
+
+
+if __name__ == '__main__':
+    main()
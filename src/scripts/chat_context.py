@@ -0,0 +1,181 @@
+# Bounded conversation context for the chatbot
+# The whole conversation is kept in memory, but only a window of it is sent to the model:
+# the last keep_turns turns (a turn is a user message and everything up to the next one),
+# fewer if they do not fit in max_tokens. The older turns are replaced by a short summary
+# (what was asked, which tools ran, which work_flow files they produced), and bulky tool
+# results of the older kept turns are cut, with the full text saved under
+# work_flow/chat_artifacts. Token counts are estimates (about 4 characters per token).
+import hashlib
+import json
+import os
+import re
+import time
+
+DEFAULT_MAX_TOKENS = 20000
+DEFAULT_KEEP_TURNS = 6
+DEFAULT_TOOL_RESULT_CHARS = 2000
+DEFAULT_ARTIFACT_DIR = './work_flow/chat_artifacts'
+
+CHARS_PER_TOKEN = 4
+
+# Paths of work_flow files mentioned in tool results, kept in the summaries
+_WORK_FLOW_PATH = re.compile(r"[\w./-]*work_flow/[\w./-]+")
+
+
+def estimate_tokens(content):
+    """Approximate token count of a message or content list."""
+    return len(json.dumps(content)) // CHARS_PER_TOKEN + 1
+
+
+def _shorten(text, length=200):
+    text = ' '.join(text.split())
+    return text if len(text) <= length else text[:length] + '...'
+
+
+def _is_turn_start(message):
+    # A turn starts with a user message that is not only tool results
+    return message['role'] == 'user' and any('text' in content for content in message['content'])
+
+
+class ConversationContext:
+    """
+    Conversation history with a bounded window sent to the model and per-request metrics.
+    """
+
+    def __init__(self, max_tokens=DEFAULT_MAX_TOKENS, keep_turns=DEFAULT_KEEP_TURNS,
+                 tool_result_chars=DEFAULT_TOOL_RESULT_CHARS, artifact_dir=DEFAULT_ARTIFACT_DIR):
+        self.max_tokens = max_tokens
+        self.keep_turns = keep_turns
+        self.tool_result_chars = tool_result_chars
+        self.artifact_dir = artifact_dir
+        self.messages = []
+        self.tokens = []
+        self.metrics = []
+        # Turn number -> summary, turns are only summarized once
+        self._summaries = {}
+
+    def append(self, message):
+        self.messages.append(message)
+        self.tokens.append(estimate_tokens(message['content']))
+
+    def total_tokens(self):
+        return sum(self.tokens)
+
+    def _turns(self):
+        # Index ranges (start, end) of the turns
+        starts = [i for i, message in enumerate(self.messages) if _is_turn_start(message)]
+        if not starts or starts[0] != 0:
+            starts.insert(0, 0)
+        return list(zip(starts, starts[1:] + [len(self.messages)]))
+
+    def _summarize(self, number, start, end):
+        if number in self._summaries:
+            return self._summaries[number]
+
+        asked, tools, answer, paths = None, [], None, []
+        for message in self.messages[start:end]:
+            for content in message['content']:
+                if 'text' in content and message['role'] == 'user' and asked is None:
+                    asked = content['text']
+                elif 'text' in content and message['role'] == 'assistant' and content['text'].strip():
+                    answer = content['text']
+                elif 'toolUse' in content:
+                    tools.append(f"{content['toolUse']['name']}({json.dumps(content['toolUse']['input'])})")
+                elif 'toolResult' in content:
+                    status = content['toolResult'].get('status', 'success')
+                    for result in content['toolResult']['content']:
+                        paths += _WORK_FLOW_PATH.findall(result.get('text', ''))
+                    if status == 'error':
+                        tools.append('(failed)')
+
+        summary = f"- User: {_shorten(asked or '')}"
+        if tools:
+            summary += f" Tools: {_shorten(', '.join(tools), 300)}."
+        if paths:
+            summary += f" Files: {', '.join(sorted(set(paths))[:10])}."
+        if answer:
+            summary += f" Assistant: {_shorten(answer)}"
+        self._summaries[number] = summary
+        return summary
+
+    def _save_artifact(self, text):
+        name = hashlib.sha1(text.encode()).hexdigest()[:12] + '.txt'
+        path = os.path.join(self.artifact_dir, name)
+        if not os.path.exists(path):
+            os.makedirs(self.artifact_dir, exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(text)
+        return path
+
+    def _compact_tool_results(self, message):
+        # Cut the long tool results of a message, the full text stays in an artifact file
+        if not any('toolResult' in content for content in message['content']):
+            return message
+        contents = []
+        for content in message['content']:
+            if 'toolResult' in content:
+                results = []
+                for result in content['toolResult']['content']:
+                    text = result.get('text')
+                    if text is not None and len(text) > self.tool_result_chars:
+                        path = self._save_artifact(text)
+                        result = {'text': f"{text[:self.tool_result_chars]}\n[{len(text) - self.tool_result_chars} "
+                                          f"more characters in {path}]"}
+                    results.append(result)
+                content = {'toolResult': {**content['toolResult'], 'content': results}}
+            contents.append(content)
+        return {**message, 'content': contents}
+
+    def window(self):
+        """Messages to send to the model: summary of the old turns plus the recent ones."""
+        turns = self._turns()
+        kept = turns[-self.keep_turns:]
+        # Drop more turns while the window is too large, the last turn is always sent
+        while len(kept) > 1 and sum(self.tokens[kept[0][0]:kept[-1][1]]) > self.max_tokens:
+            kept = kept[1:]
+
+        first = kept[0][0] if kept else 0
+        messages = []
+        for i, message in enumerate(self.messages[first:], start=first):
+            # The results of the last turn are sent in full, the model is working on them
+            messages.append(message if i >= turns[-1][0] else self._compact_tool_results(message))
+
+        dropped = turns[:len(turns) - len(kept)]
+        if dropped and messages:
+            summary = "Summary of the earlier conversation (use list_previous_results for the details of a protein):\n"
+            summary += "\n".join(self._summarize(number, start, end) for number, (start, end) in enumerate(dropped))
+            # Added to the first kept user message, the roles must keep alternating
+            messages[0] = {**messages[0], 'content': [{'text': summary}] + messages[0]['content']}
+        return messages
+
+    def record_request(self, sent, latency, usage=None):
+        """
+        Metrics of one model request: sent is the list of messages sent, usage the token
+        counts reported by the model (inputTokens / outputTokens), if any.
+        """
+        usage = usage or {}
+        metrics = {
+            'request': len(self.metrics) + 1,
+            'time': time.time(),
+            'latency': latency,
+            'messages_sent': len(sent),
+            'tokens_sent_estimate': sum(estimate_tokens(message['content']) for message in sent),
+            'history_tokens_estimate': self.total_tokens(),
+            'input_tokens': usage.get('inputTokens'),
+            'output_tokens': usage.get('outputTokens'),
+        }
+        self.metrics.append(metrics)
+        return metrics
+
+    def stats(self):
+        """Summary of the metrics of the conversation, as text."""
+        if not self.metrics:
+            return "No requests yet."
+        latencies = [metrics['latency'] for metrics in self.metrics]
+        input_tokens = sum(metrics['input_tokens'] or metrics['tokens_sent_estimate'] for metrics in self.metrics)
+        output_tokens = sum(metrics['output_tokens'] or 0 for metrics in self.metrics)
+        last = self.metrics[-1]
+        return (f"{len(self.metrics)} requests, {sum(latencies):.1f} s in total ({max(latencies):.1f} s max), "
+                f"{input_tokens} input and {output_tokens} output tokens. "
+                f"Last request: {last['messages_sent']} of {len(self.messages)} messages, "
+                f"~{last['tokens_sent_estimate']} of ~{last['history_tokens_estimate']} tokens.")
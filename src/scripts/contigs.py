@@ -0,0 +1,266 @@
+# Contig specifications of RFdiffusion
+# A contig string like [10-100/A1083-1085/20-40/0 B1-50] describes the designed protein as
+# segments separated by '/': a motif segment (chain letter and residue range, A1083-1085) is
+# copied from the input structure, a generated segment (length range, 20-40, or a fixed
+# length, 20) is built by RFdiffusion, and '0' followed by a space starts a new chain.
+#
+# parse_contig turns the string into typed segments, so a malformed contig is reported
+# before anything runs, and Contig.validate checks it against the input structure (chains
+# and residues that exist, total length within contigmap.length) before RFdiffusion loads
+# its weights on the GPU. Contig.motif_mapping gives the positions of the motif residues in
+# the design, used by the motif RMSD of design_filters.py.
+#
+# Usage:
+#   python contigs.py "[10-100/A1083-1085/20-40]" --pdb work_flow/native_proteins/7SH6.pdb
+import argparse
+import re
+from dataclasses import dataclass
+
+_MOTIF = re.compile(r"^([A-Za-z])(\d+)(?:-(\d+))?$")
+_GENERATED = re.compile(r"^(\d+)(?:-(\d+))?$")
+
+
+class ContigError(ValueError):
+    """Malformed contig, or contig that does not fit its input structure."""
+
+
+@dataclass(frozen=True)
+class MotifSegment:
+    """Residues start to end (inclusive) of a chain of the input structure, kept in the design."""
+    chain: str
+    start: int
+    end: int
+
+    @property
+    def length(self):
+        return self.end - self.start + 1
+
+    def residues(self):
+        return [(self.chain, number) for number in range(self.start, self.end + 1)]
+
+    def __str__(self):
+        return f"{self.chain}{self.start}-{self.end}"
+
+
+@dataclass(frozen=True)
+class GeneratedSegment:
+    """Residues built by RFdiffusion, between min_length and max_length of them."""
+    min_length: int
+    max_length: int
+
+    @property
+    def fixed(self):
+        return self.min_length == self.max_length
+
+    def __str__(self):
+        return f"{self.min_length}-{self.max_length}"
+
+
+@dataclass(frozen=True)
+class ChainBreak:
+    """Start of a new chain of the design ('/0 ' in the contig)."""
+
+    def __str__(self):
+        return "0"
+
+
+class Contig:
+    """Parsed contig, see parse_contig."""
+
+    def __init__(self, segments, text=None):
+        self.segments = list(segments)
+        self.text = text if text is not None else str(self)
+
+    def __str__(self):
+        parts = []
+        for segment in self.segments:
+            # A chain break is written '/0 ' before the next segment
+            parts.append(f"{segment} " if isinstance(segment, ChainBreak) else f"{segment}/")
+        return "[" + "".join(parts).rstrip('/ ') + "]"
+
+    def __repr__(self):
+        return f"Contig({self.text!r})"
+
+    @property
+    def motifs(self):
+        return [segment for segment in self.segments if isinstance(segment, MotifSegment)]
+
+    @property
+    def generated(self):
+        return [segment for segment in self.segments if isinstance(segment, GeneratedSegment)]
+
+    def motif_residues(self):
+        """(chain, residue number) of every motif residue, in design order."""
+        return [residue for motif in self.motifs for residue in motif.residues()]
+
+    def length_bounds(self):
+        """Smallest and largest total length of the design."""
+        motif_length = sum(motif.length for motif in self.motifs)
+        return (motif_length + sum(segment.min_length for segment in self.generated),
+                motif_length + sum(segment.max_length for segment in self.generated))
+
+    @property
+    def fixed(self):
+        """True if every generated segment has a fixed length, so the design layout is known in advance."""
+        return all(segment.fixed for segment in self.generated)
+
+    def motif_mapping(self, lengths=None):
+        """
+        Pairs ((chain, residue) of the input, 0-based position in the design) of the motif
+        residues. lengths are the lengths RFdiffusion chose for the generated segments, in
+        order; they can be left out if the contig is fixed.
+        """
+        if lengths is None:
+            if not self.fixed:
+                raise ContigError(f"{self.text} has generated segments of variable length, "
+                                  f"their lengths are needed for the motif positions")
+            lengths = [segment.min_length for segment in self.generated]
+        lengths = list(lengths)
+        if len(lengths) != len(self.generated):
+            raise ContigError(f"{self.text} has {len(self.generated)} generated segments, got {len(lengths)} lengths")
+
+        pairs = []
+        position = 0
+        generated = iter(lengths)
+        for segment in self.segments:
+            if isinstance(segment, MotifSegment):
+                pairs += [(residue, position + i) for i, residue in enumerate(segment.residues())]
+                position += segment.length
+            elif isinstance(segment, GeneratedSegment):
+                position += next(generated)
+        return pairs
+
+    def validate(self, residues=None, total_length=None):
+        """
+        Raise a ContigError if the motif residues are not among residues (the (chain, number)
+        pairs of the input structure, see structure_residues) or if the design can not have
+        a total length in total_length (contigmap.length, e.g. "100-150"). Returns the contig.
+        """
+        if residues is not None:
+            residues = set(residues)
+            chains = sorted({chain for chain, _ in residues})
+            for motif in self.motifs:
+                if motif.chain not in chains:
+                    raise ContigError(f"Chain {motif.chain} of {motif} is not in the input structure "
+                                      f"(chains {', '.join(chains) or 'none'})")
+                missing = [number for chain, number in motif.residues() if (chain, number) not in residues]
+                if missing:
+                    shown = ', '.join(str(number) for number in missing[:10])
+                    raise ContigError(f"Residues {shown}{'...' if len(missing) > 10 else ''} of {motif} "
+                                      f"are not in the input structure")
+
+        if total_length is not None:
+            low, high = parse_length_range(total_length)
+            min_length, max_length = self.length_bounds()
+            if max_length < low or min_length > high:
+                raise ContigError(f"{self.text} makes designs of {min_length}-{max_length} residues, "
+                                  f"outside contigmap.length {total_length}")
+        return self
+
+
+def parse_length_range(text):
+    """(low, high) of a length range like "100-150" or "120"."""
+    match = _GENERATED.match(str(text).strip())
+    if match is None:
+        raise ContigError(f"Invalid length range {text!r}, expected e.g. 100-150")
+    low, high = int(match.group(1)), int(match.group(2) or match.group(1))
+    if low > high:
+        raise ContigError(f"Invalid length range {text!r}, {low} is more than {high}")
+    return low, high
+
+
+def parse_contig(text):
+    """Parse a contig string (with or without the brackets) into a Contig, raises ContigError."""
+    if isinstance(text, Contig):
+        return text
+    body = str(text).strip()
+    if body.startswith('['):
+        if not body.endswith(']'):
+            raise ContigError(f"Contig {text!r} has no closing bracket")
+        body = body[1:-1].strip()
+    if not body:
+        raise ContigError("Empty contig")
+
+    segments = []
+    # Chains are separated by spaces, written "/0 " by RFdiffusion
+    for chain_number, chain in enumerate(body.split()):
+        if chain_number > 0 and not (segments and isinstance(segments[-1], ChainBreak)):
+            segments.append(ChainBreak())
+        for part in chain.split('/'):
+            if part == '0':
+                segments.append(ChainBreak())
+                continue
+            motif = _MOTIF.match(part)
+            generated = _GENERATED.match(part)
+            if motif:
+                start = int(motif.group(2))
+                end = int(motif.group(3) or start)
+                if end < start:
+                    raise ContigError(f"Motif segment {part!r} of {text!r} ends before it starts")
+                segments.append(MotifSegment(motif.group(1), start, end))
+            elif generated:
+                low = int(generated.group(1))
+                high = int(generated.group(2) or low)
+                if high < low:
+                    raise ContigError(f"Segment {part!r} of {text!r} has a larger minimum than maximum length")
+                if high == 0:
+                    raise ContigError(f"Segment {part!r} of {text!r} has no residues")
+                segments.append(GeneratedSegment(low, high))
+            else:
+                raise ContigError(f"Invalid segment {part!r} in contig {text!r}, expected a length range "
+                                  f"(20-40), a fixed length (20) or a motif with its chain (A1083-1085)")
+
+    if segments and isinstance(segments[-1], ChainBreak):
+        segments.pop()
+    if not any(isinstance(segment, (MotifSegment, GeneratedSegment)) for segment in segments):
+        raise ContigError(f"Contig {text!r} has no segments")
+    return Contig(segments, str(text).strip())
+
+
+def structure_residues(path):
+    """(chain, residue number) of the residues with a CA atom in the first model of a PDB file."""
+    residues = []
+    seen = set()
+    with open(path) as f:
+        for line in f:
+            if line.startswith('ENDMDL'):
+                break
+            if line.startswith(('ATOM', 'HETATM')) and line[12:16].strip() == 'CA':
+                residue = (line[21], int(line[22:26]))
+                if residue not in seen:
+                    seen.add(residue)
+                    residues.append(residue)
+    return residues
+
+
+def validate_contig(text, input_file=None, total_length=None):
+    """Parse a contig and check it against its input PDB file, returns the Contig (raises ContigError)."""
+    contig = parse_contig(text)
+    residues = structure_residues(input_file) if input_file else None
+    return contig.validate(residues, total_length)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parse and validate an RFdiffusion contig")
+    parser.add_argument('contig')
+    parser.add_argument('--pdb', default=None, help="Input structure to check the motif residues against")
+    parser.add_argument('--length', default=None, help="contigmap.length, e.g. 100-150")
+    args = parser.parse_args()
+
+    try:
+        contig = validate_contig(args.contig, args.pdb, args.length)
+    except (ContigError, OSError) as err:
+        raise SystemExit(f"Invalid contig: {err}")
+    min_length, max_length = contig.length_bounds()
+    print(f"{contig}: {len(contig.motifs)} motif segments ({len(contig.motif_residues())} residues), "
+          f"{len(contig.generated)} generated segments, design length {min_length}-{max_length}")
+    for segment in contig.segments:
+        kind = {MotifSegment: 'motif', GeneratedSegment: 'generated', ChainBreak: 'chain break'}[type(segment)]
+        print(f"  {kind:<12}{segment}")
+    if contig.fixed and contig.motifs:
+        print("Motif positions in the design (0-based):",
+              ", ".join(f"{chain}{number}->{position}" for (chain, number), position in contig.motif_mapping()))
+
+
+if __name__ == '__main__':
+    main()
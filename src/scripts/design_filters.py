@@ -0,0 +1,274 @@
+# Cheap early-rejection filters between the pipeline tools
+# Folding is the most expensive stage, and most of the designs that score badly in the end
+# could have been recognized before it. Two checks run in the pipeline (see stream_targets):
+#   - on every RFdiffusion backbone: chain breaks (consecutive CA atoms of a chain not ~3.8 A
+#     apart), CA clashes, radius of gyration of every chain against a compact protein of the
+#     same length (designs with a '/0 ' in the contig have several chains), and RMSD of
+#     the motif residues against the native ones (mapping from the .trb file of RFdiffusion,
+#     or from the contig when all the generated segments have a fixed length, see contigs.py)
+#   - on every ProteinMPNN sequence: score, global score and sequence recovery thresholds,
+#     read from the headers of the .fa file
+# A rejected design or sequence skips the remaining stages, and the reason is written to
+# work_flow/rejections.jsonl. A threshold set to None disables its check.
+#
+# Thresholds come from a JSON file overriding DEFAULT_THRESHOLDS, e.g. {"max_motif_rmsd": 1.0,
+# "max_mpnn_score": 1.2}. To calibrate them on designs already made:
+#   python design_filters.py work_flow/designs/7SH6/*/rfdiffusion/*.pdb --native work_flow/native_proteins/7SH6.pdb --contig "[10-40/A163-181/10-40]"
+#   python design_filters.py --fasta work_flow/designs/7SH6/*/protein_mpnn/*.fa --filters filters.json
+import argparse
+import json
+import os
+import pickle
+import re
+import threading
+import time
+
+import numpy as np
+
+from contigs import parse_contig
+from structural_scoring import kabsch_rmsd, tm_score
+
+DEFAULT_THRESHOLDS = {
+    # Largest deviation (A) of a consecutive CA-CA distance from 3.8 A, more is a chain break
+    'max_ca_ca_deviation': 0.5,
+    # Pairs of CA atoms at least 3 residues apart closer than clash_distance (A)
+    'clash_distance': 3.0,
+    'max_clashes': 2,
+    # Radius of gyration divided by that of a compact protein of the same length (2.2 * L^0.38),
+    # a single straight helix of 40-60 residues is around 2 to 2.5
+    'max_rg_ratio': 2.5,
+    # RMSD (A) of the motif residues of the design against the native motif
+    'max_motif_rmsd': 1.5,
+    # ProteinMPNN scores are negative log-likelihoods (lower is better), recovery is a fraction
+    'max_mpnn_score': None,
+    'max_mpnn_global_score': None,
+    'min_seq_recovery': None,
+}
+
+DEFAULT_LOG = './work_flow/rejections.jsonl'
+
+def backbone_metrics(coords, clash_distance=DEFAULT_THRESHOLDS['clash_distance'], chains=None):
+    """
+    Chain-break deviation, clash count and radius of gyration of an (L, 3) CA array.
+    chains is the chain of every residue (default: a single chain). Only consecutive residues
+    of a chain are bonded, and rg is that of the least compact chain.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    length = len(coords)
+    chains = np.asarray(chains if chains is not None else [''] * length)
+    steps = np.linalg.norm(np.diff(coords, axis=0), axis=1)[chains[1:] == chains[:-1]]
+    distances = np.linalg.norm(coords[:, None, :] - coords[None, :, :], axis=-1)
+    # Residues of a chain can only clash at least 3 apart, residues of different chains always
+    positions = np.arange(length)
+    far_apart = np.triu((positions[None, :] - positions[:, None] >= 3) | (chains[:, None] != chains[None, :]), k=1)
+    rg, rg_ratio = 0.0, 0.0
+    for chain in dict.fromkeys(chains.tolist()):
+        chain_coords = coords[chains == chain]
+        chain_rg = float(np.sqrt(((chain_coords - chain_coords.mean(axis=0)) ** 2).sum(axis=1).mean()))
+        if chain_rg / (2.2 * len(chain_coords) ** 0.38) >= rg_ratio:
+            rg, rg_ratio = chain_rg, chain_rg / (2.2 * len(chain_coords) ** 0.38)
+    return {
+        'length': length,
+        'chains': len(set(chains.tolist())),
+        'ca_ca_deviation': float(np.abs(steps - 3.8).max()) if len(steps) else 0.0,
+        'clashes': int((distances[far_apart] < clash_distance).sum()),
+        'rg': rg,
+        'rg_ratio': rg_ratio,
+    }
+
+
+def backbone_file_metrics(path, clash_distance=DEFAULT_THRESHOLDS['clash_distance']):
+    """backbone_metrics of the CA atoms of a PDB file, with their chains."""
+    residues, coords = _read_residue_ca(path)
+    return backbone_metrics(coords, clash_distance, chains=[chain for chain, _ in residues])
+
+
+def _read_residue_ca(path):
+    # (chain, residue number) of the residues in file order and their CA coordinates, first model only
+    residues, coords, seen = [], [], set()
+    with open(path) as f:
+        for line in f:
+            if line.startswith('ENDMDL'):
+                break
+            if line.startswith('ATOM') and line[12:16].strip() == 'CA' and line[16] in (' ', 'A'):
+                residue = (line[21], int(line[22:26]))
+                if residue not in seen:
+                    seen.add(residue)
+                    residues.append(residue)
+                    coords.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+    return residues, np.array(coords, dtype=np.float64)
+
+
+def motif_mapping(design_path, contig):
+    """
+    Pairs ((native chain, residue), 0-based position in the design) of the motif residues of
+    a design. Read from the .trb file RFdiffusion writes next to the design, or from the
+    contig if all its generated segments have a fixed length. None if it can not be known.
+    """
+    trb_path = os.path.splitext(design_path)[0] + '.trb'
+    if os.path.exists(trb_path):
+        try:
+            with open(trb_path, 'rb') as f:
+                trb = pickle.load(f)
+        except (pickle.UnpicklingError, EOFError, ImportError, AttributeError, ValueError):
+            # Not written by RFdiffusion, fall back to the contig
+            trb = {}
+        if isinstance(trb, dict) and 'con_ref_pdb_idx' in trb and 'con_hal_pdb_idx' in trb:
+            positions = {residue: i for i, residue in enumerate(_read_residue_ca(design_path)[0])}
+            return [((chain, int(number)), positions.get((design_chain, int(design_number))))
+                    for (chain, number), (design_chain, design_number)
+                    in zip(trb['con_ref_pdb_idx'], trb['con_hal_pdb_idx'])]
+
+    contig = parse_contig(contig)
+    return contig.motif_mapping() if contig.fixed else None
+
+
+def _motif_coords(design_path, native_path, contig):
+    # CA coordinates of the motif residues in the design and in the native structure, None if unknown
+    pairs = motif_mapping(design_path, contig)
+    if not pairs:
+        return None
+    native_residues, native_coords = _read_residue_ca(native_path)
+    native = dict(zip(native_residues, native_coords))
+    design = _read_residue_ca(design_path)[1]
+    pairs = [(ref, position) for ref, position in pairs
+             if ref in native and position is not None and position < len(design)]
+    if len(pairs) < 3:
+        return None
+    return design[[position for _, position in pairs]], np.array([native[ref] for ref, _ in pairs])
+
+
+def motif_rmsd(design_path, native_path, contig):
+    """RMSD of the motif residues of a design against the native structure, None if unknown."""
+    coords = _motif_coords(design_path, native_path, contig)
+    return float(kabsch_rmsd(*coords)[0]) if coords is not None else None
+
+
+def motif_scores(design_path, native_path, contig):
+    """
+    (tm_score, tm_score, rmsd) of the motif residues of a design against the native ones, in
+    the form of structural_scoring.score_pair, None if the motif positions are unknown.
+    """
+    coords = _motif_coords(design_path, native_path, contig)
+    if coords is None:
+        return None
+    scores, rmsds = tm_score(*coords)
+    return float(scores[0]), float(scores[0]), float(rmsds[0])
+
+
+def mpnn_fields(header):
+    """Numeric fields of a ProteinMPNN .fa header, e.g. score, global_score and seq_recovery."""
+    fields = {}
+    for key, value in re.findall(r"(\w+)=([^,]+)", header):
+        try:
+            fields[key] = float(value)
+        except ValueError:
+            pass
+    return fields
+
+
+class DesignFilters:
+    """
+    Thresholds applied to the backbones and sequences of the pipeline. The check methods
+    return None for a design that passes, or the reason of the rejection, which is logged.
+    """
+
+    def __init__(self, thresholds=None, log_path=DEFAULT_LOG):
+        unknown = set(thresholds or {}) - set(DEFAULT_THRESHOLDS)
+        if unknown:
+            raise ValueError(f"Unknown filter thresholds: {', '.join(sorted(unknown))}")
+        self.thresholds = {**DEFAULT_THRESHOLDS, **(thresholds or {})}
+        self.log_path = log_path
+        self.checked = {'backbone': 0, 'sequence': 0}
+        self.rejected = {'backbone': 0, 'sequence': 0}
+        self._lock = threading.Lock()
+
+    def _over(self, name, value):
+        limit = self.thresholds[name]
+        if limit is None or value is None:
+            return False
+        return value < limit if name.startswith('min_') else value > limit
+
+    def _result(self, kind, name, design, reasons, metrics, sample=None):
+        with self._lock:
+            self.checked[kind] += 1
+            if not reasons:
+                return None
+            self.rejected[kind] += 1
+            reason = '; '.join(reasons)
+            print(f"[{name}] {kind} {design}{'' if sample is None else f' sequence {sample}'} rejected: {reason}")
+            if self.log_path:
+                os.makedirs(os.path.dirname(self.log_path) or '.', exist_ok=True)
+                with open(self.log_path, 'a') as f:
+                    f.write(json.dumps({'time': time.time(), 'name': name, 'kind': kind, 'design': design,
+                                        'sample': sample, 'reason': reason, 'metrics': metrics}) + '\n')
+            return reason
+
+    def check_backbone(self, name, design, path, native_path=None, contig=None):
+        """Geometry checks of an RFdiffusion design (motif RMSD needs the native structure and contig)."""
+        metrics = backbone_file_metrics(path, self.thresholds['clash_distance'])
+        if native_path is not None and contig and self.thresholds['max_motif_rmsd'] is not None:
+            metrics['motif_rmsd'] = motif_rmsd(path, native_path, contig)
+
+        reasons = []
+        if self._over('max_ca_ca_deviation', metrics['ca_ca_deviation']):
+            reasons.append(f"chain break (CA-CA off by {metrics['ca_ca_deviation']:.2f} A)")
+        if self._over('max_clashes', metrics['clashes']):
+            reasons.append(f"{metrics['clashes']} CA clashes")
+        if self._over('max_rg_ratio', metrics['rg_ratio']):
+            reasons.append(f"not compact (Rg {metrics['rg']:.1f} A, {metrics['rg_ratio']:.2f}x)")
+        if self._over('max_motif_rmsd', metrics.get('motif_rmsd')):
+            reasons.append(f"motif RMSD {metrics['motif_rmsd']:.2f} A")
+        return self._result('backbone', name, design, reasons, metrics)
+
+    def check_sequence(self, name, design, sample, header):
+        """Score thresholds of a ProteinMPNN sequence, from its .fa header."""
+        fields = mpnn_fields(header)
+        reasons = []
+        for threshold, field in (('max_mpnn_score', 'score'), ('max_mpnn_global_score', 'global_score'),
+                                 ('min_seq_recovery', 'seq_recovery')):
+            if self._over(threshold, fields.get(field)):
+                reasons.append(f"{field} {fields[field]:.3f}")
+        return self._result('sequence', name, design, reasons, fields, sample)
+
+    def summary(self):
+        return ", ".join(f"{self.rejected[kind]} of {self.checked[kind]} {kind}s rejected" for kind in self.checked)
+
+
+def load_filters(path=None, log_path=DEFAULT_LOG):
+    """DesignFilters with the thresholds of a JSON file, or the defaults if path is None or 'default'."""
+    thresholds = None
+    if path not in (None, 'default'):
+        with open(path) as f:
+            thresholds = json.load(f)
+    return DesignFilters(thresholds, log_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check RFdiffusion backbones and ProteinMPNN sequences against the filter thresholds")
+    parser.add_argument('designs', nargs='*', help="RFdiffusion design PDB files")
+    parser.add_argument('--native', default=None, help="Native structure, for the motif RMSD")
+    parser.add_argument('--contig', default=None, help="Contig of the designs, for the motif RMSD")
+    parser.add_argument('--fasta', nargs='*', default=[], help="ProteinMPNN .fa files")
+    parser.add_argument('--filters', default=None, help="JSON file with the thresholds (default DEFAULT_THRESHOLDS)")
+    args = parser.parse_args()
+
+    # Only reports, nothing is logged
+    filters = load_filters(args.filters, log_path=None)
+    for path in args.designs:
+        metrics = backbone_file_metrics(path, filters.thresholds['clash_distance'])
+        if args.native and args.contig:
+            metrics['motif_rmsd'] = motif_rmsd(path, args.native, args.contig)
+        print(path, json.dumps({key: round(value, 3) if isinstance(value, float) else value
+                                for key, value in metrics.items()}))
+        filters.check_backbone(os.path.basename(path), 0, path, args.native, args.contig)
+    for path in args.fasta:
+        from rfdiffusion_pipeline import read_fasta
+        for header, _ in read_fasta(path)[1:]:
+            print(path, header)
+            filters.check_sequence(os.path.basename(path), 0, None, header)
+    print(filters.summary())
+
+
+if __name__ == '__main__':
+    main()
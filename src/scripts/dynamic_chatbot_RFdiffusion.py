@@ -1,85 +1,76 @@
+import asyncio
+import itertools
 import logging
 import json
-import boto3
+import time
 import os
-import requests
-from botocore.exceptions import ClientError
+
+from chat_context import ConversationContext
+from stream_events import StreamAssembler
+import pdb_fetch
+# The folder setup and the RFdiffusion call are the ones of the pipeline, tool paths from pipeline_config.py
+from rfdiffusion_pipeline import run_rfdiffusion, setup_folder
+from results_store import ResultsStore, format_results
+from workflow_index import WorkflowIndex
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-def setup_folder(root_dir):
-    # Define the base folder in AWS
-    base_folder = os.path.join(root_dir, 'work_flow')
-
-    # Define the subfolders
-    subfolders = ['RFdiffusion_output', 'mpnn_output', 'omegafold_output', 'native_proteins']
-
-    # Check if the base folder already exists
-    if not os.path.exists(base_folder):
-        # Create the base folder
-        os.makedirs(base_folder, exist_ok=True)
-
-        # Create the subfolders
-        for subfolder in subfolders:
-            os.makedirs(os.path.join(base_folder, subfolder), exist_ok=True)
-
-        print("work-flow folder structure created successfully.")
-    else:
-        print("The folder 'work_flow' already exists.")
-
-#TODO: We would like to add a function that can parse the output work_flow folder for previously-created files
+# Index of the previously-created files in the work_flow folder and store of the scored
+# designs of the pipeline runs, set up in main()
+workflow_index = None
+results_store = None
+
+def setup_index(root_dir):
+    # Parse the work_flow folder once for files created before the index existed
+    global workflow_index, results_store
+    workflow_index = WorkflowIndex(os.path.join(root_dir, 'work_flow', 'index.sqlite'))
+    results_store = ResultsStore(os.path.join(root_dir, 'work_flow', 'results.sqlite'))
+    added = workflow_index.scan(os.path.join(root_dir, 'work_flow'))
+    if added:
+        print(f"Indexed {added} previously-created files in the work_flow folder.")
+
+def list_previous_results(pdb_code):
+    entries = []
+    for target in sorted({pdb_code, pdb_code.upper()}):
+        entries += workflow_index.lookup(target)
+    if not entries:
+        return f"No previously-created files found for {pdb_code}."
+    lines = [f"Previously-created files for {pdb_code}:"]
+    for entry in entries:
+        line = f"- {entry['stage']} design {entry['design']}: {entry['status']}"
+        if entry['path'] is not None:
+            line += f", {entry['path']}"
+        if entry['metrics'] is not None:
+            line += f", metrics {entry['metrics']}"
+        lines.append(line)
+    return "\n".join(lines)
+
+def top_designs(pdb_code=None, k=10, metric='tm_score_1', max_rmsd=None):
+    # Best scored designs of the pipeline runs, from the results store
+    rows = results_store.top(k, metric, pdb_code=pdb_code, max_rmsd=max_rmsd)
+    if not rows:
+        return f"No scored designs found{f' for {pdb_code}' if pdb_code else ''}."
+    return f"Best {len(rows)} designs by {metric}:\n" + format_results(rows)
 
 def download_pdb(pdb_code, target_directory='./work_flow/native_proteins'):
-    # Ensure the target directory exists
-    os.makedirs(target_directory, exist_ok=True)
-
-    # Construct the full path for the PDB file
-    pdb_file_path = os.path.join(target_directory, f"{pdb_code.upper()}.pdb")
+    # Downloads go through the shared session of pdb_fetch, a file already on disk is reused
+    try:
+        pdb_file_path = pdb_fetch.download_pdb(pdb_code, target_directory)
+    except pdb_fetch.PDBFetchError as err:
+        return f"{err}. Please verify PDB code is correct and exists in RCSB database."
+    return f"PDB file {pdb_code.upper()} downloaded successfully to {pdb_file_path}"
 
-    # URL for downloading the PDB file
-    url = f"https://files.rcsb.org/download/{pdb_code.upper()}.pdb"
+def required_fields(tool_config):
+    """Required arguments of every tool of a tool config, by tool name."""
+    return {tool['toolSpec']['name']: tool['toolSpec']['inputSchema']['json'].get('required', [])
+            for tool in tool_config['tools']}
 
-    # Request the PDB file
-    response = requests.get(url)
 
-    if response.status_code == 200:
-        # Write the content to the PDB file
-        with open(pdb_file_path, 'wb') as f:
-            f.write(response.content)
-        return f"PDB file {pdb_code.upper()} downloaded successfully to {pdb_file_path}"
-    else:
-        return f"Failed to download PDB file {pdb_code.upper()}. Status code: {response.status_code}. Please verify PDB code is correct and exists in RCSB database."
-
-#NOTE: We have swapped the order of "residues_backbone" (formerly residues) and number_proteins, so that we can hard-code number_proteins
-def run_rfdiffusion(input_file: str, output_dir_and_prefix: str, residues_backbone: str,
-                    number_proteins: int = 1, guide_scale: int = None, substrate_name: str = None, model_weights: str = None,
-                    contig_length: str = None, guiding_potentials: str = None):
-    if input_file is not None and not os.path.exists(input_file):
-        raise ValueError("Input file does not exist")
-    if residues_backbone is None and guide_scale is not None:
-        raise ValueError("Please fill in residues for the backbone")
-    sh_call = "./models/RFdiffusion/scripts/run_inference.py"
-    sh_call += " inference.output_prefix=" + output_dir_and_prefix
-    sh_call += " inference.num_designs=" + str(number_proteins)
-    if input_file != "":
-        sh_call += " inference.input_pdb=" + input_file
-    if residues_backbone is not None:
-        sh_call += " 'contigmap.contigs=" + residues_backbone + "'"
-    if contig_length is not None:
-        sh_call += " contigmap.length=" + contig_length
-    if guide_scale is not None:
-        sh_call += " potentials.guide_scale=" + str(guide_scale)
-    if guiding_potentials is not None:
-        sh_call += " 'potentials.guiding_potentials=[" + '"' + guiding_potentials + '"' + "]'"
-    if substrate_name is not None:
-        sh_call += " potentials.substrate=" + substrate_name
-    if model_weights is not None:
-        sh_call += " inference.ckpt_override_path=" + model_weights
-    print("Running RFdiffusion with call", sh_call)
-    os.system(sh_call)
-
-def stream_messages(bedrock_client, model_id, messages, tool_config):
+def stream_messages(bedrock_client, model_id, messages, tool_config, metadata=None, on_tool_ready=None):
+    # metadata, if given, receives the usage and metrics reported at the end of the stream.
+    # on_tool_ready, if given, is called with every tool call as soon as its required
+    # arguments are complete, before the end of the message (see stream_events.py)
     logger.info("Streaming messages with model %s", model_id)
 
     response = bedrock_client.converse_stream(
@@ -88,203 +79,449 @@ def stream_messages(bedrock_client, model_id, messages, tool_config):
         toolConfig=tool_config
     )
 
-    stop_reason = ""
-    message = {}
-    content = []
-    message['content'] = content
-    text = ''
-    tool_use = {}
+    assembler = StreamAssembler(required_fields(tool_config), on_text=lambda text: print(text, end=''), on_tool_ready=on_tool_ready)
 
+    # With CHATBOT_RECORD_DIR set, the chunks are saved for stream_replay_benchmark.py
+    recorder = _stream_recorder()
+    tic = time.time()
     for chunk in response['stream']:
-        if 'messageStart' in chunk:
-            message['role'] = chunk['messageStart']['role']
-        elif 'contentBlockStart' in chunk:
-            tool = chunk['contentBlockStart']['start']['toolUse']
-            tool_use['toolUseId'] = tool['toolUseId']
-            tool_use['name'] = tool['name']
-        elif 'contentBlockDelta' in chunk:
-            delta = chunk['contentBlockDelta']['delta']
-            if 'toolUse' in delta:
-                if 'input' not in tool_use:
-                    tool_use['input'] = ''
-                tool_use['input'] += delta['toolUse']['input']
-            elif 'text' in delta:
-                text += delta['text']
-                print(delta['text'], end='')
-        elif 'contentBlockStop' in chunk:
-            if 'input' in tool_use:
-                tool_use['input'] = json.loads(tool_use['input'])
-                content.append({'toolUse': tool_use})
-                tool_use = {}
-            else:
-                content.append({'text': text})
-                text = ''
+        if recorder is not None:
+            recorder.write(json.dumps({'t': time.time() - tic, 'chunk': chunk}, default=str) + '\n')
+        assembler.process(chunk)
+    if recorder is not None:
+        recorder.close()
 
-        elif 'messageStop' in chunk:
-            stop_reason = chunk['messageStop']['stopReason']
+    if metadata is not None:
+        metadata.update(assembler.metadata)
+    return assembler.stop_reason, assembler.message()
 
-    return stop_reason, message
+_recorded_streams = itertools.count(1)
+
+def _stream_recorder():
+    record_dir = os.environ.get('CHATBOT_RECORD_DIR')
+    if not record_dir:
+        return None
+    os.makedirs(record_dir, exist_ok=True)
+    return open(os.path.join(record_dir, f"stream_{time.strftime('%Y%m%d-%H%M%S')}_{next(_recorded_streams)}.jsonl"), 'w')
 
 def process_tool_use(tool_name, tool_input):
     if tool_name == 'download_pdb':
         pdb_code = tool_input['pdb_code']
         target_directory = tool_input.get('target_directory', './work_flow/native_proteins')
         return download_pdb(pdb_code, target_directory)
+    elif tool_name == 'list_previous_results':
+        return list_previous_results(tool_input['pdb_code'])
+    elif tool_name == 'top_designs':
+        return top_designs(tool_input.get('pdb_code'), int(tool_input.get('k', 10)),
+                           tool_input.get('metric', 'tm_score_1'), tool_input.get('max_rmsd'))
     elif tool_name == 'run_rfdiffusion':
         input_file = tool_input['input_file']
         output_dir_and_prefix = tool_input['output_dir_and_prefix']
         residues_backbone = tool_input['residues_backbone']
-        number_proteins = tool_input['number_proteins']
+        number_proteins = tool_input.get('number_proteins', 1)
         guide_scale = tool_input.get('guide_scale')
         substrate_name = tool_input.get('substrate_name')
         model_weights = tool_input.get('model_weights')
         contig_length = tool_input.get('contig_length')
         guiding_potentials = tool_input.get('guiding_potentials')
-        run_rfdiffusion(
-            input_file, output_dir_and_prefix, residues_backbone, number_proteins, guide_scale,
-            substrate_name, model_weights, contig_length, guiding_potentials
-        )
-        return "RFdiffusion run completed successfully."
 
-def main():
-    setup_folder(os.getcwd())
-
-    model_id = "anthropic.claude-3-haiku-20240307-v1:0"
-
-    try:
-        bedrock_client = boto3.client(service_name='bedrock-runtime')
-
-        messages = []
-        tool_config = {
-            "tools": [
-                {
-                    "toolSpec": {
-                        "name": "download_pdb",
-                        "description": "Download, from the RCSB PDB database, the PDB file of the protein identified by its PDB code. Examples of PDB codes are '5AN7' and '6KUS'.",
-                        "inputSchema": {
-                            "json": {
-                                "type": "object",
-                                "properties": {
-                                    "pdb_code": {
-                                        "type": "string",
-                                        "description": "The PDB code of the protein to download."
-                                    },
-                                    "target_directory": {
-                                        "type": "string",
-                                        "description": "The directory where the PDB file will be saved.",
-                                        "default": "./work_flow/native_proteins"
-                                    }
-                                },
-                                "required": ["pdb_code"]
+        # Designs are indexed under the name of the output prefix, skip the run if they exist
+        name = os.path.basename(output_dir_and_prefix.rstrip('/'))
+        params = {
+            'input_file': input_file, 'residues_backbone': residues_backbone, 'number_proteins': number_proteins,
+            'guide_scale': guide_scale, 'substrate_name': substrate_name, 'model_weights': model_weights,
+            'contig_length': contig_length, 'guiding_potentials': guiding_potentials
+        }
+        designs = [f"{output_dir_and_prefix}_{i}.pdb" for i in range(number_proteins)]
+        if all(workflow_index.is_complete(name, 'rfdiffusion', design=i, params=params) for i in range(number_proteins)):
+            return "RFdiffusion designs with these settings already exist: " + ", ".join(designs)
+
+        # The contig is checked against the input structure before RFdiffusion starts, and a
+        # ContigError or JobError goes back to the model
+        job = run_rfdiffusion(
+            input_file, output_dir_and_prefix, number_proteins, residues=residues_backbone,
+            guide_scale=guide_scale, substrate_name=substrate_name, model_weights=model_weights,
+            contig_length=contig_length, guiding_potentials=guiding_potentials
+        )
+        for i, design in enumerate(designs):
+            if os.path.exists(design):
+                workflow_index.record(name, 'rfdiffusion', design, design=i, params=params)
+            else:
+                workflow_index.fail(name, 'rfdiffusion', design=i, params=params)
+        return f"RFdiffusion run completed successfully in {job.wall_time / 60:.1f} minutes."
+    else:
+        raise ValueError(f"Unknown tool {tool_name}")
+
+# Tools the model can call
+TOOL_CONFIG = {
+    "tools": [
+        {
+            "toolSpec": {
+                "name": "download_pdb",
+                "description": "Download, from the RCSB PDB database, the PDB file of the protein identified by its PDB code. Examples of PDB codes are '5AN7' and '6KUS'.",
+                "inputSchema": {
+                    "json": {
+                        "type": "object",
+                        "properties": {
+                            "pdb_code": {
+                                "type": "string",
+                                "description": "The PDB code of the protein to download."
+                            },
+                            "target_directory": {
+                                "type": "string",
+                                "description": "The directory where the PDB file will be saved.",
+                                "default": "./work_flow/native_proteins"
+                            }
+                        },
+                        "required": ["pdb_code"]
+                    }
+                }
+            }
+        },
+        {
+            "toolSpec": {
+                "name": "list_previous_results",
+                "description": "List the files previously created in the work_flow folder for a protein (native PDB file, RFdiffusion designs, ProteinMPNN sequences, OmegaFold structures and scores). Use it before running a tool, to avoid repeating work that already exists.",
+                "inputSchema": {
+                    "json": {
+                        "type": "object",
+                        "properties": {
+                            "pdb_code": {
+                                "type": "string",
+                                "description": "The PDB code (or output name) of the protein."
+                            }
+                        },
+                        "required": ["pdb_code"]
+                    }
+                }
+            }
+        },
+        {
+            "toolSpec": {
+                "name": "top_designs",
+                "description": "List the best designs scored by the pipeline runs (batch runs, sweeps, ...), ranked by TM-score, RMSD or ProteinMPNN score, with their target, design and sample numbers and the path of the folded structure.",
+                "inputSchema": {
+                    "json": {
+                        "type": "object",
+                        "properties": {
+                            "pdb_code": {
+                                "type": "string",
+                                "description": "Only the designs of this native protein. Leave it out for all the proteins."
+                            },
+                            "k": {
+                                "type": "integer",
+                                "description": "Number of designs to list.",
+                                "default": "10"
+                            },
+                            "metric": {
+                                "type": "string",
+                                "enum": ["tm_score_1", "tm_score_2", "rmsd", "mpnn_score"],
+                                "description": "Ranking metric, higher TM-scores and lower RMSD and ProteinMPNN scores are better.",
+                                "default": "tm_score_1"
+                            },
+                            "max_rmsd": {
+                                "type": "number",
+                                "description": "Only the designs with at most this RMSD (in Angstrom)."
                             }
                         }
                     }
-                },
-                {
-                    "toolSpec": {
-                        "name": "run_rfdiffusion",
-                        "description": "Execute the RFdiffusion model to generate protein designs.",
-                        "inputSchema": {
-                            "json": {
-                                "type": "object",
-                                "properties": {
-                                    "input_file": {
-                                        "type": "string",
-                                        "description": "Path to the input PDB file."
-                                    },
-                                    "output_dir_and_prefix": {
-                                        "type": "string",
-                                        "description": "Output directory and prefix for the results.",
-                                        "default": "./work_flow/RFdiffusion_output"
-                                    },
-                                    "residues_backbone": {
-                                        "type": "string",
-                                        "description": "Residues that specify how to build the backbone, enclosed in square brackets.  If there are multiple residues, they should be separated by /.  Examples are: [A20-30] which has one residue, [20-30/157-163] which has 2 residues, [10-100/A1083-1085/20-40/A1040-1051/25-61/B1180-1080/10-10] which has 5 residues."
-                                    },
-                                    "number_proteins": {
-                                        "type": "integer",
-                                        "description": "Number of protein designs to generate.",
-                                        "default": "1"
-                                    },
-                                    "guide_scale": {
-                                        "type": "integer",
-                                        "description": "Guide scale for the potentials.",
-                                        "default": "None"
-                                    },
-                                    "substrate_name": {
-                                        "type": "string",
-                                        "description": "Name of the substrate.",
-                                        "default": "None"
-                                    },
-                                    "model_weights": {
-                                        "type": "string",
-                                        "description": "Path to the model weights file.",
-                                        "default": "None"
-                                    },
-                                    "contig_length": {
-                                        "type": "string",
-                                        "description": "Contig length to be used.",
-                                        "default": "None"
-                                    },
-                                    "guiding_potentials": {
-                                        "type": "string",
-                                        "description": "Guiding potentials to be used.",
-                                        "default": "None"
-                                    }
-                                },
-                                "required": ["input_file", "output_dir_and_prefix", "residues_backbone"]
+                }
+            }
+        },
+        {
+            "toolSpec": {
+                "name": "run_rfdiffusion",
+                "description": "Execute the RFdiffusion model to generate protein designs.",
+                "inputSchema": {
+                    "json": {
+                        "type": "object",
+                        "properties": {
+                            "input_file": {
+                                "type": "string",
+                                "description": "Path to the input PDB file."
+                            },
+                            "output_dir_and_prefix": {
+                                "type": "string",
+                                "description": "Output directory and prefix for the results.",
+                                "default": "./work_flow/RFdiffusion_output"
+                            },
+                            "residues_backbone": {
+                                "type": "string",
+                                "description": "Contig that specifies how to build the backbone, enclosed in square brackets, with segments separated by /. A segment starting with a chain letter (e.g. A1083-1085) keeps these residues of the input structure, which must exist in it; a segment without chain letter is built by RFdiffusion, with a length range (20-40) or a fixed length (20); '/0 ' starts a new chain. Examples are: [A20-30], [10-40/A163-181/10-40], [10-100/A1083-1085/20-40/A1040-1051/25-61/10-10]."
+                            },
+                            "number_proteins": {
+                                "type": "integer",
+                                "description": "Number of protein designs to generate.",
+                                "default": "1"
+                            },
+                            "guide_scale": {
+                                "type": "integer",
+                                "description": "Guide scale for the potentials.",
+                                "default": "None"
+                            },
+                            "substrate_name": {
+                                "type": "string",
+                                "description": "Name of the substrate.",
+                                "default": "None"
+                            },
+                            "model_weights": {
+                                "type": "string",
+                                "description": "Path to the model weights file.",
+                                "default": "None"
+                            },
+                            "contig_length": {
+                                "type": "string",
+                                "description": "Contig length to be used.",
+                                "default": "None"
+                            },
+                            "guiding_potentials": {
+                                "type": "string",
+                                "description": "Guiding potentials to be used.",
+                                "default": "None"
+                            }
+                        },
+                        "required": ["input_file", "output_dir_and_prefix", "residues_backbone"]
+                    }
+                }
+            }
+        },
+        {
+            "toolSpec": {
+                "name": "job_status",
+                "description": "Show the status (running, done or failed) and run time of the background jobs started by the other tools. Long tools such as run_rfdiffusion return a job ID instead of their result when they take more than a few seconds.",
+                "inputSchema": {
+                    "json": {
+                        "type": "object",
+                        "properties": {
+                            "job_id": {
+                                "type": "string",
+                                "description": "ID of the job, e.g. job-1. Leave it out to list all the jobs."
                             }
                         }
                     }
                 }
-            ]
+            }
+        },
+        {
+            "toolSpec": {
+                "name": "job_result",
+                "description": "Get the result of a background job, optionally waiting for it to finish.",
+                "inputSchema": {
+                    "json": {
+                        "type": "object",
+                        "properties": {
+                            "job_id": {
+                                "type": "string",
+                                "description": "ID of the job, e.g. job-1."
+                            },
+                            "wait_seconds": {
+                                "type": "integer",
+                                "description": "How long to wait for the job to finish.",
+                                "default": "0"
+                            }
+                        },
+                        "required": ["job_id"]
+                    }
+                }
+            }
         }
-
-        while True:
-            user_input = input("User message to chatbot: ")
-            if user_input.lower() in ["quit","leave chat"]:
-                print("Goodbye!")
-                break
-
-            messages.append({
+    ]
+}
+
+# Tool calls that take longer than this many seconds are answered with a job ID,
+# the model (or the user) follows them with the job_status and job_result tools
+TOOL_WAIT_SECONDS = 10
+
+# Tools without side effects (or idempotent ones), started as soon as their required
+# arguments have been streamed, before the model finishes its message
+SPECULATIVE_TOOLS = {'download_pdb', 'list_previous_results', 'top_designs'}
+
+class JobManager:
+    """
+    Runs the tool calls as background jobs on worker threads, so a long RFdiffusion run
+    does not freeze the conversation and several tool calls can run at the same time.
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self._tasks = {}
+        self._ids = itertools.count(1)
+        # toolUseId -> (job ID, input) of the tool calls started while streaming
+        self._speculative = {}
+
+    def submit(self, tool_name, tool_input):
+        """Start the tool call in the background and return its job ID right away."""
+        job_id = f"job-{next(self._ids)}"
+        self.jobs[job_id] = {
+            'job_id': job_id, 'tool': tool_name, 'input': tool_input, 'status': 'running',
+            'result': None, 'submitted': time.time(), 'finished': None, 'reported': False
+        }
+        self._tasks[job_id] = asyncio.get_running_loop().create_task(self._run(self.jobs[job_id]))
+        return job_id
+
+    def speculate(self, tool_use):
+        """Start a tool call of SPECULATIVE_TOOLS whose input may still be incomplete."""
+        if tool_use['name'] in SPECULATIVE_TOOLS:
+            job_id = self.submit(tool_use['name'], tool_use['input'])
+            self._speculative[tool_use['toolUseId']] = (job_id, tool_use['input'])
+
+    def take_speculative(self, tool_use):
+        """Job ID of the speculative run of the tool call, if it was started with its final input."""
+        job_id, tool_input = self._speculative.pop(tool_use['toolUseId'], (None, None))
+        if job_id is not None and tool_input != tool_use['input']:
+            # Optional arguments came after the required ones, the speculative run is not used
+            self.jobs[job_id]['reported'] = True
+            return None
+        return job_id
+
+    async def _run(self, job):
+        try:
+            job['result'] = await asyncio.to_thread(process_tool_use, job['tool'], job['input'])
+            job['status'] = 'done'
+        except Exception as err:
+            job['result'] = str(err)
+            job['status'] = 'failed'
+        job['finished'] = time.time()
+        print(f"\n[{job['job_id']} {job['tool']} {job['status']}]")
+
+    def get(self, job_id):
+        if job_id not in self.jobs:
+            raise ValueError(f"Unknown job {job_id}, the jobs are: {', '.join(self.jobs) or 'none'}")
+        return self.jobs[job_id]
+
+    async def wait(self, job_id, timeout=None):
+        """Wait at most timeout seconds for the job to finish, and return it."""
+        job = self.get(job_id)
+        try:
+            # shield: a timeout stops the waiting, not the job
+            await asyncio.wait_for(asyncio.shield(self._tasks[job_id]), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return job
+
+    def status(self, job_id=None):
+        jobs = [self.get(job_id)] if job_id else list(self.jobs.values())
+        if not jobs:
+            return "No background jobs."
+        lines = []
+        for job in jobs:
+            elapsed = (job['finished'] or time.time()) - job['submitted']
+            lines.append(f"{job['job_id']}: {job['tool']} {job['status']} ({elapsed / 60:.1f} minutes)")
+        return "\n".join(lines)
+
+    def running(self):
+        return [job for job in self.jobs.values() if job['status'] == 'running']
+
+    def pop_finished(self):
+        """Results of the finished jobs that were not reported to the model yet."""
+        notes = []
+        for job in self.jobs.values():
+            if job['status'] != 'running' and not job['reported']:
+                job['reported'] = True
+                notes.append(f"Background job {job['job_id']} ({job['tool']}) {job['status']}: {job['result']}")
+        return "\n".join(notes)
+
+async def run_tool_call(manager, tool):
+    """Answer one toolUse block, returns its toolResult."""
+    tool_input = tool['input']
+    try:
+        if tool['name'] == 'job_status':
+            job = None
+            text = manager.status(tool_input.get('job_id'))
+        elif tool['name'] == 'job_result':
+            job = await manager.wait(tool_input['job_id'], float(tool_input.get('wait_seconds') or 0))
+        else:
+            job_id = manager.take_speculative(tool) or manager.submit(tool['name'], tool_input)
+            job = await manager.wait(job_id, TOOL_WAIT_SECONDS)
+
+        failed = False
+        if job is not None and job['status'] == 'running':
+            text = (f"{job['tool']} is running in the background as job {job['job_id']}. "
+                    f"Use job_status or job_result with this ID to follow it.")
+        elif job is not None:
+            job['reported'] = True
+            text, failed = job['result'], job['status'] == 'failed'
+    except Exception as err:
+        text, failed = str(err), True
+
+    tool_result = {"toolUseId": tool['toolUseId'], "content": [{"text": text}]}
+    if failed:
+        tool_result['status'] = 'error'
+    return tool_result
+
+async def chat(bedrock_client, model_id, read_input, manager=None, tool_config=TOOL_CONFIG, context=None):
+    """
+    Conversation loop, read_input is an async function returning the next user message.
+    The toolUse blocks of one message run concurrently and all their results are sent back
+    in one request. Only a bounded window of the conversation is sent to the model (see
+    chat_context.py). Returns the ConversationContext with the messages and request metrics.
+    """
+    manager = manager or JobManager()
+    context = context or ConversationContext()
+
+    loop = asyncio.get_running_loop()
+
+    def on_tool_ready(tool_use):
+        # Called from the streaming thread, the jobs are started on the event loop
+        loop.call_soon_threadsafe(manager.speculate, tool_use)
+
+    async def request():
+        sent = context.window()
+        metadata = {}
+        tic = time.time()
+        stop_reason, message = await asyncio.to_thread(stream_messages, bedrock_client, model_id, sent,
+                                                       tool_config, metadata, on_tool_ready)
+        context.append(message)
+        metrics = context.record_request(sent, time.time() - tic, metadata.get('usage'))
+        logger.info("Request %d: %.1f s, %d messages (~%d tokens) sent, %s output tokens",
+                    metrics['request'], metrics['latency'], metrics['messages_sent'],
+                    metrics['tokens_sent_estimate'], metrics['output_tokens'])
+        return stop_reason, message
+
+    while True:
+        user_input = await read_input("User message to chatbot: ")
+        if user_input.lower() in ["quit","leave chat"]:
+            print("Goodbye!")
+            break
+
+        content = [{"text": user_input}]
+        # Tell the model about the background jobs that finished in the meantime
+        notes = manager.pop_finished()
+        if notes:
+            content.append({"text": notes})
+        context.append({"role": "user", "content": content})
+
+        stop_reason, message = await request()
+
+        while stop_reason == "tool_use":
+            tools = [content['toolUse'] for content in message['content'] if 'toolUse' in content]
+            tool_results = await asyncio.gather(*(run_tool_call(manager, tool) for tool in tools))
+            context.append({
                 "role": "user",
-                "content": [{"text": user_input}]
+                "content": [{"toolResult": tool_result} for tool_result in tool_results]
             })
 
-            stop_reason, message = stream_messages(bedrock_client, model_id, messages, tool_config)
-            messages.append(message)
-
-            if stop_reason == "tool_use":
-                for content in message['content']:
-                    if 'toolUse' in content:
-                        tool = content['toolUse']
-                        tool_name = tool['name']
-                        tool_input = tool['input']
-                        try:
-                            result = process_tool_use(tool_name, tool_input)
-                            tool_result = {
-                                "toolUseId": tool['toolUseId'],
-                                "content": [{"text": result}]
-                            }
-                        except Exception as err:
-                            tool_result = {
-                                "toolUseId": tool['toolUseId'],
-                                "content": [{"text": str(err)}],
-                                "status": 'error'
-                            }
+            stop_reason, message = await request()
 
-                        tool_result_message = {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "toolResult": tool_result
-                                }
-                            ]
-                        }
-                        messages.append(tool_result_message)
+    print(context.stats())
+    if manager.running():
+        print(f"Waiting for {len(manager.running())} background jobs to finish...")
+    return context
+
+def main():
+    # boto3 is imported here, so the other commands and the tools of this module start without it
+    import boto3
+    from botocore.exceptions import ClientError
 
-                        stop_reason, message = stream_messages(bedrock_client, model_id, messages, tool_config)
-                        messages.append(message)
+    setup_folder(os.getcwd())
+    setup_index(os.getcwd())
+
+    model_id = "anthropic.claude-3-haiku-20240307-v1:0"
+
+    try:
+        bedrock_client = boto3.client(service_name='bedrock-runtime')
+        # input() runs on a thread, so the background jobs keep running while the user types
+        asyncio.run(chat(bedrock_client, model_id, lambda prompt: asyncio.to_thread(input, prompt)))
 
     except ClientError as err:
         message = err.response['Error']['Message']
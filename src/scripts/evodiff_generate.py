@@ -0,0 +1,138 @@
+# EvoDiff motif scaffolding, run by the pipeline as the 'evodiff' tool (see stage_evodiff)
+# Sequence-first route of notebooks/evodiff.ipynb: the motif residues of the contig are taken
+# from the native structure, every generated segment gets a length drawn from its range, and
+# the order-agnostic EvoDiff model (OA_DM) fills the masked positions one at a time in a
+# random order. There is no backbone: the sequences are folded by OmegaFold afterwards.
+#
+# Every record of the output FASTA carries its layout, the contig with the lengths that were
+# drawn, e.g. ">7SH6_evodiff_0, layout=[12-12/A157-163/31-31], seed=0", from which the motif
+# positions of the design are known (Contig.motif_mapping).
+#
+# torch and evodiff are only imported to generate (pip install evodiff), the layout helpers
+# are also used by the stand-in of stub_tools.py.
+#
+# Usage:
+#   python evodiff_generate.py --pdb_path work_flow/native_proteins/7SH6.pdb --contig "[10-40/A163-181/10-40]" \
+#       --num_seqs 8 --out_file 7SH6_evodiff.fa --prefix 7SH6_evodiff
+import argparse
+import os
+import random
+
+from contigs import ChainBreak, Contig, ContigError, GeneratedSegment, MotifSegment, parse_contig
+
+MODELS = ['oa_dm_38m', 'oa_dm_640m']
+DEFAULT_MODEL = 'oa_dm_38m'
+
+THREE_TO_ONE = {
+    'ALA': 'A', 'CYS': 'C', 'ASP': 'D', 'GLU': 'E', 'PHE': 'F', 'GLY': 'G', 'HIS': 'H', 'ILE': 'I',
+    'LYS': 'K', 'LEU': 'L', 'MET': 'M', 'ASN': 'N', 'PRO': 'P', 'GLN': 'Q', 'ARG': 'R', 'SER': 'S',
+    'THR': 'T', 'VAL': 'V', 'TRP': 'W', 'TYR': 'Y', 'MSE': 'M',
+}
+
+
+def motif_sequence(pdb_path, contig):
+    """One-letter code of every motif residue of the contig in the native structure, by (chain, number)."""
+    residues = {}
+    with open(pdb_path) as f:
+        for line in f:
+            if line.startswith('ENDMDL'):
+                break
+            if line.startswith(('ATOM', 'HETATM')) and line[12:16].strip() == 'CA':
+                residues.setdefault((line[21], int(line[22:26])), THREE_TO_ONE.get(line[17:20], 'X'))
+    missing = [f"{chain}{number}" for chain, number in contig.motif_residues() if (chain, number) not in residues]
+    if missing:
+        raise ContigError(f"Motif residues {', '.join(missing)} are not in {pdb_path}")
+    return {residue: residues[residue] for residue in contig.motif_residues()}
+
+
+def scaffold_layout(contig, rng):
+    """The contig with a length drawn for every generated segment, e.g. [12-12/A157-163/31-31]."""
+    segments = []
+    for segment in contig.segments:
+        if isinstance(segment, ChainBreak):
+            raise ContigError(f"{contig.text}: EvoDiff generates a single chain, chain breaks are not supported")
+        if isinstance(segment, GeneratedSegment):
+            length = rng.randint(segment.min_length, segment.max_length)
+            segment = GeneratedSegment(length, length)
+        segments.append(segment)
+    return Contig(segments)
+
+
+def template(layout, motif):
+    """Sequence of the layout with the motif residues in place and None at the generated positions."""
+    sequence = []
+    for segment in layout.segments:
+        if isinstance(segment, MotifSegment):
+            sequence += [motif[residue] for residue in segment.residues()]
+        else:
+            sequence += [None] * segment.min_length
+    return sequence
+
+
+def format_record(name, sequence, layout, seed):
+    return f">{name}, layout={layout}, seed={seed}\n{sequence}\n"
+
+
+def load_model(model_name, device):
+    import evodiff.pretrained
+
+    model, _, tokenizer, _ = getattr(evodiff.pretrained, model_name.upper())()
+    return model.to(device).eval(), tokenizer
+
+
+def fill_template(model, tokenizer, positions, device, seed):
+    """Unmask the None positions of a template one at a time in random order, as in EvoDiff's generate_scaffold."""
+    import numpy as np
+    import torch
+
+    torch.manual_seed(seed)
+    mask = tokenizer.alphabet[tokenizer.mask_id]
+    tokens = tokenizer.tokenize((''.join(aa or mask for aa in positions),))
+    sample = torch.tensor(np.asarray(tokens), dtype=torch.long, device=device).unsqueeze(0)
+    order = [i for i, aa in enumerate(positions) if aa is None]
+    random.Random(seed).shuffle(order)
+    # Only the 20 standard amino acids are sampled (the last 6 of all_aas are non-standard)
+    standard = len(tokenizer.all_aas) - 6
+    with torch.no_grad():
+        for i in order:
+            prediction = model(sample, torch.zeros(1, dtype=torch.long, device=device))
+            probabilities = torch.nn.functional.softmax(prediction[:, i, :standard], dim=1)
+            sample[:, i] = torch.multinomial(probabilities, num_samples=1).squeeze()
+    return tokenizer.untokenize(sample[0].cpu())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate motif-scaffolding sequences with EvoDiff")
+    parser.add_argument('--pdb_path', required=True, help="Native structure holding the motif")
+    parser.add_argument('--contig', required=True, help="RFdiffusion-style contig, e.g. [10-40/A163-181/10-40]")
+    parser.add_argument('--num_seqs', type=int, default=1)
+    parser.add_argument('--out_file', required=True, help="FASTA file of the sequences")
+    parser.add_argument('--prefix', default=None, help="Record names are <prefix>_<n> (default: out_file name)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--model', choices=MODELS, default=DEFAULT_MODEL)
+    parser.add_argument('--device', default=None, help="cuda or cpu (default: cuda if available)")
+    args = parser.parse_args()
+
+    contig = parse_contig(args.contig)
+    motif = motif_sequence(args.pdb_path, contig)
+    prefix = args.prefix or os.path.splitext(os.path.basename(args.out_file))[0]
+
+    import torch
+    device = args.device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    model, tokenizer = load_model(args.model, device)
+
+    records = []
+    for n in range(args.num_seqs):
+        seed = args.seed + n
+        layout = scaffold_layout(contig, random.Random(seed))
+        sequence = fill_template(model, tokenizer, template(layout, motif), device, seed)
+        print(f"{prefix}_{n}: {len(sequence)} residues, layout {layout}")
+        records.append(format_record(f"{prefix}_{n}", sequence, layout, seed))
+
+    os.makedirs(os.path.dirname(args.out_file) or '.', exist_ok=True)
+    with open(args.out_file, 'w') as f:
+        f.writelines(records)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# Import time of the pipeline modules and startup time of the commands
+# Every module is imported in a fresh interpreter with python -X importtime, which gives the
+# cumulative import time of the module and the list of everything it loaded. The modules of
+# LIGHT_MODULES must not load any of HEAVY_MODULES (numpy, requests, boto3, ...) at import:
+# those are imported by the functions that need them. The startup time of every command of
+# COMMANDS is the wall time of the whole process, interpreter start included (the time of an
+# empty interpreter is printed for reference).
+#
+# Usage:
+#   python import_benchmark.py
+#   python import_benchmark.py --repeat 10 --output imports.json
+#   python import_benchmark.py --max-ms 150     # exit code 1 if a light module imports a heavy one,
+#                                               # or a command takes more than 150 ms to start (CI)
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Modules measured, and the ones that must import no heavy dependency
+MODULES = ['pipeline_config', 'pipeline_cli', 'rfdiffusion_pipeline', 'stages', 'evodiff_generate', 'batch_pipeline',
+           'sweep', 'sharded_run', 'pdb_fetch', 'dynamic_chatbot_RFdiffusion', 'structural_scoring', 'design_filters']
+LIGHT_MODULES = ['pipeline_config', 'pipeline_cli', 'rfdiffusion_pipeline', 'stages', 'evodiff_generate',
+                 'batch_pipeline', 'sweep', 'sharded_run', 'pdb_fetch', 'dynamic_chatbot_RFdiffusion']
+HEAVY_MODULES = ['numpy', 'requests', 'urllib3', 'boto3', 'botocore', 'torch']
+
+# Command lines of pipeline_cli.py whose startup is measured
+COMMANDS = [
+    ['status', '--help'],
+    ['status', '--root-dir', '{tmp}'],
+    ['config'],
+    ['run', '--help'],
+    ['batch', '--help'],
+    ['score', '--help'],
+    ['results', '--store', '{tmp}/results.sqlite', 'targets'],
+]
+
+
+def _env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = SCRIPTS_DIR + os.pathsep + env.get('PYTHONPATH', '')
+    return env
+
+
+def import_profile(module):
+    """Cumulative import time (ms) of a module and the top-level packages it loaded, from -X importtime."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+                            capture_output=True, text=True, env=_env(), cwd=SCRIPTS_DIR)
+    if result.returncode != 0:
+        # Missing optional dependency, e.g. numpy for structural_scoring
+        return {'error': result.stderr.strip().splitlines()[-1]}
+
+    cumulative, loaded = None, set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        loaded.add(name.split('.')[0])
+        if name == module:
+            cumulative = int(cumulative_us) / 1000
+    return {'import_ms': cumulative, 'heavy': sorted(loaded & set(HEAVY_MODULES))}
+
+
+def startup_time(argv, repeat):
+    """Best wall time (ms) of a process over repeat runs, and its return code."""
+    best, returncode = None, None
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        result = subprocess.run(argv, capture_output=True, env=_env(), cwd=SCRIPTS_DIR)
+        elapsed = (time.perf_counter() - tic) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+        returncode = result.returncode
+    return best, returncode
+
+
+def run_benchmark(repeat=5, modules=MODULES, commands=COMMANDS):
+    import tempfile
+
+    results = {'modules': {}, 'commands': {}}
+    for module in modules:
+        # The best of the runs, the first one pays for the .pyc files and the disk cache
+        profiles = [import_profile(module) for _ in range(repeat)]
+        timed = [profile for profile in profiles if profile.get('import_ms') is not None]
+        results['modules'][module] = min(timed, key=lambda profile: profile['import_ms']) if timed else profiles[0]
+
+    results['interpreter_ms'] = startup_time([sys.executable, '-c', 'pass'], repeat)[0]
+    with tempfile.TemporaryDirectory() as tmp:
+        for command in commands:
+            argv = [argument.format(tmp=tmp) for argument in command]
+            ms, returncode = startup_time([sys.executable, os.path.join(SCRIPTS_DIR, 'pipeline_cli.py')] + argv, repeat)
+            results['commands'][' '.join(command)] = {'startup_ms': ms, 'returncode': returncode}
+    return results
+
+
+def check(results, max_ms=None):
+    """Problems found in the results: heavy imports of light modules, slow commands."""
+    problems = []
+    for module in LIGHT_MODULES:
+        heavy = results['modules'].get(module, {}).get('heavy')
+        if heavy:
+            problems.append(f"{module} imports {', '.join(heavy)}")
+    if max_ms is not None:
+        for command, stats in results['commands'].items():
+            if stats['startup_ms'] > max_ms:
+                problems.append(f"'{command}' takes {stats['startup_ms']:.0f} ms to start, more than {max_ms:.0f} ms")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time of the pipeline modules and startup time of the commands")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per module and command, the best is kept")
+    parser.add_argument('--max-ms', type=float, default=None, help="Largest allowed startup time of a command")
+    parser.add_argument('--output', default=None, help="JSON file to write the results to")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.repeat)
+    print(f"{'module':<30}{'import':>10}  heavy dependencies")
+    for module, profile in results['modules'].items():
+        if 'error' in profile:
+            print(f"{module:<30}{'-':>10}  not importable: {profile['error']}")
+        else:
+            print(f"{module:<30}{profile['import_ms']:>7.1f} ms  {', '.join(profile['heavy']) or '-'}")
+    print(f"\nEmpty interpreter: {results['interpreter_ms']:.0f} ms")
+    print(f"{'command':<30}{'startup':>10}")
+    for command, stats in results['commands'].items():
+        print(f"{command:<30}{stats['startup_ms']:>7.0f} ms" + (f"  (exit code {stats['returncode']})"
+                                                                 if stats['returncode'] else ""))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    problems = check(results, args.max_ms)
+    for problem in problems:
+        print(f"Problem: {problem}")
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
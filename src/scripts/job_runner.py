@@ -0,0 +1,189 @@
+# Managed runner for the external tools (RFdiffusion, ProteinMPNN, OmegaFold, ...)
+# Commands are run from argument lists without a shell, their stdout/stderr are streamed to
+# per-job log files, and every job returns a JobResult with its exit status, wall time,
+# CPU time and peak memory. launch_job does not block, so several jobs can be in flight.
+import contextlib
+import itertools
+import os
+import shlex
+import signal
+import subprocess
+import threading
+import time
+from dataclasses import dataclass, field
+
+DEFAULT_LOG_DIR = './work_flow/logs'
+
+_job_numbers = itertools.count()
+
+# Extra environment of the jobs launched by the current thread, see job_env
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def job_env(env):
+    """
+    Add env to the environment of the jobs launched by the current thread inside the block,
+    e.g. the CUDA_VISIBLE_DEVICES of the GPU given to the stage by the scheduler.
+    """
+    previous = getattr(_local, 'env', {})
+    _local.env = {**previous, **env}
+    try:
+        yield
+    finally:
+        _local.env = previous
+
+
+def current_job_env():
+    """The environment set with job_env for the jobs of the current thread."""
+    return dict(getattr(_local, 'env', {}))
+
+
+@dataclass
+class JobResult:
+    args: list
+    returncode: int
+    wall_time: float
+    user_time: float
+    system_time: float
+    peak_rss_mb: float
+    stdout_log: str
+    stderr_log: str
+    timed_out: bool = False
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+
+class JobError(RuntimeError):
+    """A job exited with a non-zero status or was killed after its timeout."""
+
+    def __init__(self, name, result):
+        self.result = result
+        if result.timed_out:
+            reason = f"timed out after {result.wall_time:.0f} s"
+        else:
+            reason = f"failed with exit code {result.returncode}"
+        super().__init__(f"{name} {reason}, see {result.stderr_log}")
+
+
+@dataclass
+class JobHandle:
+    """A running job, returned by launch_job."""
+    name: str
+    args: list
+    process: subprocess.Popen
+    stdout_log: str
+    stderr_log: str
+    start_time: float
+    _result: JobResult = None
+    _done: threading.Event = field(default_factory=threading.Event)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+    _timed_out: bool = False
+    _timer: threading.Timer = None
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the job to finish and return its JobResult (None if timeout expires first)."""
+        if not self._done.wait(timeout):
+            return None
+        return self._result
+
+    def kill(self):
+        """Kill the job and the processes it started."""
+        with self._lock:
+            if self._done.is_set():
+                return
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def _on_timeout(self):
+        with self._lock:
+            if not self._done.is_set():
+                self._timed_out = True
+        self.kill()
+
+    def _watch(self):
+        # Wait for the exit without reaping, so kill() can not hit a reused pid,
+        # then reap the process with wait4 to get the resource usage of this job only
+        os.waitid(os.P_PID, self.process.pid, os.WEXITED | os.WNOWAIT)
+        wall_time = time.time() - self.start_time
+        with self._lock:
+            _, status, usage = os.wait4(self.process.pid, 0)
+            self.process.returncode = os.waitstatus_to_exitcode(status)
+            self._result = JobResult(
+                args=self.args,
+                returncode=self.process.returncode,
+                wall_time=wall_time,
+                user_time=usage.ru_utime,
+                system_time=usage.ru_stime,
+                peak_rss_mb=usage.ru_maxrss / 1024,  # ru_maxrss is in KB on Linux
+                stdout_log=self.stdout_log,
+                stderr_log=self.stderr_log,
+                timed_out=self._timed_out
+            )
+            self._done.set()
+        if self._timer is not None:
+            self._timer.cancel()
+
+
+def new_log_paths(name, log_dir=DEFAULT_LOG_DIR):
+    """Paths of the stdout and stderr log files of a new job."""
+    os.makedirs(log_dir, exist_ok=True)
+    log_prefix = os.path.join(log_dir, f"{name}_{time.strftime('%Y%m%d-%H%M%S')}_{next(_job_numbers)}")
+    return log_prefix + '.out', log_prefix + '.err'
+
+
+def launch_job(args, name=None, timeout=None, env=None, cwd=None, log_dir=DEFAULT_LOG_DIR):
+    """
+    Start args (a list, run without a shell) and return a JobHandle right away.
+    stdout and stderr go to <log_dir>/<name>_<n>.out and .err.
+    The job and its children are killed after timeout seconds.
+    env is merged into the current environment (and the one set with job_env).
+    """
+    args = [str(arg) for arg in args]
+    env = {**getattr(_local, 'env', {}), **(env or {})}
+    name = name or os.path.basename(args[0])
+    stdout_log, stderr_log = new_log_paths(name, log_dir)
+
+    with open(stdout_log, 'wb') as stdout, open(stderr_log, 'wb') as stderr:
+        start_time = time.time()
+        # A new session makes the job a process group, so kill() also stops its children
+        process = subprocess.Popen(args, stdout=stdout, stderr=stderr, stdin=subprocess.DEVNULL,
+                                   env={**os.environ, **env} if env else None, cwd=cwd,
+                                   start_new_session=True)
+
+    handle = JobHandle(name, args, process, stdout_log, stderr_log, start_time)
+    if timeout is not None:
+        handle._timer = threading.Timer(timeout, handle._on_timeout)
+        handle._timer.daemon = True
+        handle._timer.start()
+
+    watcher = threading.Thread(target=handle._watch, name=f"watch-{name}", daemon=True)
+    watcher.start()
+
+    return handle
+
+
+def run_job(args, name=None, timeout=None, env=None, cwd=None, log_dir=DEFAULT_LOG_DIR, check=True):
+    """
+    Run args until it finishes and return its JobResult.
+    With check=True a JobError is raised if the job failed or timed out.
+    """
+    name = name or os.path.basename(str(args[0]))
+    print(f"Running {name} with call", shlex.join(str(arg) for arg in args))
+    result = launch_job(args, name, timeout, env, cwd, log_dir).wait()
+    print(f"{name} finished with exit code {result.returncode} in {result.wall_time / 60:.2f} minutes "
+          f"(peak memory {result.peak_rss_mb:.0f} MB), logs in {result.stdout_log}")
+    if check and not result.ok:
+        raise JobError(name, result)
+    return result
@@ -0,0 +1,378 @@
+# Warm model servers for RFdiffusion and ProteinMPNN
+# Every run_rfdiffusion / run_protein_mpnn call normally starts a new Python interpreter that
+# imports torch and loads the model weights again. A model server is a long-lived process that
+# imports torch and reads the checkpoints once and then runs the jobs it receives on a local Unix
+# socket (each job still runs the tool script, on the model the server built for the first job).
+# When a server is running for a tool, run_rfdiffusion and run_protein_mpnn send their jobs to
+# it automatically, and run the tool themselves if the server goes away.
+#
+# With the GPU scheduler (scheduler.py), a job must run on the GPUs of its allocation: the job is
+# sent to the server started for exactly these GPUs (--gpus, one server per GPU), and runs as its
+# own process when there is none. The server refuses jobs for other GPUs and applies the
+# OMP_NUM_THREADS of the allocation to the job.
+#
+# Usage:
+#   python model_server.py rfdiffusion                  # real tool, weights kept in memory
+#   python model_server.py rfdiffusion --gpus 0         # server of GPU 0, for scheduled jobs
+#   python model_server.py protein_mpnn --backend stub  # stand-in worker, no GPU needed
+#   python model_server.py protein_mpnn --stop
+#
+# Protocol: one JSON request per connection, answered by one JSON response.
+#   {"command": "run", "args": [...], "cwd": ..., "stdout_log": ..., "stderr_log": ..., "env": {...}}
+#   -> {"returncode": 0, "wall_time": 1.2, "user_time": 1.0, "system_time": 0.1, "peak_rss_mb": 900}
+#   -> {"refused": "..."} for a job of other GPUs
+#   {"command": "ping"} -> {"tool": ..., "backend": ..., "jobs": n}
+#   {"command": "stop"} -> {"stopping": true}
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import resource
+import runpy
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+
+from job_runner import JobError, JobResult, current_job_env, new_log_paths
+import pipeline_config
+
+DEFAULT_SOCKET_DIR = './work_flow/servers'
+
+# Tools with a Python script the server can run, located with pipeline_config.tool_path
+SERVER_TOOLS = ['protein_mpnn', 'rfdiffusion']
+
+# Network class of each tool, as (module, attribute) looked up by the tool script when it builds the model
+MODEL_CLASSES = {
+    'rfdiffusion': ('rfdiffusion.inference.model_runners', 'RoseTTAFoldModule'),
+    'protein_mpnn': ('protein_mpnn_utils', 'ProteinMPNN'),
+}
+
+
+def socket_path(tool, socket_dir=DEFAULT_SOCKET_DIR, gpus=None):
+    """Socket of the tool's server, of the server of the GPUs gpus (a CUDA_VISIBLE_DEVICES value) if given."""
+    if gpus is None:
+        return os.path.join(socket_dir, f"{tool}.sock")
+    return os.path.join(socket_dir, f"{tool}.gpu{gpus.replace(',', '-')}.sock" if gpus else f"{tool}.cpu.sock")
+
+
+def _request(path, request, timeout=None):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(path)
+        client.sendall(json.dumps(request).encode() + b'\n')
+        with client.makefile('rb') as reader:
+            line = reader.readline()
+    if not line:
+        raise ConnectionError(f"No answer from the server on {path}")
+    return json.loads(line)
+
+
+def server_available(tool, socket_dir=DEFAULT_SOCKET_DIR, gpus=None):
+    """True if a server for the tool (and the GPUs gpus) answers on its socket."""
+    path = socket_path(tool, socket_dir, gpus)
+    if not os.path.exists(path):
+        return False
+    try:
+        _request(path, {'command': 'ping'}, timeout=2)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def run_on_server(tool, args, name=None, timeout=None, socket_dir=DEFAULT_SOCKET_DIR):
+    """
+    Run a job with the arguments of the tool script on the tool's server.
+    Inside a scheduler allocation (job_env), the job goes to the server of the allocated GPUs.
+    Returns None if no such server is running, it refused the job or the connection to it is
+    lost (the caller then starts the tool itself), otherwise the JobResult. Raises JobError if
+    the job failed or did not answer in time (the server can not interrupt a running job, it
+    finishes in the background).
+    """
+    env = current_job_env()
+    gpus = env.get('CUDA_VISIBLE_DEVICES')
+    if not server_available(tool, socket_dir, gpus):
+        return None
+
+    name = name or tool
+    stdout_log, stderr_log = new_log_paths(name)
+    args = [str(arg) for arg in args]
+    print(f"Running {name} on the {tool} server with arguments", ' '.join(args))
+
+    tic = time.time()
+    try:
+        response = _request(socket_path(tool, socket_dir, gpus),
+                            {'command': 'run', 'args': args, 'cwd': os.getcwd(), 'env': env,
+                             'stdout_log': os.path.abspath(stdout_log), 'stderr_log': os.path.abspath(stderr_log)},
+                            timeout=timeout)
+        timed_out = False
+    except socket.timeout:
+        response = {'returncode': -1}
+        timed_out = True
+    except (OSError, ValueError) as err:
+        # The server stopped or crashed since server_available (ConnectionError, missing socket, no answer)
+        print(f"Lost the {tool} server ({err}), running {name} locally")
+        return None
+    if 'refused' in response:
+        print(f"The {tool} server refused {name} ({response['refused']}), running it locally")
+        return None
+
+    result = JobResult(
+        args=[tool] + args,
+        returncode=response['returncode'],
+        wall_time=response.get('wall_time', time.time() - tic),
+        user_time=response.get('user_time', 0.0),
+        system_time=response.get('system_time', 0.0),
+        peak_rss_mb=response.get('peak_rss_mb', 0.0),
+        stdout_log=stdout_log,
+        stderr_log=stderr_log,
+        timed_out=timed_out
+    )
+    print(f"{name} finished on the server with exit code {result.returncode} in {result.wall_time / 60:.2f} minutes")
+    if not result.ok:
+        raise JobError(name, result)
+    return result
+
+
+@contextlib.contextmanager
+def _redirect_output(stdout_log, stderr_log):
+    # Redirect the file descriptors, so output of C extensions ends up in the logs as well
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    with open(stdout_log, 'ab') as stdout, open(stderr_log, 'ab') as stderr:
+        os.dup2(stdout.fileno(), 1)
+        os.dup2(stderr.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+
+
+class InProcessBackend:
+    """
+    Runs the real tool script inside the server process. torch is imported once, and
+    torch.load is memoized, so the model checkpoints are read from disk only once.
+    The script runs again for every job (runpy), but the network it builds is kept: the model
+    class of the tool (MODEL_CLASSES) is replaced by a factory returning the model built by the
+    first job with the same arguments, already on the GPU. The jobs still load the weights into it
+    (load_state_dict, a copy into the existing tensors).
+    """
+
+    concurrency = 1  # One model on the GPU, and jobs change the working directory
+
+    def __init__(self, tool, root_dir):
+        self.script = os.path.abspath(pipeline_config.tool_path(tool, root_dir))
+        if not os.path.exists(self.script):
+            raise ValueError(f"{self.script} does not exist")
+
+        import torch
+        original_load = torch.load
+        checkpoints = {}
+
+        def cached_load(f, *args, **kwargs):
+            if not isinstance(f, (str, os.PathLike)):
+                return original_load(f, *args, **kwargs)
+            key = (os.path.abspath(f), os.stat(f).st_mtime_ns, repr(kwargs.get('map_location')))
+            if key not in checkpoints:
+                print(f"Loading {f} once for all jobs")
+                checkpoints[key] = original_load(f, *args, **kwargs)
+            checkpoint = checkpoints[key]
+            # Shallow copy, so a job replacing entries does not change the cached checkpoint
+            return dict(checkpoint) if isinstance(checkpoint, dict) else checkpoint
+
+        torch.load = cached_load
+        self.threads = torch.get_num_threads()
+        self._keep_models(tool)
+        print(f"torch {torch.__version__} loaded, serving {self.script}")
+
+    def _keep_models(self, tool):
+        # The script imports its modules relative to its folder, like when it runs as its own process
+        sys.path.insert(0, os.path.dirname(self.script))
+        module_name, class_name = MODEL_CLASSES[tool]
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError as e:
+            print(f"Can not import {module_name} ({e}), every job builds its own model")
+            return
+        model_class = getattr(module, class_name)
+        models = {}
+
+        def cached_model(*args, **kwargs):
+            key = (repr(args), repr(sorted(kwargs.items())))
+            if key not in models:
+                print(f"Building {class_name} once for all jobs")
+                models[key] = model_class(*args, **kwargs)
+            return models[key]
+
+        # The scripts look the class up in this module when they run, the module stays imported between jobs
+        setattr(module, class_name, cached_model)
+
+    def run(self, args, cwd, stdout_log, stderr_log, threads=None):
+        import torch
+
+        returncode = 0
+        saved_argv, saved_dir = sys.argv, os.getcwd()
+        sys.argv = [self.script] + args
+        with _redirect_output(stdout_log, stderr_log):
+            try:
+                os.chdir(cwd)
+                # The cores of the job's allocation (OMP_NUM_THREADS is only read when torch starts)
+                torch.set_num_threads(threads or self.threads)
+                runpy.run_path(self.script, run_name='__main__')
+            except SystemExit as exit:
+                returncode = exit.code if isinstance(exit.code, int) else (0 if exit.code is None else 1)
+            except Exception:
+                traceback.print_exc()
+                returncode = 1
+            finally:
+                sys.argv = saved_argv
+                os.chdir(saved_dir)
+                # RFdiffusion is a hydra app, hydra refuses to initialize twice in one process
+                if 'hydra' in sys.modules:
+                    from hydra.core.global_hydra import GlobalHydra
+                    GlobalHydra.instance().clear()
+        return returncode
+
+
+class StubBackend:
+    """Stand-in worker writing the outputs of stub_tools, to test the protocol without a GPU."""
+
+    def __init__(self, tool, load_time=0.0, job_time=0.0, concurrency=1):
+        self.tool = tool
+        self.job_time = job_time
+        self.concurrency = concurrency
+        # Pretend to load the weights
+        time.sleep(load_time)
+
+    def run(self, args, cwd, stdout_log, stderr_log, threads=None):
+        # Test stand-ins, only imported by stub servers
+        import stub_tools
+
+        # Jobs may run concurrently, so the stand-in writes its own logs instead of redirecting output
+        with open(stderr_log, 'w') as stderr:
+            try:
+                stub_tools.TOOLS[self.tool](args, latency=self.job_time, cwd=cwd)
+            except Exception:
+                traceback.print_exc(file=stderr)
+                return 1
+        with open(stdout_log, 'w') as stdout:
+            stdout.write(f"stub {self.tool} {' '.join(args)}\n")
+        return 0
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        server = self.server
+        command = request.get('command')
+
+        if command == 'ping':
+            response = {'tool': server.tool, 'backend': type(server.backend).__name__, 'jobs': server.jobs}
+        elif command == 'stop':
+            response = {'stopping': True}
+        elif command == 'run':
+            response = server.run_job(request)
+        else:
+            response = {'error': f"Unknown command {command}"}
+
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+        self.wfile.flush()
+
+        if command == 'stop':
+            # shutdown() blocks until serve_forever returns, so it is called from another thread
+            threading.Thread(target=server.shutdown).start()
+
+
+class ModelServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, tool, backend, path, gpus=None):
+        self.tool = tool
+        self.backend = backend
+        # CUDA_VISIBLE_DEVICES of the server, None if it was not started for given GPUs
+        self.gpus = gpus
+        self.jobs = 0
+        # Jobs wait here for a free slot of the backend
+        self._slots = threading.Semaphore(backend.concurrency)
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, _Handler)
+
+    def run_job(self, request):
+        env = request.get('env') or {}
+        gpus = env.get('CUDA_VISIBLE_DEVICES')
+        if gpus is not None and gpus != self.gpus:
+            return {'refused': f"job for GPUs '{gpus}', server of GPUs '{self.gpus}'"}
+        threads = int(env['OMP_NUM_THREADS']) if env.get('OMP_NUM_THREADS') else None
+
+        with self._slots:
+            self.jobs += 1
+            tic = time.time()
+            usage_before = resource.getrusage(resource.RUSAGE_SELF)
+            returncode = self.backend.run(request['args'], request['cwd'],
+                                          request['stdout_log'], request['stderr_log'], threads=threads)
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+
+        return {
+            'returncode': returncode,
+            'wall_time': time.time() - tic,
+            'user_time': usage.ru_utime - usage_before.ru_utime,
+            'system_time': usage.ru_stime - usage_before.ru_stime,
+            # Peak of the server process, which holds the model for all the jobs
+            'peak_rss_mb': usage.ru_maxrss / 1024,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Long-lived model server for RFdiffusion or ProteinMPNN")
+    parser.add_argument('tool', choices=SERVER_TOOLS)
+    parser.add_argument('--backend', choices=['inprocess', 'stub'], default='inprocess')
+    parser.add_argument('--root-dir', default=pipeline_config.root_dir(), help="Folder containing the tools and work_flow")
+    parser.add_argument('--socket-dir', default=None, help="Folder of the server sockets (default work_flow/servers)")
+    parser.add_argument('--gpus', default=None,
+                        help="GPUs of the server (CUDA_VISIBLE_DEVICES, e.g. 0), it then runs the scheduled jobs of these GPUs")
+    parser.add_argument('--stop', action='store_true', help="Stop the running server of the tool")
+    parser.add_argument('--load-time', type=float, default=0.0, help="Stub backend: seconds to load the weights")
+    parser.add_argument('--job-time', type=float, default=0.0, help="Stub backend: seconds per design")
+    parser.add_argument('--concurrency', type=int, default=1, help="Stub backend: jobs run at the same time")
+    args = parser.parse_args()
+
+    socket_dir = args.socket_dir or os.path.join(args.root_dir, DEFAULT_SOCKET_DIR)
+    path = socket_path(args.tool, socket_dir, args.gpus)
+
+    if args.stop:
+        print(_request(path, {'command': 'stop'}, timeout=10))
+        return
+
+    if args.gpus is not None:
+        # Before torch is imported by the backend
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpus
+
+    if args.backend == 'stub':
+        backend = StubBackend(args.tool, args.load_time, args.job_time, args.concurrency)
+    else:
+        backend = InProcessBackend(args.tool, args.root_dir)
+
+    os.makedirs(socket_dir, exist_ok=True)
+    server = ModelServer(args.tool, backend, path, args.gpus)
+    print(f"{args.tool} server ({args.backend}) listening on {path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+# Batched OmegaFold folding
+# Folding one sequence per omegafold call reloads the model every time. Here the pending
+# sequences (from any number of targets) are sorted into buckets of similar length, every
+# bucket is written to one multi-record FASTA and folded by a single omegafold call in a staging
+# folder, and the structures are committed to the folders of their designs (see artifact_store.py).
+#
+# Every record is named "{name}_{design}_{sample}" (see stage_omegafold), OmegaFold names the
+# structure after the record, so it ends up in work_flow/designs/{name}/{design}/omegafold/{name}_{design}_{sample}.pdb
+#
+# Usage (fold every ProteinMPNN sequence of the index that has no structure yet):
+#   python omegafold_batch.py --bucket-width 32 --max-records 64
+import argparse
+import hashlib
+import os
+
+import pipeline_config
+from artifact_store import get_store
+from rfdiffusion_pipeline import run_omegafold, read_mpnn_sequences
+from workflow_index import WorkflowIndex
+
+# Bucket limits: sequences in a bucket differ by at most bucket_width residues, and a bucket
+# holds at most max_records sequences and max_residues residues in total
+DEFAULT_BUCKET_WIDTH = 32
+DEFAULT_MAX_RECORDS = 64
+DEFAULT_MAX_RESIDUES = 20000
+
+
+def record_name(record):
+    return f"{record['name']}_{record['design']}_{record['sample']}"
+
+
+def bucket_by_length(records, bucket_width=DEFAULT_BUCKET_WIDTH, max_records=DEFAULT_MAX_RECORDS,
+                     max_residues=DEFAULT_MAX_RESIDUES):
+    """
+    Split records (dicts with name, design, sample and sequence) into lists of records of
+    similar length, shortest first, so that padding inside a bucket stays small.
+    """
+    buckets = []
+    bucket = []
+    residues = 0
+    for record in sorted(records, key=lambda record: len(record['sequence'])):
+        length = len(record['sequence'])
+        if bucket and (length - len(bucket[0]['sequence']) > bucket_width
+                       or len(bucket) >= max_records or residues + length > max_residues):
+            buckets.append(bucket)
+            bucket = []
+            residues = 0
+        bucket.append(record)
+        residues += length
+    if bucket:
+        buckets.append(bucket)
+    return buckets
+
+
+def fold_bucket(bucket, store=None, cache=None, timeout=None):
+    """
+    Fold the records of one bucket with one omegafold call and commit every structure to the
+    artifact store (default: get_store()). Returns the path of the structure of every record, in order.
+    """
+    store = store or get_store()
+    names = [record_name(record) for record in bucket]
+    bucket_id = hashlib.sha1('\n'.join(names).encode()).hexdigest()[:12]
+
+    with store.staging(f"bucket-{bucket_id}", 'omegafold') as staging:
+        fasta_path = os.path.join(staging, f"{bucket_id}.fa")
+        with open(fasta_path, 'w') as f:
+            for name, record in zip(names, bucket):
+                f.write(f">{name}\n{record['sequence']}\n")
+
+        run_omegafold(input_file=fasta_path, output_file=os.path.join(staging, 'output'), cache=cache, timeout=timeout)
+
+        # Demultiplex the structures to the folders of their designs
+        missing = [name for name in names if not os.path.exists(os.path.join(staging, 'output', f"{name}.pdb"))]
+        if missing:
+            raise RuntimeError(f"OmegaFold did not fold {', '.join(missing)} (bucket {bucket_id})")
+        return [store.commit(os.path.join(staging, 'output', f"{name}.pdb"), record['name'], record['design'], 'omegafold')
+                for name, record in zip(names, bucket)]
+
+
+def fold_records(records, bucket_width=DEFAULT_BUCKET_WIDTH, max_records=DEFAULT_MAX_RECORDS,
+                 max_residues=DEFAULT_MAX_RESIDUES, store=None, cache=None, index=None, timeout=None):
+    """
+    Fold records (dicts with name, design, sample and sequence) bucket by bucket.
+    Records whose structure is already recorded in the index are not folded again.
+    Returns two dicts: record name -> path of its structure, and record name -> error message
+    for the records of the buckets that failed (a failed bucket does not stop the others).
+    """
+    folded = {}
+    errors = {}
+    pending = []
+    for record in records:
+        design = f"{record['design']}_{record['sample']}"
+        params = {'sequence': record['sequence']}
+        if index is not None and index.is_complete(record['name'], 'omegafold', design, params=params):
+            folded[record_name(record)] = index.get(record['name'], 'omegafold', design)['path']
+        else:
+            pending.append(record)
+
+    buckets = bucket_by_length(pending, bucket_width, max_records, max_residues)
+    for number, bucket in enumerate(buckets, start=1):
+        lengths = [len(record['sequence']) for record in bucket]
+        print(f"Folding bucket {number}/{len(buckets)}: {len(bucket)} sequences of {min(lengths)}-{max(lengths)} residues")
+        try:
+            paths = fold_bucket(bucket, store, cache, timeout)
+        except Exception as err:
+            for record in bucket:
+                errors[record_name(record)] = str(err)
+            continue
+
+        for record, path in zip(bucket, paths):
+            folded[record_name(record)] = path
+            if index is not None:
+                index.record(record['name'], 'omegafold', path, design=f"{record['design']}_{record['sample']}",
+                             params={'sequence': record['sequence']})
+
+    return folded, errors
+
+
+def pending_records(index):
+    """ProteinMPNN sequences recorded in the index that have no OmegaFold structure yet."""
+    records = []
+    for target in index.targets():
+        for entry in index.lookup(target):
+            if entry['stage'] != 'protein_mpnn' or entry['status'] != 'done' or not entry['path']:
+                continue
+            if not os.path.exists(entry['path']):
+                continue
+            for sequence in read_mpnn_sequences(entry['path']):
+                record = {'name': target, 'design': entry['design'], 'sample': sequence['sample'],
+                          'sequence': sequence['sequence']}
+                design = f"{record['design']}_{record['sample']}"
+                if not index.is_complete(target, 'omegafold', design, params={'sequence': record['sequence']}):
+                    records.append(record)
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fold the pending ProteinMPNN sequences in length buckets")
+    parser.add_argument('--root-dir', default=pipeline_config.root_dir(), help="Folder containing work_flow")
+    parser.add_argument('--bucket-width', type=int, default=DEFAULT_BUCKET_WIDTH,
+                        help="Maximum length difference inside a bucket")
+    parser.add_argument('--max-records', type=int, default=DEFAULT_MAX_RECORDS, help="Maximum sequences per bucket")
+    parser.add_argument('--max-residues', type=int, default=DEFAULT_MAX_RESIDUES, help="Maximum residues per bucket")
+    args = parser.parse_args()
+
+    os.chdir(args.root_dir)
+    index = WorkflowIndex()
+    records = pending_records(index)
+    print(f"{len(records)} sequences to fold")
+
+    folded, errors = fold_records(records, args.bucket_width, args.max_records, args.max_residues, index=index)
+    for name, error in errors.items():
+        print(f"{name} failed: {error}")
+    print(f"{len(folded)} sequences folded")
+
+
+if __name__ == '__main__':
+    main()
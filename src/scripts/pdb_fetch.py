@@ -0,0 +1,242 @@
+# Download of native structures from the RCSB (or a mirror of it)
+# All downloads share one pooled requests.Session with timeouts and retries, the files are
+# transferred gzip-compressed and written uncompressed to work_flow/native_proteins.
+# A structure already on disk is not downloaded again. With revalidate=True the server is asked
+# whether it changed (ETag / Last-Modified kept in a .meta.json file next to it).
+#
+# The base URL is https://files.rcsb.org/download by default. It can be changed with the
+# PDB_BASE_URL environment variable or the base_url argument, to an internal HTTP mirror or a
+# local folder (plain path or file:// URL) holding {CODE}.pdb(.gz) / {CODE}.cif(.gz) files,
+# for air-gapped machines and tests.
+# requests is only imported when the first HTTP download starts, structures already on disk
+# or in a local mirror need none of it.
+#
+# Usage:
+#   python pdb_fetch.py 7SH6 1QYS --workers 8
+#   python pdb_fetch.py 7SH6 --format cif --base-url /data/pdb_mirror
+import argparse
+import gzip
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_BASE_URL = 'https://files.rcsb.org/download'
+DEFAULT_TARGET_DIR = './work_flow/native_proteins'
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRIES = 3
+DEFAULT_WORKERS = 8
+
+FORMATS = {'pdb': '.pdb', 'cif': '.cif'}
+
+
+class PDBFetchError(Exception):
+    pass
+
+
+def _local_dir(base_url):
+    # Folder of a local mirror, or None for an HTTP(S) base URL
+    if base_url.startswith('file://'):
+        return base_url[len('file://'):]
+    if '://' not in base_url:
+        return base_url
+    return None
+
+
+def _maybe_gunzip(data):
+    # Some servers answer the .gz URL with the already decompressed file
+    return gzip.decompress(data) if data[:2] == b'\x1f\x8b' else data
+
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.tmp.{threading.get_ident()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class PDBFetcher:
+    """
+    Downloads structures into target_directory through one pooled session.
+    fmt is 'pdb' or 'cif' (mmCIF, for the large entries without a PDB format file).
+    """
+
+    def __init__(self, base_url=None, target_directory=DEFAULT_TARGET_DIR, fmt='pdb',
+                 timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, pool_size=DEFAULT_WORKERS):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown format {fmt}, expected one of {', '.join(FORMATS)}")
+        self.base_url = (base_url or os.environ.get('PDB_BASE_URL') or DEFAULT_BASE_URL).rstrip('/')
+        self.target_directory = target_directory
+        self.fmt = fmt
+        self.timeout = timeout
+        self.retries = retries
+        self.pool_size = pool_size
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        """The pooled requests.Session, created by the first download."""
+        with self._session_lock:
+            if self._session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+
+                session = requests.Session()
+                # Retry connection errors and the transient answers of an overloaded server, with backoff
+                retry = Retry(total=self.retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                              allowed_methods=['GET'])
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+            return self._session
+
+    def path(self, pdb_code):
+        return os.path.join(self.target_directory, f"{pdb_code.upper()}{FORMATS[self.fmt]}")
+
+    def _meta_path(self, pdb_code):
+        return self.path(pdb_code) + '.meta.json'
+
+    def _read_meta(self, pdb_code):
+        try:
+            with open(self._meta_path(pdb_code)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _fetch_local(self, pdb_code, folder):
+        # Look for the compressed and the plain file, with upper and lower case codes
+        extension = FORMATS[self.fmt]
+        for code in (pdb_code.upper(), pdb_code.lower()):
+            for suffix in (extension + '.gz', extension):
+                source = os.path.join(folder, code + suffix)
+                if os.path.exists(source):
+                    with open(source, 'rb') as f:
+                        return _maybe_gunzip(f.read())
+        raise PDBFetchError(f"{pdb_code.upper()}{extension} not found in the local mirror {folder}")
+
+    def _fetch_http(self, pdb_code, revalidate):
+        # Returns the content, or None if the file on disk is still up to date
+        headers = {}
+        meta = self._read_meta(pdb_code) if revalidate and os.path.exists(self.path(pdb_code)) else {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        import requests
+        url = f"{self.base_url}/{pdb_code.upper()}{FORMATS[self.fmt]}"
+        response = None
+        # Transfer the gzip file, fall back to the plain one if the mirror does not have it
+        for candidate in (url + '.gz', url):
+            try:
+                response = self.session.get(candidate, headers=headers, timeout=self.timeout)
+            except requests.RequestException as err:
+                raise PDBFetchError(f"Failed to download {pdb_code.upper()}: {err}") from err
+            if response.status_code != 404:
+                break
+
+        if response.status_code == 304:
+            return None
+        if response.status_code != 200:
+            raise PDBFetchError(f"Failed to download PDB file {pdb_code.upper()}. Status code: {response.status_code}")
+
+        meta = {'url': response.url, 'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')}
+        _write_atomic(self._meta_path(pdb_code), json.dumps(meta).encode())
+        return _maybe_gunzip(response.content)
+
+    def fetch(self, pdb_code, revalidate=False):
+        """
+        Path of the structure, downloaded if it is not on disk yet (or changed on the server,
+        with revalidate=True). Raises PDBFetchError if it can not be downloaded.
+        """
+        path = self.path(pdb_code)
+        if os.path.exists(path) and not revalidate:
+            return path
+
+        os.makedirs(self.target_directory, exist_ok=True)
+        folder = _local_dir(self.base_url)
+        if folder is not None:
+            data = self._fetch_local(pdb_code, folder)
+        else:
+            data = self._fetch_http(pdb_code, revalidate)
+            if data is None:
+                print(f"PDB file {pdb_code.upper()} is up to date")
+                return path
+
+        _write_atomic(path, data)
+        print(f"PDB file {pdb_code.upper()} downloaded successfully to {path}")
+        return path
+
+    def fetch_many(self, pdb_codes, workers=DEFAULT_WORKERS, revalidate=False):
+        """
+        Download several structures concurrently.
+        Returns a dict mapping every code to its path, or to the PDBFetchError it raised.
+        """
+        codes = list(dict.fromkeys(code.upper() for code in pdb_codes))
+
+        def fetch_one(code):
+            try:
+                return self.fetch(code, revalidate)
+            except PDBFetchError as err:
+                return err
+
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(codes) or 1))) as executor:
+            return dict(zip(codes, executor.map(fetch_one, codes)))
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+
+# Fetchers shared by download_pdb, one per (base URL, folder, format)
+_fetchers = {}
+_fetchers_lock = threading.Lock()
+
+
+def get_fetcher(target_directory=DEFAULT_TARGET_DIR, fmt='pdb', base_url=None):
+    key = (base_url or os.environ.get('PDB_BASE_URL'), os.path.abspath(target_directory), fmt)
+    with _fetchers_lock:
+        if key not in _fetchers:
+            _fetchers[key] = PDBFetcher(base_url, target_directory, fmt)
+        return _fetchers[key]
+
+
+def download_pdb(pdb_code, target_directory=DEFAULT_TARGET_DIR, fmt='pdb', revalidate=False):
+    """Download one structure with the shared session, returns its path."""
+    return get_fetcher(target_directory, fmt).fetch(pdb_code, revalidate)
+
+
+def download_many(pdb_codes, target_directory=DEFAULT_TARGET_DIR, fmt='pdb', workers=DEFAULT_WORKERS,
+                  revalidate=False):
+    """Download several structures concurrently, see PDBFetcher.fetch_many."""
+    return get_fetcher(target_directory, fmt).fetch_many(pdb_codes, workers, revalidate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download structures from the RCSB or a mirror")
+    parser.add_argument('pdb_codes', nargs='+')
+    parser.add_argument('--target-dir', default=DEFAULT_TARGET_DIR)
+    parser.add_argument('--format', choices=sorted(FORMATS), default='pdb')
+    parser.add_argument('--base-url', default=None,
+                        help=f"Server or local folder to download from (default $PDB_BASE_URL or {DEFAULT_BASE_URL})")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--revalidate', action='store_true', help="Ask the server whether files on disk changed")
+    args = parser.parse_args()
+
+    fetcher = PDBFetcher(args.base_url, args.target_dir, args.format, pool_size=args.workers)
+    failed = 0
+    for code, result in fetcher.fetch_many(args.pdb_codes, args.workers, args.revalidate).items():
+        if isinstance(result, PDBFetchError):
+            print(result)
+            failed += 1
+    fetcher.close()
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+# End-to-end benchmark of the pipeline orchestration with stand-in tools
+# Every scenario runs batch_pipeline.run_batch in a fresh folder where RFdiffusion,
+# ProteinMPNN, OmegaFold and TMalign are replaced by the deterministic executables of
+# stub_tools.py (with configurable latencies, none by default). With the tools taking no
+# time, what is measured is the pipeline's own cost: process starts, file handling, index
+# and report bookkeeping, queueing between the stages.
+#
+# For every scenario it reports the designs (folded sequences) per second, the overhead of
+# every stage (stage wall time minus the time spent in its tool, from the run report), and
+# the file-system operations made by the pipeline process (opens, stats, listings, renames,
+# removals, folder creations), per design. Scoring has no tool run unless --tmalign is given,
+# and TMalign is started outside job_runner, so the whole score stage counts as overhead.
+#
+# Usage:
+#   python pipeline_benchmark.py                                    # 1 and 100 designs, short and long contigs
+#   python pipeline_benchmark.py --scenarios all --output bench.json
+#   python pipeline_benchmark.py --latency rfdiffusion=0.2,omegafold=0.1 --fold-batch-size 16
+#   python pipeline_benchmark.py --baseline bench.json --tolerance 0.25   # exit code 1 on a regression (CI)
+#   python pipeline_benchmark.py --scenarios 1-binder --filters default   # two-chain designs must pass the filters
+import argparse
+import collections
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import stub_tools
+from batch_pipeline import run_batch
+from rfdiffusion_pipeline import setup_folder, STAGES
+from run_report import RunReport, load_reports, percentile
+from workflow_index import WorkflowIndex
+
+PDB_CODE = '1BNC'
+NATIVE_LENGTH = 320
+CONTIGS = {
+    'short': '[20-20/A100-110/20-20]',
+    'long': '[120-120/A100-120/150-150]',
+    # Two chains: the motif as chain A and a generated binder as chain B
+    'binder': '[A100-130/0 30-30]',
+}
+# Designs are the folded sequences: targets x backbones per target x sequences per backbone
+SIZES = {
+    '1': (1, 1, 1),
+    '100': (10, 5, 2),
+    '10k': (100, 10, 10),
+}
+DEFAULT_SCENARIOS = ['1-short', '1-long', '100-short', '100-long']
+
+# Audit events (see sys.addaudithook) counted as file-system operations, stat is counted separately
+_FS_EVENTS = {'open': 'open', 'os.listdir': 'listdir', 'os.scandir': 'listdir', 'os.rename': 'rename',
+              'os.replace': 'rename', 'os.remove': 'remove', 'os.unlink': 'remove', 'os.rmdir': 'remove',
+              'os.mkdir': 'mkdir', 'os.utime': 'utime', 'shutil.copyfile': 'copy', 'shutil.move': 'rename'}
+_fs_counts = None
+
+
+def _audit(event, args):
+    if _fs_counts is not None and event in _FS_EVENTS:
+        _fs_counts[_FS_EVENTS[event]] += 1
+
+
+@contextlib.contextmanager
+def count_fs_ops():
+    """Count the file-system operations of this process inside the block, yields the Counter."""
+    global _fs_counts
+    if not getattr(count_fs_ops, 'installed', False):
+        # Audit hooks can not be removed, one hook counts for every block
+        sys.addaudithook(_audit)
+        count_fs_ops.installed = True
+    counts = collections.Counter()
+    stat = os.stat
+
+    def counted_stat(*args, **kwargs):
+        counts['stat'] += 1
+        return stat(*args, **kwargs)
+
+    _fs_counts = counts
+    # os.path.exists, getsize, ... call os.stat, which raises no audit event
+    os.stat = counted_stat
+    try:
+        yield counts
+    finally:
+        os.stat = stat
+        _fs_counts = None
+
+
+def scenario_targets(size, contig):
+    targets, number_proteins, num_seq_per_target = SIZES[size]
+    return [{'pdb_code': PDB_CODE, 'contig': CONTIGS[contig], 'name': f"bench_{i:04d}",
+             'number_proteins': number_proteins, 'num_seq_per_target': num_seq_per_target}
+            for i in range(targets)]
+
+
+def run_scenario(name, root_dir, latencies=None, fold_batch_size=1, use_tmalign=False, workers=None, filters=None):
+    """
+    Run one scenario ('<size>-<contig>') in a fresh folder under root_dir, returns its metrics.
+    filters is a JSON file of design_filters thresholds or 'default', None runs without filters.
+    """
+    size, contig = name.split('-')
+    scenario_dir = os.path.join(root_dir, name)
+    shutil.rmtree(scenario_dir, ignore_errors=True)
+    os.makedirs(scenario_dir)
+    previous_dir, previous_path = os.getcwd(), os.environ.get('PATH', '')
+
+    os.chdir(scenario_dir)
+    try:
+        with open('pipeline.log', 'w') as log, contextlib.redirect_stdout(log):
+            setup_folder(scenario_dir)
+            bin_dir = stub_tools.install_stubs(scenario_dir, latencies)
+            os.environ['PATH'] = bin_dir + os.pathsep + previous_path
+            # The native structure is on disk, so nothing is downloaded
+            stub_tools.write_backbone(f"./work_flow/native_proteins/{PDB_CODE}.pdb", NATIVE_LENGTH,
+                                      stub_tools._rng('native'))
+
+            targets = scenario_targets(size, contig)
+            design_filters = None
+            if filters is not None:
+                from design_filters import load_filters
+                design_filters = load_filters(filters)
+            report = RunReport('./work_flow/reports/benchmark.jsonl')
+            tic = time.perf_counter()
+            with count_fs_ops() as fs_ops:
+                results = run_batch(targets, workers=workers, index=WorkflowIndex(), use_tmalign=use_tmalign,
+                                    fold_batch_size=fold_batch_size, fold_batch_wait=0.2, report=report,
+                                    filters=design_filters)
+            elapsed = time.perf_counter() - tic
+        # The report is only created by the first record: no file if every target failed early
+        records = load_reports([report.path]) if os.path.exists(report.path) else []
+    finally:
+        os.chdir(previous_dir)
+        os.environ['PATH'] = previous_path
+
+    done = sum(1 for result in results if result['status'] == 'done')
+    stages = {}
+    for stage in STAGES:
+        stage_records = [record for record in records if record['stage'] == stage and record['status'] == 'done']
+        if not stage_records:
+            continue
+        overheads = [record['wall_time'] - record.get('job_wall_time', 0.0) for record in stage_records]
+        stages[stage] = {
+            'runs': len(stage_records),
+            'wall_p50_ms': percentile([record['wall_time'] for record in stage_records], 50) * 1000,
+            'tool_p50_ms': percentile([record.get('job_wall_time', 0.0) for record in stage_records], 50) * 1000,
+            'overhead_p50_ms': percentile(overheads, 50) * 1000,
+            'overhead_p95_ms': percentile(overheads, 95) * 1000,
+        }
+    return {
+        'designs': len(results),
+        'done': done,
+        'rejected': sum(1 for result in results if result['status'] == 'rejected'),
+        'elapsed_s': elapsed,
+        'designs_per_s': done / elapsed if elapsed else 0.0,
+        'fs_ops': dict(fs_ops),
+        'fs_ops_per_design': sum(fs_ops.values()) / max(len(results), 1),
+        'stages': stages,
+    }
+
+
+def compare(metrics, baseline, tolerance):
+    """Regressions of metrics against a baseline (same scenarios), as a list of messages."""
+    regressions = []
+    for name, current in metrics.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if current['designs_per_s'] < previous['designs_per_s'] * (1 - tolerance):
+            regressions.append(f"{name}: {current['designs_per_s']:.2f} designs/s, "
+                               f"baseline {previous['designs_per_s']:.2f}")
+        if current['fs_ops_per_design'] > previous['fs_ops_per_design'] * (1 + tolerance):
+            regressions.append(f"{name}: {current['fs_ops_per_design']:.0f} file-system ops per design, "
+                               f"baseline {previous['fs_ops_per_design']:.0f}")
+        if current['done'] < previous['done']:
+            regressions.append(f"{name}: {current['done']} designs done, baseline {previous['done']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline orchestration with stand-in tools")
+    parser.add_argument('--scenarios', default=','.join(DEFAULT_SCENARIOS),
+                        help=f"Scenarios <size>-<contig> separated by commas, sizes {', '.join(SIZES)}, "
+                             f"contigs {', '.join(CONTIGS)}, or 'all'")
+    parser.add_argument('--latency', default='',
+                        help="Seconds per tool call, e.g. rfdiffusion=0.2,protein_mpnn=0.05,omegafold=0.1,tmalign=0.01 "
+                             "(per design for rfdiffusion, per sequence for omegafold)")
+    parser.add_argument('--fold-batch-size', type=int, default=1)
+    parser.add_argument('--tmalign', action='store_true', help="Score with the TMalign stand-in instead of in-process")
+    parser.add_argument('--filters', default=None,
+                        help="Run with the design filters: JSON file of thresholds, or 'default' (see design_filters.py)")
+    parser.add_argument('--root-dir', default=None, help="Folder for the scenario runs (default: a temporary folder)")
+    parser.add_argument('--output', default=None, help="JSON file to write the metrics to")
+    parser.add_argument('--baseline', default=None, help="JSON metrics of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed relative regression against the baseline")
+    args = parser.parse_args()
+
+    names = [f"{size}-{contig}" for size in SIZES for contig in CONTIGS] if args.scenarios == 'all' \
+        else args.scenarios.split(',')
+    latencies = {tool: float(seconds) for tool, seconds in
+                 (pair.split('=') for pair in args.latency.split(',') if pair)}
+    root_dir = os.path.abspath(args.root_dir or tempfile.mkdtemp(prefix='pipeline_benchmark_'))
+    # The scenarios run in their own folders
+    filters_path = os.path.abspath(args.filters) if args.filters not in (None, 'default') else args.filters
+
+    metrics = {}
+    for name in names:
+        metrics[name] = result = run_scenario(name, root_dir, latencies, args.fold_batch_size, args.tmalign,
+                                              filters=filters_path)
+        print(f"{name}: {result['done']}/{result['designs']} designs ({result['rejected']} rejected) "
+              f"in {result['elapsed_s']:.2f} s, "
+              f"{result['designs_per_s']:.2f} designs/s, {result['fs_ops_per_design']:.0f} file-system ops per design "
+              f"({', '.join(f'{op} {count}' for op, count in sorted(result['fs_ops'].items()))})")
+        print(f"  {'stage':<14}{'runs':>6}{'wall p50':>11}{'tool p50':>11}{'overhead p50':>15}{'p95':>9}")
+        for stage, stats in result['stages'].items():
+            print(f"  {stage:<14}{stats['runs']:>6}{stats['wall_p50_ms']:>8.1f} ms{stats['tool_p50_ms']:>8.1f} ms"
+                  f"{stats['overhead_p50_ms']:>12.1f} ms{stats['overhead_p95_ms']:>6.1f} ms")
+    print(f"Scenario folders and pipeline logs in {root_dir}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(metrics, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(metrics, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# One command line for the pipeline scripts
+# Installed as the rfdiffusion-pipeline command (see pyproject.toml at the root of the repo),
+# or run as python pipeline_cli.py. Every subcommand imports its module only when it runs, so
+# status and the --help of every command start without numpy, requests or boto3, and the
+# chatbot is the only command that loads boto3.
+#
+# Usage:
+#   rfdiffusion-pipeline run 7SH6 "[20-30/A157-163/20-40]" --designs 2 --sequences 4
+#   rfdiffusion-pipeline run 7SH6 "[20-30/A157-163/20-40]" --routes rfdiffusion,evodiff
+#   rfdiffusion-pipeline batch targets.csv --number-proteins 4      # batch_pipeline.py arguments
+#   rfdiffusion-pipeline chat
+#   rfdiffusion-pipeline score --models a.pdb --references b.pdb    # structural_scoring.py arguments
+#   rfdiffusion-pipeline status                                     # work_flow index and shard queue
+#   rfdiffusion-pipeline results top --k 50 --target "7SH6*"         # results_store.py arguments
+#   rfdiffusion-pipeline config                                     # root folder and tool paths in use
+#   rfdiffusion-pipeline artifacts gc                               # artifact_store.py arguments
+# The sweep, shard, filters, contig, report and fetch commands take the arguments of sweep.py,
+# sharded_run.py, design_filters.py, contigs.py, run_report.py and pdb_fetch.py.
+import argparse
+import importlib
+import os
+import sys
+
+# Commands that hand their arguments to the main() of a module: (module, description)
+COMMANDS = {
+    'batch': ('batch_pipeline', "Run a manifest of targets through the pipeline"),
+    'chat': ('dynamic_chatbot_RFdiffusion', "Chatbot driving the tools (needs boto3 and AWS credentials)"),
+    'score': ('structural_scoring', "All-vs-all TM-score and RMSD between PDB files"),
+    'sweep': ('sweep', "Successive-halving sweep of RFdiffusion / ProteinMPNN settings"),
+    'shard': ('sharded_run', "Sharded execution of a screen on several hosts"),
+    'filters': ('design_filters', "Check backbones and sequences against the filter thresholds"),
+    'contig': ('contigs', "Parse and validate an RFdiffusion contig"),
+    'report': ('run_report', "Summary of the run reports"),
+    'results': ('results_store', "Best designs, filters and export of the results store"),
+    'artifacts': ('artifact_store', "Clean-up, checksums and listing of the pipeline outputs"),
+    'fetch': ('pdb_fetch', "Download native structures"),
+    'config': ('pipeline_config', "Show the root folder and the tool paths in use"),
+}
+
+
+def run_module(module, prog, argv):
+    """Run the main() of a module as if it was started as a script with argv."""
+    saved = sys.argv
+    sys.argv = [prog] + list(argv)
+    try:
+        return importlib.import_module(module).main()
+    finally:
+        sys.argv = saved
+
+
+def command_run(args):
+    """One target through RFdiffusion, ProteinMPNN, OmegaFold and the scoring."""
+    from rfdiffusion_pipeline import process_protein, setup_folder
+
+    os.chdir(args.root_dir)
+    setup_folder(args.root_dir)
+    results = process_protein(args.pdb_code, args.contig, number_proteins=args.designs,
+                              num_seq_per_target=args.sequences, resume=not args.no_resume,
+                              routes=args.routes.split(','))
+    for result in results:
+        print(result.get('route'), result.get('design'), result.get('sample'), result['status'],
+              result.get('tm_score_1'), result.get('tm_score_2'), result.get('rmsd'))
+    return 0 if all(result['status'] == 'done' for result in results) else 1
+
+
+def command_status(args):
+    """Stages recorded in the work_flow index per target, and the state of the shard queue."""
+    from workflow_index import WorkflowIndex
+    from sharded_run import counts, queue_dir
+
+    index_path = os.path.join(args.root_dir, 'work_flow', 'index.sqlite')
+    if os.path.exists(index_path):
+        # The index of a sharded run is on a folder shared between hosts, it is not switched to WAL
+        index = WorkflowIndex(index_path, journal_mode='DELETE' if os.path.isdir(queue_dir(args.root_dir)) else 'WAL')
+        targets = index.targets()
+        print(f"{len(targets)} targets in {index_path}")
+        for target in targets[:args.limit] if args.limit else targets:
+            stages = {}
+            for entry in index.lookup(target):
+                stage = stages.setdefault(entry['stage'], {})
+                stage[entry['status']] = stage.get(entry['status'], 0) + 1
+            print(f"  {target:<20}" + "  ".join(
+                f"{stage} " + "/".join(f"{count} {status}" for status, count in sorted(statuses.items()))
+                for stage, statuses in stages.items()))
+        index.close()
+    else:
+        print(f"No work_flow index in {args.root_dir}")
+
+    if os.path.isdir(queue_dir(args.root_dir)):
+        print(f"Shard queue: {counts(args.root_dir)}")
+    return 0
+
+
+def build_parser():
+    from pipeline_config import root_dir
+
+    parser = argparse.ArgumentParser(prog='rfdiffusion-pipeline',
+                                     description="RFdiffusion -> ProteinMPNN -> OmegaFold design pipeline")
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+
+    run = subparsers.add_parser('run', help="Run one target through the pipeline")
+    run.add_argument('pdb_code')
+    run.add_argument('contig', help="RFdiffusion contig, e.g. [20-30/A157-163/20-40]")
+    run.add_argument('--designs', type=int, default=1, help="RFdiffusion designs")
+    run.add_argument('--sequences', type=int, default=1, help="ProteinMPNN sequences per design")
+    run.add_argument('--root-dir', default=root_dir(), help="Folder containing work_flow and the tools")
+    run.add_argument('--no-resume', action='store_true', help="Run again the stages recorded as done")
+    run.add_argument('--routes', default='rfdiffusion',
+                     help="Routes run concurrently, separated by commas: rfdiffusion, evodiff (see stages.py)")
+    run.set_defaults(handler=command_run)
+
+    status = subparsers.add_parser('status', help="Progress recorded in the work_flow folder")
+    status.add_argument('--root-dir', default=root_dir(), help="Folder containing work_flow")
+    status.add_argument('--limit', type=int, default=50, help="Targets shown (0 for all)")
+    status.set_defaults(handler=command_status)
+
+    for name, (_, description) in COMMANDS.items():
+        # The arguments are parsed by the module itself, -h included
+        subparsers.add_parser(name, help=description, add_help=False)
+    return parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv and argv[0] in COMMANDS:
+        module = COMMANDS[argv[0]][0]
+        return run_module(module, f"rfdiffusion-pipeline {argv[0]}", argv[1:])
+
+    args = build_parser().parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
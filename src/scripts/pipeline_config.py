@@ -0,0 +1,101 @@
+# Where the pipeline finds its root folder and the external tools
+# The scripts used to hard-code ./RFdiffusion (pipeline), ./models/RFdiffusion (chatbot) and
+# /home/ubuntu (rfdiffusion_run.py). Every path now comes from, in order:
+#   - an environment variable: RFDIFFUSION_ROOT, RFDIFFUSION_SCRIPT, PROTEIN_MPNN_SCRIPT,
+#     OMEGAFOLD_BIN, TMALIGN_BIN, EVODIFF_SCRIPT
+#   - a JSON config file, RFDIFFUSION_CONFIG or ./pipeline_config.json, e.g.
+#       {"root_dir": "/home/ubuntu", "tools": {"rfdiffusion": "./models/RFdiffusion/scripts/run_inference.py"}}
+#   - the first of the default locations that exists (both layouts of the old scripts work),
+#     relative paths being relative to the root folder
+# Only the standard library is imported here, the module is loaded by every command.
+#
+# Usage:
+#   python pipeline_config.py            # show the paths in use
+import json
+import os
+
+CONFIG_ENV = 'RFDIFFUSION_CONFIG'
+DEFAULT_CONFIG_FILE = './pipeline_config.json'
+ROOT_ENV = 'RFDIFFUSION_ROOT'
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Default locations of every tool, the first one that exists is used
+DEFAULT_TOOLS = {
+    'rfdiffusion': ['./RFdiffusion/scripts/run_inference.py', './models/RFdiffusion/scripts/run_inference.py'],
+    'protein_mpnn': ['./ProteinMPNN/protein_mpnn_run.py', './models/ProteinMPNN/protein_mpnn_run.py'],
+    # Commands without a folder are looked up in PATH
+    'omegafold': ['omegafold'],
+    'tmalign': ['./TMalign', './models/TMalign'],
+    # The EvoDiff runner of this repo, unless a copy is put in the root folder
+    'evodiff': ['./EvoDiff/evodiff_generate.py', os.path.join(SCRIPTS_DIR, 'evodiff_generate.py')],
+}
+TOOL_ENV = {
+    'rfdiffusion': 'RFDIFFUSION_SCRIPT',
+    'protein_mpnn': 'PROTEIN_MPNN_SCRIPT',
+    'omegafold': 'OMEGAFOLD_BIN',
+    'tmalign': 'TMALIGN_BIN',
+    'evodiff': 'EVODIFF_SCRIPT',
+}
+
+_config = None
+
+
+def load_config(path=None, reload=False):
+    """Settings of the JSON config file (empty if there is none), read once."""
+    global _config
+    if _config is not None and path is None and not reload:
+        return _config
+    path = path or os.environ.get(CONFIG_ENV) or DEFAULT_CONFIG_FILE
+    config = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            config = json.load(f)
+        unknown = set(config.get('tools', {})) - set(DEFAULT_TOOLS)
+        if unknown:
+            raise ValueError(f"Unknown tools in {path}: {', '.join(sorted(unknown))}, "
+                             f"expected some of {', '.join(DEFAULT_TOOLS)}")
+    _config = config
+    return config
+
+
+def root_dir():
+    """Folder containing work_flow and the tools (default: the current folder)."""
+    return os.environ.get(ROOT_ENV) or load_config().get('root_dir') or os.getcwd()
+
+
+def tool_path(tool, root=None):
+    """
+    Path (or command) of a tool, see the top of the file for the order. Relative paths are
+    relative to root, or returned as they are (relative to the current folder) without root.
+    """
+    if tool not in DEFAULT_TOOLS:
+        raise ValueError(f"Unknown tool {tool}, expected one of {', '.join(DEFAULT_TOOLS)}")
+
+    def resolve(path):
+        # A command to look up in PATH, or an absolute path, is used as it is
+        if os.sep not in path or os.path.isabs(path) or root is None:
+            return path
+        return os.path.normpath(os.path.join(root, path))
+
+    configured = os.environ.get(TOOL_ENV[tool]) or load_config().get('tools', {}).get(tool)
+    if configured:
+        return resolve(configured)
+    candidates = [resolve(path) for path in DEFAULT_TOOLS[tool]]
+    for path in candidates:
+        if os.sep not in path or os.path.exists(path):
+            return path
+    # None installed, the error comes from the call with the first location
+    return candidates[0]
+
+
+def main():
+    print(f"config file: {os.environ.get(CONFIG_ENV) or DEFAULT_CONFIG_FILE}"
+          f"{'' if load_config() else ' (not found, defaults)'}")
+    print(f"root_dir: {root_dir()}")
+    for tool in DEFAULT_TOOLS:
+        path = tool_path(tool, root_dir())
+        print(f"{tool}: {path}{'' if os.sep not in path or os.path.exists(path) else ' (missing)'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+# Staged work queue used by the pipeline
+# Items (dicts) flow through a list of stages. Every stage has its own queue and number of
+# worker threads, and a stage function can turn one item into several items for the next stage
+# (e.g. one RFdiffusion target into one item per design). The items coming out of the last
+# stage are yielded as soon as they are finished. A batched stage collects several pending
+# items (from any target) and gets them in one call, e.g. to fold them in one OmegaFold run.
+# merge_streams runs several such pipelines side by side and yields their items as one stream.
+import queue
+import threading
+import time
+
+# Marker put in the queues to stop the workers
+_STOP = object()
+# Marker put in the results queue once every stage has stopped
+_DONE = object()
+
+
+def _collect(in_queue, first_item, batch_size, batch_wait):
+    # Take up to batch_size items, waiting at most batch_wait seconds for more to arrive.
+    # Returns the batch and whether the stop marker was taken from the queue.
+    batch = [first_item]
+    deadline = time.time() + batch_wait
+    while len(batch) < batch_size:
+        try:
+            item = in_queue.get(timeout=max(deadline - time.time(), 0))
+        except queue.Empty:
+            break
+        if item is _STOP:
+            return batch, True
+        batch.append(item)
+    return batch, False
+
+
+def _stage_worker(stage, function, in_queue, out_queue, results, batch_size, batch_wait):
+    stopping = False
+    while not stopping:
+        item = in_queue.get()
+        if item is _STOP:
+            break
+
+        if batch_size > 1:
+            batch, stopping = _collect(in_queue, item, batch_size, batch_wait)
+        else:
+            batch = [item]
+
+        tic = time.time()
+        try:
+            outputs = function(batch) if batch_size > 1 else function(item)
+        except Exception as err:
+            # Failed items leave the pipeline, the other items keep going
+            for item in batch:
+                print(f"[{item.get('name')}] {stage} failed: {err}")
+                results.put({**item, 'status': 'failed', 'error': f"{stage}: {err}"})
+            continue
+
+        elapsed = time.time() - tic
+        for output in outputs:
+            # Outputs are built from their input item, so they carry its timings
+            output = {**output, 'timings': {**output.get('timings', {}), stage: elapsed}}
+            if output.get('status') in ('failed', 'rejected'):
+                # A stage can also report failed (or filtered out) items without raising, they skip the next stages
+                results.put(output)
+            elif out_queue is not None:
+                out_queue.put(output)
+            else:
+                results.put({**output, 'status': output.get('status', 'done')})
+
+
+def _shutdown(queues, threads, results):
+    # Stop the stages in order: once every worker of a stage has stopped,
+    # nothing else can arrive in the queue of the next stage
+    for stage_queue, stage_threads in zip(queues, threads):
+        for _ in stage_threads:
+            stage_queue.put(_STOP)
+        for thread in stage_threads:
+            thread.join()
+    results.put(_DONE)
+
+
+def run_stages(items, stages):
+    """
+    Run the items through the stages, a list of (name, function, workers) tuples.
+    function(item) returns the list of items passed to the next stage.
+    A stage given as (name, function, workers, batch_size, batch_wait) is batched: function
+    gets a list of up to batch_size items, collected for at most batch_wait seconds.
+    Yields the items of the last stage as they finish (with status 'done'), and the items
+    whose stage raised an exception (with status 'failed' and the error). Items returned by a
+    stage with status 'failed' or 'rejected' skip the next stages and are yielded as they are.
+    """
+    stages = [tuple(stage) + (1, 0.0)[len(stage) - 3:] for stage in stages]
+    for name, _, workers, batch_size, _ in stages:
+        if workers < 1:
+            raise ValueError(f"Stage {name} needs at least one worker")
+        if batch_size < 1:
+            raise ValueError(f"Stage {name} needs a batch size of at least one")
+
+    queues = [queue.Queue() for _ in stages]
+    results = queue.Queue()
+
+    # Start the workers of every stage, each stage feeds the queue of the next one
+    threads = []
+    for i, (name, function, workers, batch_size, batch_wait) in enumerate(stages):
+        out_queue = queues[i + 1] if i + 1 < len(stages) else None
+        stage_threads = [
+            threading.Thread(target=_stage_worker, name=f"{name}-{n}", daemon=True,
+                             args=(name, function, queues[i], out_queue, results, batch_size, batch_wait))
+            for n in range(workers)
+        ]
+        for thread in stage_threads:
+            thread.start()
+        threads.append(stage_threads)
+
+    for item in items:
+        queues[0].put(item)
+
+    threading.Thread(target=_shutdown, args=(queues, threads, results), daemon=True).start()
+
+    while True:
+        result = results.get()
+        if result is _DONE:
+            break
+        yield result
+
+
+def merge_streams(streams):
+    """
+    Yield the items of several iterators (e.g. several run_stages) in the order they come,
+    every iterator being consumed by its own thread. An exception of an iterator is raised here.
+    """
+    results = queue.Queue()
+
+    def consume(stream):
+        try:
+            for item in stream:
+                results.put(item)
+        except Exception as err:
+            results.put(err)
+        finally:
+            results.put(_DONE)
+
+    streams = list(streams)
+    for stream in streams:
+        threading.Thread(target=consume, args=(stream,), daemon=True).start()
+
+    remaining = len(streams)
+    while remaining:
+        result = results.get()
+        if result is _DONE:
+            remaining -= 1
+        elif isinstance(result, Exception):
+            raise result
+        else:
+            yield result
@@ -0,0 +1,185 @@
+# Content-addressed cache for the outputs of RFdiffusion, ProteinMPNN and OmegaFold
+# A stage run is identified by the hash of its input files plus the normalized set of
+# arguments. When the same run is requested again, the stored outputs are hardlinked
+# (or copied) into the expected work_flow/*_output folder instead of running the tool.
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+DEFAULT_CACHE_DIR = './work_flow/cache'
+DEFAULT_MAX_BYTES = 100 * 1024 ** 3  # 100 GB
+
+
+def _hash_file(path, hasher):
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(block)
+
+
+def _snapshot(directory):
+    # Relative path -> (size, mtime) of every file below the directory
+    snapshot = {}
+    if not os.path.isdir(directory):
+        return snapshot
+    for root, _, files in os.walk(directory):
+        for filename in files:
+            path = os.path.join(root, filename)
+            stat = os.stat(path)
+            snapshot[os.path.relpath(path, directory)] = (stat.st_size, stat.st_mtime_ns)
+    return snapshot
+
+
+def _link_or_copy(src, dst):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        # Different file system or no hardlink support
+        shutil.copy2(src, dst)
+
+
+def _unshare(directory, relpaths):
+    # Replace hardlinked files by private copies, so that a tool writing its outputs
+    # in place cannot change the content of the cache entries they are linked to
+    for relpath in relpaths:
+        path = os.path.join(directory, relpath)
+        if os.path.exists(path) and os.stat(path).st_nlink > 1:
+            shutil.copy2(path, path + '.unshare')
+            os.replace(path + '.unshare', path)
+
+
+class ResultCache:
+    """
+    Cache of stage outputs stored under cache_dir, limited to max_bytes.
+    Least recently used entries are evicted when the limit is exceeded.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self._index = json.load(f)
+        else:
+            self._index = {}
+
+    def key(self, stage, input_files=(), file_params=None, params=None):
+        """
+        Hash of the stage name, the content of the input files and the arguments.
+        file_params are large files (e.g. model checkpoints) identified by path, size and
+        modification time instead of their content. Arguments set to None are dropped so
+        that leaving out an argument and passing None give the same key.
+        """
+        hasher = hashlib.sha256()
+        hasher.update(stage.encode())
+        for path in input_files:
+            hasher.update(os.path.basename(path).encode())
+            _hash_file(path, hasher)
+
+        normalized = {name: value for name, value in (params or {}).items() if value is not None}
+        for name, path in (file_params or {}).items():
+            if path is not None:
+                stat = os.stat(path)
+                normalized[name] = [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+        hasher.update(json.dumps(normalized, sort_keys=True, default=str).encode())
+
+        return hasher.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, 'objects', key[:2], key)
+
+    def restore(self, key, output_dir):
+        """
+        Materialize the outputs stored under key into output_dir.
+        Returns False on a cache miss.
+        """
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                return False
+            entry['last_used'] = time.time()
+            files = list(entry['files'])
+
+        entry_dir = self._entry_dir(key)
+        try:
+            for relpath in files:
+                _link_or_copy(os.path.join(entry_dir, relpath), os.path.join(output_dir, relpath))
+        except FileNotFoundError:
+            # The entry was removed from disk behind our back
+            with self._lock:
+                self._index.pop(key, None)
+                self._save()
+            return False
+
+        with self._lock:
+            self._save()
+        return True
+
+    def store(self, key, output_dir, files):
+        """Store the given files (relative to output_dir) under key."""
+        entry_dir = self._entry_dir(key)
+        size = 0
+        for relpath in files:
+            src = os.path.join(output_dir, relpath)
+            _link_or_copy(src, os.path.join(entry_dir, relpath))
+            size += os.path.getsize(src)
+
+        with self._lock:
+            self._index[key] = {'files': list(files), 'size': size, 'last_used': time.time()}
+            self._evict()
+            self._save()
+
+    def run(self, key, output_dir, run_function, outputs=None):
+        """
+        Restore the outputs of key into output_dir, or call run_function and store its outputs.
+        outputs is the list of files (relative to output_dir) the run creates. If it is not
+        known, the files created or modified in output_dir during the run are stored, which
+        is only correct if nothing else writes to output_dir at the same time.
+        Returns True on a cache hit.
+        """
+        if self.restore(key, output_dir):
+            print(f"Cache hit {key[:12]}, outputs restored to {output_dir}")
+            return True
+
+        if outputs is not None:
+            _unshare(output_dir, outputs)
+            run_function()
+            created = [relpath for relpath in outputs if os.path.exists(os.path.join(output_dir, relpath))]
+        else:
+            before = _snapshot(output_dir)
+            _unshare(output_dir, before)
+            run_function()
+            after = _snapshot(output_dir)
+            created = sorted(relpath for relpath, state in after.items() if before.get(relpath) != state)
+        if created:
+            self.store(key, output_dir, created)
+        return False
+
+    def size(self):
+        with self._lock:
+            return sum(entry['size'] for entry in self._index.values())
+
+    def _evict(self):
+        # Must be called with the lock held
+        total = sum(entry['size'] for entry in self._index.values())
+        for key in sorted(self._index, key=lambda k: self._index[k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            total -= self._index.pop(key)['size']
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+    def _save(self):
+        # Must be called with the lock held
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self.index_path)
@@ -0,0 +1,308 @@
+# Results store of the pipeline: one row per folded (or failed, or rejected) sequence
+# stream_targets writes every result to work_flow/results.sqlite as soon as it is scored, with
+# its target, pdb code, contig, design and sample numbers, scores, paths, and the settings of
+# its run (number_proteins, sampling_temp, guide_scale, sweep configuration, ...) as JSON.
+# Finding the best designs of a screen is then one indexed query instead of a walk through
+# the output folders:
+#   python results_store.py top --k 50                                # best TM-scores of all the runs
+#   python results_store.py top --target "7SH6*" --metric rmsd --max-rmsd 2 --param guide_scale=2
+#   python results_store.py targets                                   # designs and best score per target
+#   python results_store.py export designs.parquet --status done      # also .csv and .jsonl
+#   python results_store.py import work_flow/queue/results/*.jsonl    # results written as JSONL
+# Parquet export needs pyarrow. The shards of sharded_run.py write JSONL results (SQLite should
+# not be shared between hosts over NFS), import them once the screen is finished.
+#
+# design and sample are -1 for the results of a target that failed before the stage numbering
+# them (e.g. RFdiffusion failed), such a row is removed when the stage later succeeds.
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_STORE_PATH = './work_flow/results.sqlite'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS designs (
+    target     TEXT NOT NULL,
+    design     INTEGER NOT NULL,
+    sample     INTEGER NOT NULL,
+    pdb_code   TEXT,
+    contig     TEXT,
+    status     TEXT NOT NULL,
+    error      TEXT,
+    tm_score_1 REAL,
+    tm_score_2 REAL,
+    rmsd       REAL,
+    mpnn_score REAL,
+    length     INTEGER,
+    sequence   TEXT,
+    scaffold   TEXT,
+    model      TEXT,
+    params     TEXT,
+    timings    TEXT,
+    updated    REAL NOT NULL,
+    PRIMARY KEY (target, design, sample)
+)
+"""
+_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS designs_tm_score ON designs (status, tm_score_1)",
+    "CREATE INDEX IF NOT EXISTS designs_rmsd ON designs (status, rmsd)",
+    "CREATE INDEX IF NOT EXISTS designs_pdb_code ON designs (pdb_code, status)",
+    "CREATE INDEX IF NOT EXISTS designs_contig ON designs (contig)",
+]
+COLUMNS = ['target', 'design', 'sample', 'pdb_code', 'contig', 'status', 'error', 'tm_score_1', 'tm_score_2',
+           'rmsd', 'mpnn_score', 'length', 'sequence', 'scaffold', 'model', 'params', 'timings', 'updated']
+# Metrics that can rank the designs, True if higher is better
+METRICS = {'tm_score_1': True, 'tm_score_2': True, 'rmsd': False, 'mpnn_score': False}
+# Keys of a result that are not settings of its run
+_NOT_PARAMS = set(COLUMNS) | {'name', 'fasta', 'header'}
+
+
+def result_row(result):
+    """Row of the designs table for a result of stream_targets, or for an exported row."""
+    params = {key: value for key, value in result.items() if key not in _NOT_PARAMS and value is not None}
+    params.update(result.get('params') or {})
+    sequence = result.get('sequence')
+    return {
+        'target': result.get('name') or result.get('target') or result['pdb_code'],
+        'design': result.get('design', -1),
+        'sample': result.get('sample', -1),
+        'pdb_code': result['pdb_code'].upper() if result.get('pdb_code') else None,
+        'contig': result.get('contig'),
+        'status': result['status'],
+        'error': result.get('error'),
+        'tm_score_1': result.get('tm_score_1'),
+        'tm_score_2': result.get('tm_score_2'),
+        'rmsd': result.get('rmsd'),
+        'mpnn_score': result.get('mpnn_score'),
+        'length': len(sequence) if sequence else None,
+        'sequence': sequence,
+        'scaffold': result.get('scaffold'),
+        'model': result.get('model'),
+        'params': json.dumps(params, sort_keys=True, default=str),
+        'timings': json.dumps(result['timings']) if result.get('timings') else None,
+        'updated': time.time(),
+    }
+
+
+def parse_param(text):
+    """key=value filter of the run settings, the value is compared as text (2 matches "2")."""
+    key, sep, value = text.partition('=')
+    if not sep or not key:
+        raise ValueError(f"Invalid parameter filter {text!r}, expected key=value")
+    return key, value
+
+
+class ResultsStore:
+    """SQLite store of the pipeline results, safe to share between threads."""
+
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(_SCHEMA)
+            for statement in _INDEXES:
+                self._db.execute(statement)
+
+    def add(self, result):
+        """Write one result (a dict of stream_targets), replacing the earlier one of the same sequence."""
+        self.add_many([result])
+
+    def add_many(self, results):
+        rows = [result_row(result) for result in results]
+        with self._lock, self._db:
+            for row in rows:
+                # A failure recorded before the designs or samples were numbered is superseded
+                if row['design'] >= 0:
+                    self._db.execute("DELETE FROM designs WHERE target = ? AND design = -1", (row['target'],))
+                if row['sample'] >= 0:
+                    self._db.execute("DELETE FROM designs WHERE target = ? AND design = ? AND sample = -1",
+                                     (row['target'], row['design']))
+            self._db.executemany(f"INSERT OR REPLACE INTO designs VALUES ({', '.join('?' * len(COLUMNS))})",
+                                 [[row[column] for column in COLUMNS] for row in rows])
+        return len(rows)
+
+    def _where(self, target=None, pdb_code=None, contig=None, status='done', min_tm_score=None,
+               max_rmsd=None, params=None):
+        # SQL condition and arguments of the query filters, target is a glob pattern (7SH6*)
+        conditions, arguments = [], []
+        for condition, value in (("target GLOB ?", target), ("pdb_code = ?", pdb_code and pdb_code.upper()),
+                                 ("contig = ?", contig), ("status = ?", status),
+                                 ("tm_score_1 >= ?", min_tm_score), ("rmsd <= ?", max_rmsd)):
+            if value is not None:
+                conditions.append(condition)
+                arguments.append(value)
+        for key, value in (params or {}).items():
+            conditions.append("CAST(json_extract(params, ?) AS TEXT) = ?")
+            arguments += [f"$.{key}", str(value)]
+        return (" WHERE " + " AND ".join(conditions)) if conditions else "", arguments
+
+    def top(self, k=50, metric='tm_score_1', **filters):
+        """
+        The k best results by metric (see METRICS), best first. filters are target (glob),
+        pdb_code, contig, status (default 'done', None for all), min_tm_score, max_rmsd and
+        params (dict of run settings, e.g. {'guide_scale': 2}).
+        """
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric {metric}, expected one of {', '.join(METRICS)}")
+        where, arguments = self._where(**filters)
+        where += (" AND " if where else " WHERE ") + f"{metric} IS NOT NULL"
+        order = "DESC" if METRICS[metric] else "ASC"
+        with self._lock:
+            rows = self._db.execute(f"SELECT * FROM designs{where} ORDER BY {metric} {order} LIMIT ?",
+                                    arguments + [k]).fetchall()
+        return [_row_to_dict(row) for row in rows]
+
+    def query(self, **filters):
+        """All the results matching the filters of top, ordered by target, design and sample."""
+        where, arguments = self._where(**filters)
+        with self._lock:
+            rows = self._db.execute(f"SELECT * FROM designs{where} ORDER BY target, design, sample",
+                                    arguments).fetchall()
+        return [_row_to_dict(row) for row in rows]
+
+    def count(self, **filters):
+        where, arguments = self._where(**{'status': None, **filters})
+        with self._lock:
+            return self._db.execute(f"SELECT COUNT(*) FROM designs{where}", arguments).fetchone()[0]
+
+    def targets(self):
+        """Per target: results, done ones, best TM-score and lowest RMSD."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT target, pdb_code, COUNT(*) AS results, SUM(status = 'done') AS done, "
+                "MAX(tm_score_1) AS best_tm_score, MIN(rmsd) AS best_rmsd "
+                "FROM designs GROUP BY target ORDER BY target"
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def export(self, path, fmt=None, **filters):
+        """
+        Write the results matching the filters (see top, status None for all) to a CSV,
+        JSONL or Parquet file (fmt, or from the extension). Returns the number of rows.
+        """
+        fmt = fmt or os.path.splitext(path)[1].lstrip('.')
+        rows = self.query(**{'status': None, **filters})
+        if fmt == 'jsonl':
+            with open(path, 'w') as f:
+                for row in rows:
+                    f.write(json.dumps(row) + '\n')
+        elif fmt == 'csv':
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=COLUMNS)
+                writer.writeheader()
+                for row in rows:
+                    writer.writerow({**row, 'params': json.dumps(row['params']),
+                                     'timings': json.dumps(row['timings']) if row['timings'] else None})
+        elif fmt == 'parquet':
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise ValueError("Parquet export needs pyarrow (pip install pyarrow), or use .csv / .jsonl")
+            columns = {column: [row[column] for row in rows] for column in COLUMNS}
+            # Nested settings are kept as JSON text, their keys differ between runs
+            columns['params'] = [json.dumps(value) for value in columns['params']]
+            columns['timings'] = [json.dumps(value) if value else None for value in columns['timings']]
+            pyarrow.parquet.write_table(pyarrow.table(columns), path)
+        else:
+            raise ValueError(f"Unknown export format {fmt}, expected csv, jsonl or parquet")
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def _row_to_dict(row):
+    entry = dict(row)
+    entry['params'] = json.loads(entry['params']) if entry['params'] is not None else {}
+    entry['timings'] = json.loads(entry['timings']) if entry['timings'] is not None else None
+    return entry
+
+
+def import_jsonl(store, paths):
+    """Add the results of JSONL files (batch_pipeline --results, sharded_run, sweep) to the store."""
+    added = 0
+    for path in paths:
+        with open(path) as f:
+            added += store.add_many(json.loads(line) for line in f if line.strip())
+    return added
+
+
+def format_results(rows):
+    lines = [f"{'target':<20}{'design':>7}{'sample':>7}{'tm_score':>10}{'rmsd':>8}{'mpnn':>8}{'length':>8}  model"]
+    for row in rows:
+        values = [f"{row[key]:.3f}" if row[key] is not None else '-' for key in ('tm_score_1', 'rmsd', 'mpnn_score')]
+        lines.append(f"{row['target']:<20}{row['design']:>7}{row['sample']:>7}{values[0]:>10}{values[1]:>8}"
+                     f"{values[2]:>8}{row['length'] or '-':>8}  {row['model'] or row['error'] or ''}")
+    return "\n".join(lines)
+
+
+def _add_filters(parser):
+    parser.add_argument('--target', default=None, help="Target name, or a glob pattern like 7SH6*")
+    parser.add_argument('--pdb-code', default=None)
+    parser.add_argument('--contig', default=None)
+    parser.add_argument('--min-tm-score', type=float, default=None)
+    parser.add_argument('--max-rmsd', type=float, default=None)
+    parser.add_argument('--param', action='append', default=[], help="Run setting key=value, can be repeated")
+
+
+def _filters(args, status):
+    return {'target': args.target, 'pdb_code': args.pdb_code, 'contig': args.contig, 'status': status,
+            'min_tm_score': args.min_tm_score, 'max_rmsd': args.max_rmsd,
+            'params': dict(parse_param(param) for param in args.param)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query and export the pipeline results")
+    parser.add_argument('--store', default=DEFAULT_STORE_PATH, help="SQLite results store")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    top = subparsers.add_parser('top', help="Best designs by a metric")
+    top.add_argument('--k', type=int, default=50)
+    top.add_argument('--metric', default='tm_score_1', choices=sorted(METRICS))
+    top.add_argument('--json', action='store_true', help="One JSON object per design instead of a table")
+    _add_filters(top)
+
+    subparsers.add_parser('targets', help="Designs and best scores per target")
+
+    export = subparsers.add_parser('export', help="Write the results to a CSV, JSONL or Parquet file")
+    export.add_argument('output')
+    export.add_argument('--format', default=None, choices=['csv', 'jsonl', 'parquet'])
+    export.add_argument('--status', default=None, help="Only the results with this status (done, failed, rejected)")
+    _add_filters(export)
+
+    load = subparsers.add_parser('import', help="Add the results of JSONL files")
+    load.add_argument('files', nargs='+')
+    args = parser.parse_args()
+
+    store = ResultsStore(args.store)
+    if args.command == 'top':
+        rows = store.top(args.k, args.metric, **_filters(args, 'done'))
+        if args.json:
+            for row in rows:
+                print(json.dumps(row))
+        else:
+            print(format_results(rows))
+    elif args.command == 'targets':
+        for row in store.targets():
+            best = f"{row['best_tm_score']:.3f}" if row['best_tm_score'] is not None else '-'
+            print(f"{row['target']:<20}{row['done']:>6} / {row['results']:<6} done, best TM-score {best}")
+    elif args.command == 'export':
+        written = store.export(args.output, args.format, **_filters(args, args.status))
+        print(f"{written} results written to {args.output}")
+    else:
+        print(f"{import_jsonl(store, args.files)} results added to {store.path}")
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,10 +3,21 @@
 import glob
 import os
 import re
-import requests
 import subprocess
 import time
 
+from artifact_store import get_store
+from job_runner import JobError, run_job
+from model_server import run_on_server
+import pdb_fetch
+from pipeline_config import tool_path
+from contigs import parse_contig, validate_contig
+from result_cache import ResultCache
+from results_store import ResultsStore
+import run_report
+from run_report import NullReport, RunReport
+from workflow_index import WorkflowIndex, file_checksum
+
 
 def setup_folder(root_dir):  
 
@@ -17,25 +28,62 @@ def setup_folder(root_dir):
     subfolders = ['RFdiffusion_output', 'mpnn_output', 'omegafold_output', 'native_proteins']
 
     # Check if the base folder already exists
-    if not os.path.exists(base_folder):
-        # Create the base folder
-        os.makedirs(base_folder, exist_ok=True)
+    exists = os.path.exists(base_folder)
 
-        # Create the subfolders
-        for subfolder in subfolders:
-            os.makedirs(os.path.join(base_folder, subfolder), exist_ok=True)
+    # Create the base folder and the subfolders that are missing
+    os.makedirs(base_folder, exist_ok=True)
+    for subfolder in subfolders:
+        os.makedirs(os.path.join(base_folder, subfolder), exist_ok=True)
 
+    if not exists:
         print("Folder structure created successfully.")
     else:
         print("The folder 'work_flow' already exists.")
 
 
+# Run a tool call, or take its outputs from the cache when the same call was run before.
+# If a warm model server is running for the tool (see model_server.py), the call is sent to it
+# with the script arguments, instead of starting a new process.
+# A failed tool call raises a JobError, so the next stages do not run on missing files.
+# Returns the JobResult of the tool run, or None when the outputs came from the cache.
+def _run_call(args, name, timeout=None, cache=None, cache_key=None, output_dir=None,
+              server_tool=None, script_args=None, outputs=None):
+    jobs = []
+
+    def run():
+        try:
+            result = None
+            if server_tool is not None:
+                result = run_on_server(server_tool, script_args, name=name, timeout=timeout)
+            if result is None:
+                result = run_job(args, name=name, timeout=timeout)
+        except JobError as err:
+            run_report.add_job(err.result)
+            raise
+        # CPU time and memory of the tool go to the run report of the stage
+        run_report.add_job(result)
+        jobs.append(result)
+
+    if cache is None:
+        run()
+    else:
+        cache.run(cache_key, output_dir, run, outputs=outputs)
+    return jobs[0] if jobs else None
+
+
 def run_rfdiffusion(input_file: str, output_dir_and_prefix: str, number_proteins: int,
                     residues: str = None, guide_scale: int = None,
                     substrate_name: str = None, model_weights: str = None,
-                    contig_length: str = None, guiding_potentials: str = None):
+                    contig_length: str = None, guiding_potentials: str = None,
+                    design_startnum: int = 0,
+                    cache: ResultCache = None, timeout: float = None):
     """
     If the name of the substrate is specified (e.g. LLK), it must be present in the input pdb file.
+    The designs are numbered from design_startnum (<prefix>_<design_startnum>.pdb, ...).
+    If a cache is given, the designs of an identical earlier run are reused.
+    The run is killed after timeout seconds (default: no limit).
+    Returns the JobResult of the run (None if the designs came from the cache), raises a
+    JobError if RFdiffusion failed.
     """
     if input_file is not None and not os.path.exists(input_file):
       raise ValueError("Input file does not exist")
@@ -43,42 +91,58 @@ def run_rfdiffusion(input_file: str, output_dir_and_prefix: str, number_proteins
     # Input checks
     if residues is None and guide_scale is not None:
         raise ValueError("Please fill in residues")
+    # A bad contig would only fail once RFdiffusion has loaded its weights, raises a ContigError
+    if residues is not None:
+        validate_contig(residues, input_file or None, contig_length)
 
-    # Create function call
-    sh_call = "./RFdiffusion/scripts/run_inference.py"
-    #sh_call = "run_inference.py"
-    sh_call += " inference.output_prefix=" + output_dir_and_prefix
-    sh_call += " inference.num_designs=" + str(number_proteins)
+    # Create function call, the arguments are passed without a shell so they need no quoting
+    args = [tool_path('rfdiffusion')]
+    args.append("inference.output_prefix=" + output_dir_and_prefix)
+    args.append("inference.num_designs=" + str(number_proteins))
+    if design_startnum:
+        args.append("inference.design_startnum=" + str(design_startnum))
 
     # Optional arguments
     if input_file != "":
-        sh_call += " inference.input_pdb=" + input_file
+        args.append("inference.input_pdb=" + input_file)
 
     if residues is not None:
-        # contigmap.contigs line must be in single quotes
-        sh_call += " 'contigmap.contigs=" + residues + "'"
+        args.append("contigmap.contigs=" + residues)
 
     if contig_length is not None:
-        sh_call += " contigmap.length=" + contig_length
+        args.append("contigmap.length=" + contig_length)
 
     if guide_scale is not None:
-        sh_call += " potentials.guide_scale=" + str(guide_scale)
+        args.append("potentials.guide_scale=" + str(guide_scale))
 
     if guiding_potentials is not None:
-        # potentials.guiding_potentials line must be in single quotes
-        # the guiding_potentials must be in double quotes
-        # sh_call += " " + repr('potentials.guiding_potentials=["type:substrate_contacts,s:1,r_0:8,rep_r_0:5.0,rep_s:2,rep_r_min:1"]')
-        sh_call += " 'potentials.guiding_potentials=[" + '"' + guiding_potentials + '"' + "]'"
+        # the guiding_potentials must be in double quotes, e.g.
+        # potentials.guiding_potentials=["type:substrate_contacts,s:1,r_0:8,rep_r_0:5.0,rep_s:2,rep_r_min:1"]
+        args.append("potentials.guiding_potentials=[" + '"' + guiding_potentials + '"' + "]")
 
     if substrate_name is not None:
-        sh_call += " potentials.substrate=" + substrate_name
+        args.append("potentials.substrate=" + substrate_name)
 
     if model_weights is not None:
-        sh_call += " inference.ckpt_override_path=" + model_weights
-
-    print("Running RFdiffusion with call", sh_call)
-
-    os.system(sh_call)
+        args.append("inference.ckpt_override_path=" + model_weights)
+
+    cache_key = None
+    if cache is not None:
+        # Output names depend on the prefix, the folder they are restored to does not matter
+        cache_key = cache.key(
+            'rfdiffusion',
+            input_files=[input_file] if input_file else [],
+            file_params={'model_weights': model_weights},
+            params={'output_prefix': os.path.basename(output_dir_and_prefix),
+                    'number_proteins': number_proteins, 'residues': residues,
+                    'contig_length': contig_length, 'guide_scale': guide_scale,
+                    'guiding_potentials': guiding_potentials, 'substrate_name': substrate_name,
+                    # Only when set, so the keys of the runs numbered from 0 do not change
+                    **({'design_startnum': design_startnum} if design_startnum else {})}
+        )
+
+    return _run_call(args, "RFdiffusion", timeout, cache, cache_key, os.path.dirname(output_dir_and_prefix) or '.',
+              server_tool='rfdiffusion', script_args=args[1:])
 
 
 def run_protein_mpnn(input_file: str, output_dir: str,
@@ -86,62 +150,97 @@ def run_protein_mpnn(input_file: str, output_dir: str,
                     sampling_temp: str = "0.1", #default
                     seed: int = 0 , #default
                     batch_size: int = 1, #default
-                    model_name: str = "v_48_020"): #default
+                    model_name: str = "v_48_020", #default
+                    cache: ResultCache = None,
+                    timeout: float = None):
 
     # Check if input file exists
     if not os.path.exists(input_file):
         raise ValueError("input_file does not exist")
 
-    sh_call= "python ./ProteinMPNN/protein_mpnn_run.py"
-    sh_call+= " --pdb_path " + input_file
-    sh_call+= " --out_folder " + output_dir
-    sh_call+= " --num_seq_per_target " + str(num_seq_per_target)
+    args = ["python", tool_path('protein_mpnn')]
+    args += ["--pdb_path", input_file]
+    args += ["--out_folder", output_dir]
+    args += ["--num_seq_per_target", str(num_seq_per_target)]
     # Must be a string, can contain multiple temps, e.g.  "0.1 0.2"
-    sh_call+= " --sampling_temp " + '"' + sampling_temp + '"'
-    sh_call+= " --seed " + str(seed)
-    sh_call+= " --batch_size " + str(batch_size)
-    sh_call+= " --model_name " + model_name
+    args += ["--sampling_temp", sampling_temp]
+    args += ["--seed", str(seed)]
+    args += ["--batch_size", str(batch_size)]
+    args += ["--model_name", model_name]
 
-    print("Running ProteinMPNN with call", sh_call)
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.key(
+            'protein_mpnn',
+            input_files=[input_file],
+            params={'num_seq_per_target': num_seq_per_target, 'sampling_temp': sampling_temp.split(),
+                    'seed': seed, 'batch_size': batch_size, 'model_name': model_name}
+        )
 
-    os.system(sh_call)
+    # Several designs of a target share the output folder, so the cache is told which file is ours
+    outputs = [os.path.join('seqs', os.path.splitext(os.path.basename(input_file))[0] + '.fa')]
+    return _run_call(args, "ProteinMPNN", timeout, cache, cache_key, output_dir,
+              server_tool='protein_mpnn', script_args=args[2:], outputs=outputs)
 
 
-def run_omegafold(input_file: str, output_file: str):
+def run_omegafold(input_file: str, output_file: str, cache: ResultCache = None, timeout: float = None):
 
     if not os.path.exists(input_file):
         raise ValueError("input_file does not exist")
 
-    sh_call= "omegafold"
-    sh_call+= " " + input_file
-    sh_call+= " " + output_file
-
-
-    print("Running omegafold with call", sh_call)
+    args = [tool_path('omegafold'), input_file, output_file]
 
-    os.system(sh_call)
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.key('omegafold', input_files=[input_file])
 
+    # OmegaFold names every structure after the header of its FASTA record
+    outputs = [f"{header}.pdb" for header, _ in read_fasta(input_file)]
+    return _run_call(args, "OmegaFold", timeout, cache, cache_key, output_file, outputs=outputs)
 
-def download_pdb(pdb_code, target_directory='./work_flow/native_proteins'):
-    # Ensure the target directory exists
-    os.makedirs(target_directory, exist_ok=True)
-
-    # Construct the full path for the PDB file
-    pdb_file_path = os.path.join(target_directory, f"{pdb_code.upper()}.pdb")
 
-    # URL for downloading the PDB file
-    url = f"https://files.rcsb.org/download/{pdb_code.upper()}.pdb"
+def run_evodiff(input_file: str, output_file: str, residues: str, number_sequences: int = 1,
+                seed: int = 0, model_name: str = "oa_dm_38m", prefix: str = None,
+                cache: ResultCache = None, timeout: float = None):
+    """
+    Motif-scaffolding sequences for the contig residues with EvoDiff (see evodiff_generate.py),
+    written to output_file as FASTA records named <prefix>_<n>.
+    Returns the JobResult of the run (None if the sequences came from the cache).
+    """
+    if not os.path.exists(input_file):
+        raise ValueError("input_file does not exist")
+    # Same checks as for RFdiffusion, before the model is loaded
+    validate_contig(residues, input_file)
+    prefix = prefix or os.path.splitext(os.path.basename(output_file))[0]
+
+    args = ["python", tool_path('evodiff')]
+    args += ["--pdb_path", input_file]
+    args += ["--contig", residues]
+    args += ["--num_seqs", str(number_sequences)]
+    args += ["--out_file", output_file]
+    args += ["--prefix", prefix]
+    args += ["--seed", str(seed)]
+    args += ["--model", model_name]
+
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.key(
+            'evodiff',
+            input_files=[input_file],
+            params={'residues': residues, 'number_sequences': number_sequences, 'seed': seed,
+                    'model_name': model_name, 'prefix': prefix, 'output': os.path.basename(output_file)}
+        )
+
+    return _run_call(args, "EvoDiff", timeout, cache, cache_key, os.path.dirname(output_file) or '.',
+                     outputs=[os.path.basename(output_file)])
 
-    # Request the PDB file
-    response = requests.get(url)
 
-    if response.status_code == 200:
-        # Write the content to the PDB file
-        with open(pdb_file_path, 'wb') as f:
-            f.write(response.content)
-        print(f"PDB file {pdb_code.upper()} downloaded successfully to {pdb_file_path}")
-    else:
-        print(f"Failed to download PDB file {pdb_code.upper()}. Status code: {response.status_code}")
+def download_pdb(pdb_code, target_directory='./work_flow/native_proteins'):
+    # Downloads go through the shared session of pdb_fetch, a file already on disk is reused
+    try:
+        return pdb_fetch.download_pdb(pdb_code, target_directory)
+    except pdb_fetch.PDBFetchError as err:
+        print(err)
 
 
 def extract_scores(ref_protein, generated_protein): #it takes as inputs the path of the two pdb files
@@ -149,7 +248,7 @@ def extract_scores(ref_protein, generated_protein): #it takes as inputs the path
     generated_protein_abs = os.path.abspath(generated_protein)
 
     # Run the TMalign command
-    tmalign_command = ["./TMalign", ref_protein_abs, generated_protein_abs]
+    tmalign_command = [tool_path('tmalign'), ref_protein_abs, generated_protein_abs]
     result = subprocess.run(tmalign_command, capture_output=True, text=True)
 
     if result.returncode == 0:
@@ -178,11 +277,36 @@ def extract_scores(ref_protein, generated_protein): #it takes as inputs the path
         print(result.stderr)
         return None
 
+# The stage outputs are laid out by artifact_store.py, work_flow/designs/<name>/<design>/<stage>.
+# The outputs of runs made before, in one folder per stage and target, are still found.
+def _artifact_or_legacy(path, legacy_path):
+    if not os.path.exists(path) and os.path.exists(legacy_path):
+        return legacy_path
+    return path
+
+
+# RFdiffusion backbone of one design, see stage_rfdiffusion
+def backbone_path(name, design=0):
+    return _artifact_or_legacy(get_store().path(name, design, 'rfdiffusion', f"{name}_scaffold_{design}.pdb"),
+                               f"./work_flow/RFdiffusion_output/{name}/{name}_scaffold_{design}.pdb")
+
+
 #we will need this function to isolate the correct pdb file from the files that omegafold will give as output
-def find_score_file(pdb_code):
+def find_score_file(pdb_code, design=0, sample=1):
+    # Structure of one MPNN sequence of one design, see stage_omegafold
+    path = get_store().path(pdb_code, design, 'omegafold', f'{pdb_code}_{design}_{sample}.pdb')
+    if os.path.exists(path):
+        return path
+
     directory = f'./work_flow/omegafold_output/{pdb_code}'
-    score_file_prefix = f'{pdb_code}_score'
+    path = os.path.join(directory, f'{pdb_code}_{design}_{sample}.pdb')
+    if os.path.exists(path):
+        return path
+    if not os.path.isdir(directory):
+        return None
 
+    # Outputs of runs made before the sequences were folded one by one
+    score_file_prefix = f'{pdb_code}_score'
     for filename in os.listdir(directory):
         if filename.startswith(score_file_prefix):
             return os.path.join(directory, filename)
@@ -190,10 +314,81 @@ def find_score_file(pdb_code):
     return None
 
 
-# Main pipeline (RFdiffusion using PDB code + ProteinMPNN + OmegaFold)
-def process_protein(pdb_code, residues_input):
-
-    tic = time.time()
+# Records of a FASTA file as (header, sequence) tuples
+def read_fasta(path):
+    records = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                records.append([line[1:], ''])
+            elif line and records:
+                records[-1][1] += line
+    return [tuple(record) for record in records]
+
+
+# Sequences designed by ProteinMPNN, from the .fa file of one backbone
+# The first record is the input backbone itself, the others are the samples, with headers like
+# "T=0.1, sample=1, score=0.9, global_score=0.9, seq_recovery=0.05"
+def read_mpnn_sequences(fasta_path):
+    sequences = []
+    for header, sequence in read_fasta(fasta_path)[1:]:
+        fields = dict(re.findall(r"(\w+)=([^,]+)", header))
+        sequences.append({
+            'sample': int(fields.get('sample', len(sequences) + 1)),
+            'sequence': sequence,
+            'mpnn_score': float(fields['score']) if 'score' in fields else None,
+            'header': header
+        })
+    return sequences
+
+
+# Sequence generated by EvoDiff, from the .fa file of one design
+# The header is like "7SH6_evodiff_0, layout=[12-12/A157-163/31-31], seed=0", the layout
+# giving the motif positions in the sequence
+def read_evodiff_sequence(fasta_path):
+    header, sequence = read_fasta(fasta_path)[0]
+    fields = dict(re.findall(r"(\w+)=([^,]+)", header))
+    return {'sample': 1, 'sequence': sequence, 'layout': fields.get('layout'), 'header': header}
+
+
+# The pipeline is split in stages so that several targets and designs can be in flight at
+# once. Every stage works on the folders of one target, named after the pdb code unless a
+# different name is given (e.g. same PDB, other contig). RFdiffusion makes number_proteins
+# backbones (designs) per target, ProteinMPNN designs num_seq_per_target sequences (samples)
+# per backbone, and every sequence is folded by OmegaFold and scored against its backbone.
+# When a WorkflowIndex is given, a stage that already finished with the same inputs and
+# parameters is skipped, so an interrupted run resumes where it stopped.
+
+# Run a stage unless the index says it is already done, run_stage returns the output file
+def _indexed_stage(index, name, stage, params, run_stage, design=0):
+    if index is not None and index.is_complete(name, stage, design, params=params):
+        print(f"[{name}] {stage} {design} already done, skipping")
+        return index.get(name, stage, design)['path']
+
+    if index is not None:
+        index.start(name, stage, design, params=params)
+    try:
+        output_path = run_stage()
+        if output_path is None or not os.path.exists(output_path):
+            raise RuntimeError(f"{stage} did not create its output file for {name} {design}")
+    except Exception:
+        if index is not None:
+            index.fail(name, stage, design, params=params)
+        raise
+
+    if index is not None:
+        index.record(name, stage, output_path, design=design, params=params)
+    return output_path
+
+
+# Stage 1: download the native protein and run RFdiffusion on it, returns the paths of the designs
+# options are extra run_rfdiffusion arguments (guide_scale, guiding_potentials, model_weights, ...)
+# With first_design, the designs first_design .. first_design + number_proteins - 1 are made,
+# to add designs to a target that already has the earlier ones (see sweep.py).
+def stage_rfdiffusion(pdb_code, residues_input, name=None, number_proteins=1, cache=None, index=None,
+                      first_design=0, **options):
+    name = name or pdb_code
 
     download_pdb(pdb_code)
     # Ensure the pdb_code is in uppercase
@@ -201,70 +396,296 @@ def process_protein(pdb_code, residues_input):
 
     # Construct the input and output paths
     RF_input = f"./work_flow/native_proteins/{pdb_code_upper}.pdb"
-    RF_output = f"./work_flow/RFdiffusion_output/{pdb_code}/{pdb_code}_scaffold"
+    numbers = range(first_design, first_design + number_proteins)
+    designs = [backbone_path(name, design) for design in numbers]
 
     # Check if the input file exists
     if not os.path.exists(RF_input):
         raise ValueError(f"Input file {RF_input} does not exist")
 
-    # Run RFdiffusion
-    run_rfdiffusion(
-        input_file=RF_input,
-        output_dir_and_prefix=RF_output,
-        number_proteins=1,
-        residues=residues_input
-    )
-
-    # Run ProteinMPNN
-    run_protein_mpnn(
-        input_file=f"./work_flow/RFdiffusion_output/{pdb_code}/{pdb_code}_scaffold_0.pdb",
-        output_dir=f"./work_flow/mpnn_output/{pdb_code}",
-        num_seq_per_target=1,
-        sampling_temp="0.1",
-        seed=0,
-        batch_size=1,
-        model_name="v_48_020"
-    )
-
-    # Run OmegaFold
-    run_omegafold(
-        input_file=f"./work_flow/mpnn_output/{pdb_code}/seqs/{pdb_code}_scaffold_0.fa",
-        output_file=f"./work_flow/omegafold_output/{pdb_code}"
-    )
-
-    #now we change the names in the omegafold folder such that in the name there is information about the score:
-    #we perform this task in 4 steps
-    # 1. Define the folder containing the .pdb files
-    folder_path = f'./work_flow/omegafold_output/{pdb_code}'
-
-    # 2. List all files in the folder
-    files = os.listdir(folder_path)
-
-    # 3. Define a regular expression to extract the relevant parts of the filename
-    pattern = re.compile(r"([a-zA-Z0-9]+)_.*score=([\d.]+)")
-
-    # 4. Process each file
-    for filename in files:
-       if filename.endswith('.pdb'):
-           match = pattern.search(filename)
-           if match:
-                alphanumeric_part = match.group(1)
-                score_part = match.group(2)
-                new_filename = f"{alphanumeric_part}_score_{score_part}.pdb"
-                old_file = os.path.join(folder_path, filename)
-                new_file = os.path.join(folder_path, new_filename)
-                os.rename(old_file, new_file)
-                print(f"Renamed '{filename}' to '{new_filename}'")
-
-
-    #now let's print the metrics between the output of the first and third steps of the pipeline
-    output_first_step=f'./work_flow/RFdiffusion_output/{pdb_code}/{pdb_code}_scaffold_0.pdb'
-    output_third_step=find_score_file(pdb_code)
+    params = {'input': file_checksum(RF_input), 'residues': residues_input, 'number_proteins': number_proteins}
+    # Only the options that are set, so runs without them keep their index entries
+    params.update({key: value for key, value in options.items() if value is not None})
+    if first_design:
+        params['first_design'] = first_design
+    if index is not None and all(index.is_complete(name, 'rfdiffusion', design, params=params)
+                                 for design in numbers) and all(map(os.path.exists, designs)):
+        print(f"[{name}] rfdiffusion already done, skipping")
+        return designs
+
+    store = get_store()
+    try:
+        # RFdiffusion writes into a staging folder, the designs are moved into place once all exist
+        with store.staging(name, 'rfdiffusion') as staging:
+            # Run RFdiffusion, all the designs of a target in one call so the weights are loaded once
+            run_rfdiffusion(
+                input_file=RF_input,
+                output_dir_and_prefix=os.path.join(staging, f"{name}_scaffold"),
+                number_proteins=number_proteins,
+                residues=residues_input,
+                design_startnum=first_design,
+                cache=cache,
+                **options
+            )
+            missing = [f"{name}_scaffold_{design}.pdb" for design in numbers
+                       if not os.path.exists(os.path.join(staging, f"{name}_scaffold_{design}.pdb"))]
+            if missing:
+                raise RuntimeError(f"rfdiffusion did not create {', '.join(missing)}")
+
+            designs = []
+            for design in numbers:
+                # The .trb (motif positions) first, so a design never exists without it
+                trb = os.path.join(staging, f"{name}_scaffold_{design}.trb")
+                if os.path.exists(trb):
+                    store.commit(trb, name, design, 'rfdiffusion')
+                designs.append(store.commit(os.path.join(staging, f"{name}_scaffold_{design}.pdb"),
+                                            name, design, 'rfdiffusion'))
+    except Exception:
+        if index is not None:
+            for design in numbers:
+                index.fail(name, 'rfdiffusion', design, params=params)
+        raise
+
+    if index is not None:
+        for design, path in zip(numbers, designs):
+            index.record(name, 'rfdiffusion', path, design=design, params=params)
+    return designs
+
+
+# Stage 2: design sequences for one RFdiffusion backbone with ProteinMPNN, returns the .fa file
+def stage_protein_mpnn(name, design=0, num_seq_per_target=1, sampling_temp="0.1", seed=0,
+                       cache=None, index=None):
+    input_file = backbone_path(name, design)
+    store = get_store()
+
+    def run_stage():
+        with store.staging(name, 'protein_mpnn') as staging:
+            run_protein_mpnn(
+                input_file=input_file,
+                output_dir=staging,
+                num_seq_per_target=num_seq_per_target,
+                sampling_temp=sampling_temp,
+                seed=seed,
+                batch_size=1,
+                model_name="v_48_020",
+                cache=cache
+            )
+            fasta = os.path.join(staging, 'seqs', f"{name}_scaffold_{design}.fa")
+            return store.commit(fasta, name, design, 'protein_mpnn') if os.path.exists(fasta) else None
+
+    params = {'input': file_checksum(input_file), 'num_seq_per_target': num_seq_per_target,
+              'sampling_temp': sampling_temp, 'seed': seed, 'model_name': "v_48_020"}
+    return _indexed_stage(index, name, 'protein_mpnn', params, run_stage, design)
+
+
+# Stage 3: fold one designed sequence with OmegaFold, returns the structure
+# The sequence gets its own FASTA file with a header "{name}_{design}_{sample}", which is also
+# the name OmegaFold gives to the structure, so no renaming is needed afterwards.
+def stage_omegafold(name, sequence, design=0, sample=1, cache=None, index=None):
+    record = f"{name}_{design}_{sample}"
+    store = get_store()
+
+    def run_stage():
+        with store.staging(name, 'omegafold') as staging:
+            input_file = os.path.join(staging, f"{record}.fa")
+            with open(input_file, 'w') as f:
+                f.write(f">{record}\n{sequence}\n")
+            run_omegafold(
+                input_file=input_file,
+                output_file=os.path.join(staging, 'output'),
+                cache=cache
+            )
+            model = os.path.join(staging, 'output', f"{record}.pdb")
+            return store.commit(model, name, design, 'omegafold') if os.path.exists(model) else None
+
+    params = {'sequence': sequence}
+    return _indexed_stage(index, name, 'omegafold', params, run_stage, f"{design}_{sample}")
+
+
+# Stage 4: metrics between the backbone (first step) and the folded sequence (third step)
+# Scored in-process (see structural_scoring.py), or with the TMalign binary if use_tmalign
+def stage_score(name, design=0, sample=1, index=None, use_tmalign=False):
+    output_first_step=backbone_path(name, design)
+    output_third_step=find_score_file(name, design, sample)
+
+    params = None
+    if index is not None:
+        params = {'reference': file_checksum(output_first_step), 'model': file_checksum(output_third_step),
+                  'scorer': 'tmalign' if use_tmalign else 'numpy'}
+        if index.is_complete(name, 'score', f"{design}_{sample}", params=params):
+            return tuple(index.get(name, 'score', f"{design}_{sample}")['metrics'])
+
+    if use_tmalign:
+        scores = extract_scores(output_first_step, output_third_step)
+    else:
+        # numpy is only imported by the runs that score in-process
+        from structural_scoring import score_pair
+        scores = score_pair(output_first_step, output_third_step)
+
+    if index is not None and scores is not None:
+        index.record(name, 'score', None, design=f"{design}_{sample}", params=params, metrics=list(scores))
+    return scores
+
+
+# Stage 1 of the EvoDiff route: motif-scaffolding sequences, returns the .fa file of every design
+# There is no backbone, every sequence is a design of its own (with a single sample) and goes
+# straight to OmegaFold. All the sequences of a target come from one call, the model is loaded once.
+def stage_evodiff(pdb_code, residues_input, name=None, number_sequences=1, seed=0, model_name="oa_dm_38m",
+                  cache=None, index=None):
+    name = name or pdb_code
+
+    download_pdb(pdb_code)
+    EvoDiff_input = f"./work_flow/native_proteins/{pdb_code.upper()}.pdb"
+    store = get_store()
+    designs = [store.path(name, design, 'evodiff', f"{name}_{design}.fa") for design in range(number_sequences)]
+
+    if not os.path.exists(EvoDiff_input):
+        raise ValueError(f"Input file {EvoDiff_input} does not exist")
+
+    params = {'input': file_checksum(EvoDiff_input), 'residues': residues_input,
+              'number_sequences': number_sequences, 'seed': seed, 'model_name': model_name}
+    if index is not None and all(index.is_complete(name, 'evodiff', design, params=params)
+                                 for design in range(number_sequences)) and all(map(os.path.exists, designs)):
+        print(f"[{name}] evodiff already done, skipping")
+        return designs
+
+    try:
+        with store.staging(name, 'evodiff') as staging:
+            output_file = os.path.join(staging, f"{name}_evodiff.fa")
+            run_evodiff(EvoDiff_input, output_file, residues_input, number_sequences, seed, model_name,
+                        prefix=name, cache=cache)
+            records = read_fasta(output_file) if os.path.exists(output_file) else []
+            if len(records) < number_sequences:
+                raise RuntimeError(f"evodiff made {len(records)} of {number_sequences} sequences")
+            # One file per design, next to the structures folded from it
+            designs = [store.write(name, design, 'evodiff', f"{name}_{design}.fa", f">{header}\n{sequence}\n")
+                       for design, (header, sequence) in enumerate(records[:number_sequences])]
+    except Exception:
+        if index is not None:
+            for design in range(number_sequences):
+                index.fail(name, 'evodiff', design, params=params)
+        raise
+
+    if index is not None:
+        for design, path in enumerate(designs):
+            index.record(name, 'evodiff', path, design=design, params=params)
+    return designs
+
+
+# Last stage of the EvoDiff route: the motif residues of the folded sequence against the native
+# motif (positions from the layout), there is no backbone to compare the structure to.
+# Same (tm_score_1, tm_score_2, rmsd) form as stage_score, both TM-scores being the motif one.
+def stage_motif_score(name, pdb_code, layout, design=0, sample=1, index=None):
+    native = f"./work_flow/native_proteins/{pdb_code.upper()}.pdb"
+    model = find_score_file(name, design, sample)
+
+    params = None
+    if index is not None:
+        params = {'reference': file_checksum(native), 'model': file_checksum(model), 'layout': layout}
+        if index.is_complete(name, 'motif_score', f"{design}_{sample}", params=params):
+            return tuple(index.get(name, 'motif_score', f"{design}_{sample}")['metrics'])
+
+    from design_filters import motif_scores
+    scores = motif_scores(model, native, layout)
+
+    if index is not None and scores is not None:
+        index.record(name, 'motif_score', None, design=f"{design}_{sample}", params=params, metrics=list(scores))
+    return scores
+
+
+# Stages of the default (rfdiffusion) route and their default number of workers when the designs
+# of a target fan out, see stages.py for the other routes.
+# RFdiffusion, ProteinMPNN and OmegaFold share the GPU, scoring is CPU only.
+STAGES = ['rfdiffusion', 'protein_mpnn', 'omegafold', 'score']
+# run_rfdiffusion arguments a target of stream_targets can set
+RFDIFFUSION_OPTIONS = ['guide_scale', 'guiding_potentials', 'model_weights', 'substrate_name', 'contig_length']
+DEFAULT_WORKERS = {'rfdiffusion': 1, 'protein_mpnn': 1, 'omegafold': 1, 'score': 2}
+
+
+def stream_targets(targets, number_proteins=1, num_seq_per_target=1, sampling_temp="0.1",
+                   workers=None, cache=None, index=None, use_tmalign=False,
+                   fold_batch_size=1, fold_batch_wait=30.0, report=None, scheduler=None, filters=None,
+                   store=None, routes=None):
+    """
+    Run targets (dicts with pdb_code, contig and name) through the pipeline, every design
+    and every MPNN sequence separately, with a bounded number of workers per stage.
+    A target can override number_proteins, num_seq_per_target and sampling_temp with keys of the
+    same name, and set the RFDIFFUSION_OPTIONS (e.g. guide_scale, model_weights) of its run.
+    With a first_design key, the designs of the target are numbered from it (see stage_rfdiffusion).
+    With fold_batch_size > 1, up to fold_batch_size pending sequences (waiting at most
+    fold_batch_wait seconds for them) are folded together in length buckets, see omegafold_batch.py.
+    Every stage run is measured in report (a RunReport), if given.
+    With a Scheduler, every stage run first waits for the GPU, cores and memory of its stage
+    (later stages and lower target priorities first), and its tools are pinned to them.
+    With DesignFilters (see design_filters.py), the backbones and sequences failing the
+    thresholds are not folded, they come out with status 'rejected' and the reason as error.
+    With a ResultsStore (see results_store.py), every result is written to it as it comes out.
+    routes are the stage chains every target goes through (see stages.py), default the
+    rfdiffusion route; with several (e.g. ['rfdiffusion', 'evodiff']) they run concurrently.
+    Yields one dict per folded sequence as soon as it is scored, with the target, route, design,
+    sample, sequence, mpnn_score, paths, tm_score_1, tm_score_2, rmsd and status.
+    """
+    from stages import DEFAULT_ROUTE, StageContext, run_routes
+
+    # Malformed contigs are reported before any job starts (the residues are checked against
+    # the input structure in run_rfdiffusion, once it is downloaded)
+    targets = list(targets)
+    for target in targets:
+        parse_contig(target['contig'])
+
+    context = StageContext(cache=cache, index=index, report=report or NullReport(), filters=filters,
+                           use_tmalign=use_tmalign,
+                           defaults={'number_proteins': number_proteins, 'num_seq_per_target': num_seq_per_target,
+                                     'sampling_temp': sampling_temp})
+    for result in run_routes(targets, routes or [DEFAULT_ROUTE], context, workers, scheduler,
+                             fold_batch_size, fold_batch_wait):
+        if store is not None:
+            store.add(result)
+        yield result
+
+
+def stream_protein(pdb_code, residues_input, name=None, **kwargs):
+    """stream_targets for a single target, see process_protein."""
+    target = {'pdb_code': pdb_code, 'contig': residues_input, 'name': name or pdb_code}
+    yield from stream_targets([target], **kwargs)
+
+
+# Main pipeline (RFdiffusion using PDB code + ProteinMPNN + OmegaFold)
+# Makes number_proteins backbones, num_seq_per_target sequences per backbone, folds and scores
+# all of them, and returns one dict per sequence (see stream_targets). Use stream_protein to
+# get the results while the other designs are still running.
+# Pass a ResultCache to skip the tool runs that were already done with the same inputs.
+# By default the stages recorded as done in work_flow/index.sqlite are not run again,
+# pass resume=False to run everything.
+# The time, CPU and memory of every stage run are written to a run report in work_flow/reports
+# (see run_report.py for the summary), and the results to work_flow/results.sqlite (see
+# results_store.py for the queries).
+# routes=['rfdiffusion', 'evodiff'] also runs the EvoDiff route on the target, see stages.py.
+def process_protein(pdb_code, residues_input, number_proteins=1, num_seq_per_target=1,
+                    cache=None, index=None, resume=True, workers=None, report=None, store=None, routes=None):
+
+    tic = time.time()
+
+    if index is None and resume:
+        index = WorkflowIndex()
+    if report is None:
+        report = RunReport()
+    if store is None:
+        store = ResultsStore()
+
+    results = []
+    for result in stream_protein(pdb_code, residues_input, number_proteins=number_proteins,
+                                 num_seq_per_target=num_seq_per_target, workers=workers,
+                                 cache=cache, index=index, report=report, store=store, routes=routes):
+        print(f"[{pdb_code}] design {result.get('design')} sequence {result.get('sample')}: {result['status']}")
+        results.append(result)
 
     toc = time.time()
-    print("It took {:.2f} minutes to run RFdiffusion + ProteinMPNN + OmegaFold".format((toc - tic)/60))
+    print("It took {:.2f} minutes to run {}".format((toc - tic)/60, ' and '.join(routes) if routes
+                                                   else "RFdiffusion + ProteinMPNN + OmegaFold"))
+    print(f"Stage timings written to {report.path}, see python run_report.py {report.path}")
 
-    return extract_scores(output_first_step, output_third_step)
+    return results
 
 # TM and LM score metric to determine quality of newly designed protein and compare it from native protein
 def visual_comparison(ref_protein, generated_protein): #it takes as inputs the path of the two pdb files
@@ -272,7 +693,7 @@ def visual_comparison(ref_protein, generated_protein): #it takes as inputs the p
     generated_protein_abs = os.path.abspath(generated_protein)
 
     # Run the TMalign command
-    tmalign_command = ["./TMalign", ref_protein_abs, generated_protein_abs]
+    tmalign_command = [tool_path('tmalign'), ref_protein_abs, generated_protein_abs]
     result = subprocess.run(tmalign_command, capture_output=True, text=True)
 
     if result.returncode == 0:
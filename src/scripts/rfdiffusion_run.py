@@ -1,13 +1,18 @@
 import os
+from pipeline_config import root_dir as configured_root_dir
 from rfdiffusion_pipeline import process_protein, setup_folder, visual_comparison, find_score_file
 
-root_dir = "/home/ubuntu"
+# Folder with the tools and work_flow, a shared folder when running on several hosts (see sharded_run.py)
+# Set by RFDIFFUSION_ROOT or pipeline_config.json, see pipeline_config.py (default: the current folder)
+root_dir = configured_root_dir()
 os.chdir(root_dir)
 setup_folder(root_dir)
 
 # user must change below: (1) PDB code & (2) amino acid positions
-result=process_protein('7SH6', "[20-30/157-163/20-40/157-163/20-30]")
-print(result)
+# number_proteins RFdiffusion designs, num_seq_per_target ProteinMPNN sequences per design
+results=process_protein('7SH6', "[20-30/157-163/20-40/157-163/20-30]", number_proteins=1, num_seq_per_target=1)
+for result in results:
+    print(result.get('design'), result.get('sample'), result['status'], result.get('tm_score_1'), result.get('tm_score_2'), result.get('rmsd'))
 
 # user must change PDB code below to match the PDB code above
 pdb_code_native='7SH6'
@@ -0,0 +1,217 @@
+# Per-stage instrumentation of pipeline runs
+# Every stage run (one RFdiffusion target, one ProteinMPNN design, one OmegaFold sequence,
+# one scoring) is written as one JSON line to work_flow/reports/run_<time>.jsonl with its
+# wall time, CPU time, peak memory, bytes written and status. The tools started by the stage
+# (see job_runner / model_server) add their own CPU time and peak memory to it.
+#
+# Usage (summary of the latest run, or of the given reports):
+#   python run_report.py
+#   python run_report.py work_flow/reports/run_20240101-120000.jsonl --by-length 50
+#   python run_report.py --parquet report.parquet   # needs pandas and pyarrow
+import argparse
+import glob
+import json
+import os
+import resource
+import threading
+import time
+
+DEFAULT_REPORT_DIR = './work_flow/reports'
+
+# Stage record of the current thread, so jobs started by a stage are added to it
+_local = threading.local()
+
+
+class StageRecord:
+    """Measures one stage run, use it as a context manager (see RunReport.stage)."""
+
+    def __init__(self, report, target, stage, design=None, **fields):
+        self.report = report
+        self.fields = {'target': target, 'stage': stage, 'design': design, **fields}
+        self.jobs = []
+        self.bytes_written = 0
+
+    def add_job(self, result):
+        """Add the JobResult of a tool run by the stage."""
+        self.jobs.append(result)
+
+    def set(self, **fields):
+        """Add fields to the record, e.g. the length of the design."""
+        self.fields.update(fields)
+
+    def add_outputs(self, paths):
+        """Add the sizes of the files written by the stage."""
+        for path in paths:
+            if path and os.path.exists(path):
+                self.bytes_written += os.path.getsize(path)
+
+    def __enter__(self):
+        self._previous = getattr(_local, 'record', None)
+        _local.record = self
+        self._start = time.time()
+        self._thread_cpu = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _local.record = self._previous
+        # The stage's own CPU time (e.g. scoring in-process) plus the CPU time of its jobs
+        cpu_time = time.thread_time() - self._thread_cpu
+        cpu_time += sum(job.user_time + job.system_time for job in self.jobs)
+        if self.jobs:
+            peak_rss_mb = max(job.peak_rss_mb for job in self.jobs)
+        else:
+            peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+        self.report.write({
+            **self.fields,
+            'start': self._start,
+            'wall_time': time.time() - self._start,
+            'cpu_time': cpu_time,
+            'peak_rss_mb': peak_rss_mb,
+            'bytes_written': self.bytes_written,
+            'jobs': len(self.jobs),
+            # Time spent in the tools, the rest of wall_time is the pipeline's own overhead
+            'job_wall_time': sum(job.wall_time for job in self.jobs),
+            'status': 'failed' if exc_type is not None else 'done',
+            'error': str(exc) if exc is not None else None,
+        })
+        # Exceptions are recorded, not swallowed
+        return False
+
+
+class RunReport:
+    """JSONL file with one record per stage run, shared by all the workers of a run."""
+
+    def __init__(self, path=None, report_dir=DEFAULT_REPORT_DIR):
+        if path is None:
+            path = os.path.join(report_dir, f"run_{time.strftime('%Y%m%d-%H%M%S')}.jsonl")
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.run_id = os.path.splitext(os.path.basename(path))[0]
+        self._lock = threading.Lock()
+
+    def stage(self, target, stage, design=None, **fields):
+        return StageRecord(self, target, stage, design, **fields)
+
+    def write(self, record):
+        line = json.dumps({'run_id': self.run_id, **record}, default=str)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+
+class NullReport(RunReport):
+    """Report that measures but writes nothing, used when no report is wanted."""
+
+    def __init__(self):
+        self.path = None
+        self.run_id = None
+
+    def write(self, record):
+        pass
+
+
+def add_job(result):
+    """Add a JobResult to the stage record of the current thread, if there is one."""
+    record = getattr(_local, 'record', None)
+    if record is not None:
+        record.add_job(result)
+
+
+def load_reports(paths):
+    records = []
+    for path in paths:
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def percentile(values, q):
+    """q-th percentile (0-100) with linear interpolation."""
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(records, by_length=None):
+    """Print p50/p95 per stage and the throughput of the run(s)."""
+    stages = []
+    for record in records:
+        if record['stage'] not in stages:
+            stages.append(record['stage'])
+
+    print(f"{'stage':<14}{'runs':>6}{'failed':>8}{'wall p50':>10}{'wall p95':>10}"
+          f"{'cpu p50':>10}{'peak MB':>10}{'MB written':>12}")
+    for stage in stages:
+        stage_records = [record for record in records if record['stage'] == stage]
+        done = [record for record in stage_records if record['status'] == 'done']
+        wall = [record['wall_time'] for record in done]
+        cpu = [record['cpu_time'] for record in done]
+        print(f"{stage:<14}{len(stage_records):>6}{len(stage_records) - len(done):>8}"
+              f"{percentile(wall, 50):>10.1f}{percentile(wall, 95):>10.1f}{percentile(cpu, 50):>10.1f}"
+              f"{max((record['peak_rss_mb'] for record in done), default=0):>10.0f}"
+              f"{sum(record['bytes_written'] for record in stage_records) / 1024 ** 2:>12.1f}")
+
+    if records:
+        elapsed = max(record['start'] + record['wall_time'] for record in records) - min(record['start'] for record in records)
+        hours = max(elapsed, 1e-9) / 3600
+        # Designs come from the generator stages of every route, scores from its scorer stages
+        # (imported here, stages.py imports this module)
+        from stages import PLUGINS
+        kinds = {stage: plugin.kind for stage, plugin in PLUGINS.items()}
+        done = [record for record in records if record['status'] == 'done']
+        designs = sum(record.get('designs', 1) for record in done if kinds.get(record['stage']) == 'generator')
+        sequences = sum(1 for record in done if kinds.get(record['stage']) == 'scorer')
+        print(f"\n{elapsed / 60:.1f} minutes: {designs / hours:.1f} designs/hour, "
+              f"{sequences / hours:.1f} scored sequences/hour")
+
+    if by_length:
+        # Median wall time per stage for designs of similar length
+        print(f"\nMedian wall time (s) by length (bins of {by_length} residues)")
+        for stage in stages:
+            bins = {}
+            for record in records:
+                if record['stage'] == stage and record['status'] == 'done' and record.get('length'):
+                    bins.setdefault(record['length'] // by_length * by_length, []).append(record['wall_time'])
+            if bins:
+                print(f"{stage:<14}" + '  '.join(f"{low}-{low + by_length - 1}: {percentile(times, 50):.1f}"
+                                                 for low, times in sorted(bins.items())))
+
+
+def to_parquet(records, path):
+    try:
+        import pandas as pd
+    except ImportError:
+        raise ImportError("Writing Parquet needs pandas and pyarrow: pip install pandas pyarrow")
+    pd.DataFrame.from_records(records).to_parquet(path, index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summary of pipeline run reports")
+    parser.add_argument('reports', nargs='*', help="Report files (default: the latest in work_flow/reports)")
+    parser.add_argument('--report-dir', default=DEFAULT_REPORT_DIR)
+    parser.add_argument('--by-length', type=int, default=None, metavar='BIN',
+                        help="Also show the median wall time per stage by design length")
+    parser.add_argument('--parquet', default=None, help="Also write the records to this Parquet file")
+    args = parser.parse_args()
+
+    paths = args.reports
+    if not paths:
+        paths = sorted(glob.glob(os.path.join(args.report_dir, 'run_*.jsonl')))[-1:]
+    if not paths:
+        raise SystemExit(f"No reports in {args.report_dir}")
+
+    records = load_reports(paths)
+    print(f"{len(records)} stage runs in {', '.join(paths)}\n")
+    summarize(records, args.by_length)
+    if args.parquet:
+        to_parquet(records, args.parquet)
+        print(f"Records written to {args.parquet}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+# Resource-aware scheduling of the pipeline jobs
+# Every stage declares what one of its jobs needs (GPU slots, CPU cores, memory). A job waits
+# in a priority queue until its resources are free on this machine; it then gets GPU ids and
+# cores, and the tools it launches see only its GPUs (CUDA_VISIBLE_DEVICES) and use only its
+# cores (OMP_NUM_THREADS). With backfill, a job that fits starts even if a higher-priority job
+# is waiting for a busy GPU, so CPU-only jobs (scoring, TMalign) keep running.
+#
+# The resources do not have to exist: Scheduler(gpus=4, cpus=16) on a laptop schedules as if
+# the machine had 4 GPUs, to test the policy and the throughput with stub executables:
+#   python scheduler.py --gpus 2 --cpus 8 --targets 8 --duration rfdiffusion=1.0,omegafold=0.5
+import argparse
+import bisect
+import contextlib
+import itertools
+import os
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+
+from job_runner import job_env, run_job
+from pipeline_engine import run_stages
+
+
+@dataclass(frozen=True)
+class Resources:
+    gpus: int = 0
+    cpus: int = 1
+    memory_gb: float = 0.0
+
+
+# Needs of one job of every stage
+STAGE_RESOURCES = {
+    'rfdiffusion': Resources(gpus=1, cpus=2, memory_gb=16),
+    'protein_mpnn': Resources(gpus=1, cpus=1, memory_gb=4),
+    'omegafold': Resources(gpus=1, cpus=2, memory_gb=16),
+    'score': Resources(gpus=0, cpus=1, memory_gb=1),
+}
+
+
+@dataclass
+class Allocation:
+    stage: str
+    gpu_ids: list
+    cpus: int
+    memory_gb: float
+
+    def env(self):
+        """Environment of the tools run with this allocation."""
+        return {'CUDA_VISIBLE_DEVICES': ','.join(str(gpu) for gpu in self.gpu_ids),
+                'OMP_NUM_THREADS': str(self.cpus)}
+
+
+@dataclass(order=True)
+class _Request:
+    priority: tuple
+    number: int
+    stage: str = field(compare=False)
+    need: Resources = field(compare=False)
+
+
+def detect_gpus():
+    """GPU ids of this machine, from CUDA_VISIBLE_DEVICES or nvidia-smi."""
+    visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+    if visible is not None:
+        return [gpu for gpu in visible.split(',') if gpu.strip()]
+    try:
+        output = subprocess.run(['nvidia-smi', '-L'], capture_output=True, text=True, timeout=10).stdout
+    except (OSError, subprocess.SubprocessError):
+        return []
+    return [str(i) for i, line in enumerate(output.splitlines()) if line.startswith('GPU')]
+
+
+def detect_memory_gb():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+    except (ValueError, OSError, AttributeError):
+        return float('inf')
+
+
+class Scheduler:
+    """
+    Hands out the GPUs, cores and memory of the machine to the stage jobs.
+    gpus is a number of GPUs or a list of GPU ids, None detects them (same for cpus and
+    memory_gb). Lower priorities start first, see acquire.
+    """
+
+    def __init__(self, gpus=None, cpus=None, memory_gb=None, stage_resources=None, backfill=True):
+        if gpus is None:
+            gpus = detect_gpus()
+        self.gpu_ids = [str(gpu) for gpu in (range(gpus) if isinstance(gpus, int) else gpus)]
+        self.cpus = cpus if cpus is not None else os.cpu_count()
+        self.memory_gb = memory_gb if memory_gb is not None else detect_memory_gb()
+        self.stage_resources = {**STAGE_RESOURCES, **(stage_resources or {})}
+        self.backfill = backfill
+
+        self._free_gpus = list(self.gpu_ids)
+        self._free_cpus = self.cpus
+        self._free_memory = self.memory_gb
+        self._waiting = []
+        self._numbers = itertools.count()
+        self._condition = threading.Condition()
+
+        # Statistics: per stage jobs, busy and waiting seconds, GPU-seconds used
+        self._start = time.time()
+        self.stats = {}
+        self._gpu_seconds = 0.0
+
+    def need(self, stage):
+        """Resources of one job of the stage, limited to what the machine has so it can always run."""
+        need = self.stage_resources.get(stage, Resources())
+        return Resources(min(need.gpus, len(self.gpu_ids)), min(need.cpus, self.cpus),
+                         min(need.memory_gb, self.memory_gb))
+
+    def capacity(self, stage):
+        """Number of jobs of the stage that fit on the machine at the same time."""
+        need = self.need(stage)
+        limits = [self.cpus // max(need.cpus, 1)]
+        if need.gpus:
+            limits.append(len(self.gpu_ids) // need.gpus)
+        if need.memory_gb:
+            limits.append(int(self.memory_gb // need.memory_gb))
+        return max(1, min(limits))
+
+    def _fits(self, need):
+        return (len(self._free_gpus) >= need.gpus and self._free_cpus >= need.cpus
+                and self._free_memory >= need.memory_gb)
+
+    def _can_start(self, request):
+        if not self._fits(request.need):
+            return False
+        for other in self._waiting:
+            if other is request:
+                return True
+            # A higher-priority request goes first if it fits too (or always, without backfill)
+            if not self.backfill or self._fits(other.need):
+                return False
+        return True
+
+    @contextlib.contextmanager
+    def acquire(self, stage, priority=0):
+        """
+        Wait until the resources of a stage job are free and hold them inside the block.
+        priority is a number or a tuple, lower first. The jobs launched in the block
+        (see job_runner) run with the CUDA_VISIBLE_DEVICES and OMP_NUM_THREADS of the allocation.
+        """
+        request = _Request(priority if isinstance(priority, tuple) else (priority,), next(self._numbers),
+                           stage, self.need(stage))
+        tic = time.time()
+        with self._condition:
+            bisect.insort(self._waiting, request)
+            while not self._can_start(request):
+                self._condition.wait()
+            self._waiting.remove(request)
+            gpu_ids = self._free_gpus[:request.need.gpus]
+            del self._free_gpus[:request.need.gpus]
+            self._free_cpus -= request.need.cpus
+            self._free_memory -= request.need.memory_gb
+            # Others may fit in what is left
+            self._condition.notify_all()
+
+        allocation = Allocation(stage, gpu_ids, request.need.cpus, request.need.memory_gb)
+        started = time.time()
+        try:
+            with job_env(allocation.env()):
+                yield allocation
+        finally:
+            with self._condition:
+                self._free_gpus.extend(gpu_ids)
+                self._free_cpus += request.need.cpus
+                self._free_memory += request.need.memory_gb
+                stats = self.stats.setdefault(stage, {'jobs': 0, 'busy': 0.0, 'waiting': 0.0})
+                stats['jobs'] += 1
+                stats['busy'] += time.time() - started
+                stats['waiting'] += started - tic
+                self._gpu_seconds += len(gpu_ids) * (time.time() - started)
+                self._condition.notify_all()
+
+    def summary(self):
+        """Jobs, busy and waiting time per stage, and the GPU utilization, as text."""
+        elapsed = time.time() - self._start
+        lines = [f"{'stage':<14}{'jobs':>6}{'busy s':>10}{'wait s':>10}"]
+        for stage, stats in self.stats.items():
+            lines.append(f"{stage:<14}{stats['jobs']:>6}{stats['busy']:>10.1f}{stats['waiting']:>10.1f}")
+        if self.gpu_ids:
+            lines.append(f"GPU utilization {self._gpu_seconds / (len(self.gpu_ids) * elapsed):.0%} "
+                         f"of {len(self.gpu_ids)} GPUs over {elapsed:.1f} s")
+        return "\n".join(lines)
+
+
+def stage_priority(stage, stages, item=None):
+    """Later stages first, so designs in flight finish before new ones start, then the target priority."""
+    return (-stages.index(stage), (item or {}).get('priority', 0))
+
+
+def _simulate(scheduler, targets, durations):
+    # Stand-in pipeline: every stage job is a subprocess sleeping for the duration of the stage
+    # and checking that it got its own GPU
+    stages = list(durations)
+    in_use = {}
+    lock = threading.Lock()
+    conflicts = []
+
+    def step(stage):
+        def run(item):
+            with scheduler.acquire(stage, stage_priority(stage, stages, item)) as allocation:
+                with lock:
+                    for gpu in allocation.gpu_ids:
+                        if in_use.get(gpu):
+                            conflicts.append((stage, gpu))
+                        in_use[gpu] = True
+                run_job([sys.executable, '-c', f"import time; time.sleep({durations[stage]})"],
+                        name=f"sim_{stage}", log_dir='./work_flow/logs/scheduler_sim')
+                with lock:
+                    for gpu in allocation.gpu_ids:
+                        in_use[gpu] = False
+            return [item]
+        return run
+
+    items = [{'name': f"target_{i}", 'priority': 0} for i in range(targets)]
+    tic = time.time()
+    results = list(run_stages(items, [(stage, step(stage), scheduler.capacity(stage)) for stage in stages]))
+    elapsed = time.time() - tic
+    done = sum(1 for result in results if result['status'] == 'done')
+    return elapsed, done, conflicts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the scheduling of the pipeline on fake resources")
+    parser.add_argument('--gpus', type=int, default=2)
+    parser.add_argument('--cpus', type=int, default=8)
+    parser.add_argument('--memory-gb', type=float, default=64)
+    parser.add_argument('--targets', type=int, default=8)
+    parser.add_argument('--duration', default='rfdiffusion=1.0,protein_mpnn=0.3,omegafold=0.6,score=0.2',
+                        help="Seconds per job of every stage, stage=seconds separated by commas")
+    parser.add_argument('--no-backfill', action='store_true')
+    args = parser.parse_args()
+
+    durations = {stage: float(seconds) for stage, seconds in
+                 (pair.split('=') for pair in args.duration.split(','))}
+    scheduler = Scheduler(args.gpus, args.cpus, args.memory_gb, backfill=not args.no_backfill)
+    elapsed, done, conflicts = _simulate(scheduler, args.targets, durations)
+
+    print(scheduler.summary())
+    print(f"{done} targets in {elapsed:.1f} s, {done / elapsed * 3600:.0f} targets/hour")
+    if conflicts:
+        print(f"{len(conflicts)} jobs got a GPU that was already in use: {conflicts}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+# Sharded execution of large screens on several hosts sharing one work_flow folder
+# The coordinator splits a target manifest into work units (files in work_flow/queue/pending).
+# Workers on any host that sees the shared folder (NFS, EFS, ...) take a unit by renaming its
+# file into work_flow/queue/leased (a rename is atomic, only one worker gets it), run its
+# targets with batch_pipeline.run_batch and move it to done. A worker renews its lease by
+# touching the file; a unit whose lease was not renewed for lease_seconds (crashed or stopped
+# worker) is put back in pending by the next worker or coordinator that looks, and given up
+# after max_attempts.
+#
+# SQLite must not be shared between hosts over NFS, so every worker has its own work_flow index
+# and artifact manifest (work_flow/index.<worker>.sqlite, artifacts.<worker>.sqlite, without
+# WAL). Before a unit, the worker takes the entries of its targets from the merged index and
+# adds the outputs already in the designs folder (e.g. made by a worker that crashed), so the
+# stages finished before are not run again. The coordinator merges the worker databases into
+# work_flow/index.sqlite and artifacts.sqlite once every unit is finished (--wait, or merge).
+#
+# File names carry the state: pending/<unit>~<attempt>.json, leased/<unit>~<attempt>@<worker>.json,
+# done/<unit>.json and failed/<unit>.json. The results of a unit are in results/<unit>.jsonl.
+#
+# Usage:
+#   python sharded_run.py coordinator targets.csv --root-dir /shared --shard-size 4
+#   python sharded_run.py worker --root-dir /shared            # on every host, any number of times
+#   python sharded_run.py status --root-dir /shared
+#   python sharded_run.py coordinator --wait --root-dir /shared   # requeue expired leases until all done, merge
+#   python sharded_run.py merge --root-dir /shared                # merge the worker indexes and manifests
+import argparse
+import glob
+import json
+import os
+import socket
+import threading
+import time
+
+import pipeline_config
+
+DEFAULT_LEASE_SECONDS = 600
+DEFAULT_MAX_ATTEMPTS = 3
+STATES = ('pending', 'leased', 'done', 'failed')
+
+
+def queue_dir(root_dir):
+    return os.path.join(root_dir, 'work_flow', 'queue')
+
+
+def _parse(filename):
+    # <unit>~<attempt>[@<worker>].json -> (unit, attempt, worker)
+    stem = filename[:-len('.json')]
+    stem, _, worker = stem.partition('@')
+    unit, _, attempt = stem.partition('~')
+    return unit, int(attempt or 0), worker or None
+
+
+def _units(root_dir, state):
+    folder = os.path.join(queue_dir(root_dir), state)
+    if not os.path.isdir(folder):
+        return []
+    return sorted(filename for filename in os.listdir(folder) if filename.endswith('.json'))
+
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def create_units(root_dir, targets, shard_size=1):
+    """Split the targets into units of shard_size targets, returns the number of new units."""
+    for state in STATES + ('results',):
+        os.makedirs(os.path.join(queue_dir(root_dir), state), exist_ok=True)
+
+    existing = {_parse(filename)[0] for state in STATES for filename in _units(root_dir, state)}
+    created = 0
+    for number, start in enumerate(range(0, len(targets), shard_size)):
+        unit = f"unit_{number:05d}"
+        if unit in existing:
+            # Coordinator started again on the same queue
+            continue
+        _write_atomic(os.path.join(queue_dir(root_dir), 'pending', f"{unit}~0.json"),
+                      json.dumps({'unit': unit, 'targets': targets[start:start + shard_size]}))
+        created += 1
+    return created
+
+
+def requeue_expired(root_dir, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """Put the units whose lease was not renewed in time back in pending (or in failed)."""
+    requeued = 0
+    leased_dir = os.path.join(queue_dir(root_dir), 'leased')
+    for filename in _units(root_dir, 'leased'):
+        path = os.path.join(leased_dir, filename)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        # The rename of the lease changes ctime, the renewals change mtime
+        if time.time() - max(stat.st_mtime, stat.st_ctime) < lease_seconds:
+            continue
+
+        unit, attempt, worker = _parse(filename)
+        if attempt + 1 >= max_attempts:
+            target = os.path.join(queue_dir(root_dir), 'failed', f"{unit}.json")
+        else:
+            target = os.path.join(queue_dir(root_dir), 'pending', f"{unit}~{attempt + 1}.json")
+        try:
+            os.rename(path, target)
+        except FileNotFoundError:
+            # Finished or requeued by someone else in the meantime
+            continue
+        print(f"Lease of {unit} by {worker} expired, {'given up' if 'failed' in target else 'requeued'}")
+        requeued += 1
+    return requeued
+
+
+class Lease:
+    """A unit taken by a worker, renewed in the background until it is released."""
+
+    def __init__(self, root_dir, filename, worker, lease_seconds):
+        self.root_dir = root_dir
+        self.unit, self.attempt, _ = _parse(filename)
+        self.path = os.path.join(queue_dir(root_dir), 'leased', f"{self.unit}~{self.attempt}@{worker}.json")
+        self.lost = False
+        with open(self.path) as f:
+            self.targets = json.load(f)['targets']
+
+        self._stop = threading.Event()
+        self._renewer = threading.Thread(target=self._renew, args=(lease_seconds / 3,), daemon=True)
+        self._renewer.start()
+
+    def _renew(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                # Requeued after a missed renewal, another worker may run the unit too
+                self.lost = True
+                print(f"Lease of {self.unit} lost")
+                return
+
+    def release(self, state, results=None):
+        """
+        Stop renewing and move the unit to done or failed with its results, or back to
+        pending for another attempt.
+        """
+        self._stop.set()
+        self._renewer.join()
+        if results is not None:
+            _write_atomic(os.path.join(queue_dir(self.root_dir), 'results', f"{self.unit}.jsonl"),
+                          ''.join(json.dumps(result, default=str) + '\n' for result in results))
+        filename = f"{self.unit}~{self.attempt + 1}.json" if state == 'pending' else f"{self.unit}.json"
+        try:
+            os.rename(self.path, os.path.join(queue_dir(self.root_dir), state, filename))
+        except FileNotFoundError:
+            self.lost = True
+
+
+def take_unit(root_dir, worker, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """Lease the first pending unit, or return None if there is none."""
+    pending_dir = os.path.join(queue_dir(root_dir), 'pending')
+    for filename in _units(root_dir, 'pending'):
+        unit, attempt, _ = _parse(filename)
+        leased = os.path.join(queue_dir(root_dir), 'leased', f"{unit}~{attempt}@{worker}.json")
+        try:
+            os.rename(os.path.join(pending_dir, filename), leased)
+        except FileNotFoundError:
+            # Taken by another worker
+            continue
+        return Lease(root_dir, filename, worker, lease_seconds)
+    return None
+
+
+def counts(root_dir):
+    return {state: len(_units(root_dir, state)) for state in STATES}
+
+
+def run_worker(root_dir, worker=None, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS,
+               poll_seconds=10, run_unit=None):
+    """
+    Take and run units until the queue is empty. run_unit(targets) returns the results of
+    a unit (default: batch_pipeline.run_batch with the index and manifest of the worker).
+    Returns the number of units run.
+    """
+    worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+    if run_unit is None:
+        run_unit = _default_run_unit(root_dir, worker)
+
+    finished = 0
+    while True:
+        requeue_expired(root_dir, lease_seconds, max_attempts)
+        lease = take_unit(root_dir, worker, lease_seconds)
+        if lease is None:
+            if counts(root_dir)['leased'] == 0:
+                break
+            # Units held by other workers may come back if their worker died
+            time.sleep(poll_seconds)
+            continue
+
+        print(f"[{worker}] running {lease.unit} (attempt {lease.attempt + 1}, {len(lease.targets)} targets)")
+        try:
+            results = run_unit(lease.targets)
+        except Exception as err:
+            print(f"[{worker}] {lease.unit} failed: {err}")
+            # Give the unit back right away for another attempt
+            lease.release('failed' if lease.attempt + 1 >= max_attempts else 'pending')
+            continue
+
+        lease.release('done', results)
+        finished += 1
+        print(f"[{worker}] {lease.unit} done" + (" (lease had been lost)" if lease.lost else ""))
+    return finished
+
+
+def worker_database_paths(root_dir, worker):
+    """Index and artifact manifest of a worker, in the shared work_flow folder."""
+    work_flow = os.path.join(root_dir, 'work_flow')
+    return os.path.join(work_flow, f"index.{worker}.sqlite"), os.path.join(work_flow, f"artifacts.{worker}.sqlite")
+
+
+def _default_run_unit(root_dir, worker):
+    from artifact_store import ArtifactStore, set_store
+    from batch_pipeline import run_batch
+    from rfdiffusion_pipeline import setup_folder
+    from workflow_index import WorkflowIndex
+
+    os.chdir(root_dir)
+    setup_folder(root_dir)
+    index_path, manifest_path = worker_database_paths(root_dir, worker)
+    index = WorkflowIndex(index_path, journal_mode='DELETE')
+    set_store(ArtifactStore(manifest_name=os.path.basename(manifest_path), journal_mode='DELETE'))
+    merged_index = os.path.join(root_dir, 'work_flow', 'index.sqlite')
+
+    def run_unit(targets):
+        names = {target['name'] for target in targets}
+        # Entries of earlier screens (written by the coordinator only), then the outputs of
+        # earlier attempts of the unit, which are in no merged index yet
+        if os.path.exists(merged_index):
+            index.merge([merged_index], targets=names)
+        index.scan(targets=names)
+        return run_batch(targets, index=index)
+    return run_unit
+
+
+def merge_databases(root_dir):
+    """
+    Merge the indexes and manifests of the workers into work_flow/index.sqlite and artifacts.sqlite.
+    Only run it when no worker is running, the worker files are kept (merging again is harmless).
+    """
+    from artifact_store import ArtifactStore
+    from workflow_index import WorkflowIndex
+
+    work_flow = os.path.join(root_dir, 'work_flow')
+    index = WorkflowIndex(os.path.join(work_flow, 'index.sqlite'), journal_mode='DELETE')
+    store = ArtifactStore(work_flow, journal_mode='DELETE')
+    try:
+        entries = index.merge(sorted(glob.glob(os.path.join(work_flow, 'index.*.sqlite'))))
+        files = store.merge(sorted(glob.glob(os.path.join(work_flow, 'artifacts.*.sqlite'))))
+    finally:
+        index.close()
+        store.close()
+    print(f"Merged {entries} index entries and {files} manifest entries of the workers")
+    return entries, files
+
+
+def wait_for_units(root_dir, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS, poll_seconds=10):
+    """Requeue expired leases until every unit is done or failed."""
+    while True:
+        requeue_expired(root_dir, lease_seconds, max_attempts)
+        state = counts(root_dir)
+        if state['pending'] == 0 and state['leased'] == 0:
+            return state
+        time.sleep(poll_seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded execution of a screen on several hosts")
+    parser.add_argument('mode', choices=['coordinator', 'worker', 'status', 'merge'])
+    parser.add_argument('manifest', nargs='?', help="Coordinator: CSV or JSONL manifest (see batch_pipeline.py)")
+    parser.add_argument('--root-dir', default=pipeline_config.root_dir(), help="Shared folder containing work_flow and the tools")
+    parser.add_argument('--shard-size', type=int, default=1, help="Targets per work unit")
+    parser.add_argument('--worker-id', default=None, help="Worker name (default host-pid)")
+    parser.add_argument('--lease-seconds', type=float, default=DEFAULT_LEASE_SECONDS,
+                        help="A unit goes back to the queue if its worker did not renew it for this long")
+    parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS)
+    parser.add_argument('--poll-seconds', type=float, default=10)
+    parser.add_argument('--wait', action='store_true', help="Coordinator: requeue expired leases until all units finish")
+    args = parser.parse_args()
+    root_dir = os.path.abspath(args.root_dir)
+
+    if args.mode == 'coordinator':
+        if args.manifest:
+            from batch_pipeline import read_manifest
+            created = create_units(root_dir, read_manifest(os.path.abspath(args.manifest)), args.shard_size)
+            print(f"{created} work units created in {queue_dir(root_dir)}")
+        if args.wait:
+            print(wait_for_units(root_dir, args.lease_seconds, args.max_attempts, args.poll_seconds))
+            merge_databases(root_dir)
+    elif args.mode == 'merge':
+        merge_databases(root_dir)
+    elif args.mode == 'worker':
+        run_worker(root_dir, args.worker_id, args.lease_seconds, args.max_attempts, args.poll_seconds)
+    else:
+        print(counts(root_dir))
+        for filename in _units(root_dir, 'leased'):
+            unit, attempt, worker = _parse(filename)
+            print(f"{unit} attempt {attempt + 1} leased by {worker}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+# Stage plugins of the pipeline and the routes they make
+# Every stage is a plugin: a Stage subclass registered under its name, which declares its kind
+# (generator, designer, folder or scorer), the item keys it needs and the ones it adds, and what
+# one of its jobs takes (GPUs, cores, memory, see scheduler.py). A route is a chain of stages
+# from a target (pdb_code, contig, name) to scored designs. Two routes are built in:
+#   rfdiffusion: rfdiffusion -> protein_mpnn -> omegafold -> score     backbone first
+#   evodiff:     evodiff -> omegafold -> motif_score                    sequence first (notebooks/evodiff.ipynb)
+# The rfdiffusion route scores every fold against its backbone. The evodiff route has no
+# backbone, it scores the motif residues of the fold against the native motif; both give
+# tm_score_1, tm_score_2 and rmsd.
+#
+# A new backend is a Stage subclass with @register and a route in ROUTES. check_route makes
+# sure every stage of a route gets the keys it needs before any job starts.
+#
+# Ensemble mode: with several routes (stream_targets(..., routes=['rfdiffusion', 'evodiff']),
+# batch_pipeline.py --routes rfdiffusion,evodiff) every target goes through all of them
+# concurrently, sharing the GPUs through the scheduler, and their results come out as one
+# stream (and go to one results store), each with its 'route'. Outside of the rfdiffusion route
+# a target is named <name>_<route>, so the files, index entries and results of the routes never
+# collide; the results of both routes are found with results_store.py top --target "7SH6*".
+from dataclasses import dataclass, field
+
+from contigs import structure_residues
+from pipeline_engine import merge_streams, run_stages
+from rfdiffusion_pipeline import (DEFAULT_WORKERS, RFDIFFUSION_OPTIONS, read_evodiff_sequence, read_mpnn_sequences,
+                                  stage_evodiff, stage_motif_score, stage_omegafold, stage_protein_mpnn,
+                                  stage_rfdiffusion, stage_score)
+from run_report import NullReport
+from scheduler import STAGE_RESOURCES, Resources, stage_priority
+
+KINDS = ['generator', 'designer', 'folder', 'scorer']
+# Keys of the items given to the first stage of a route
+TARGET_KEYS = ('pdb_code', 'contig', 'name', 'route')
+
+# Stage classes by name, see register
+PLUGINS = {}
+
+
+def register(cls):
+    """Class decorator adding a Stage subclass to PLUGINS."""
+    if cls.kind not in KINDS:
+        raise ValueError(f"Stage {cls.name} has kind {cls.kind}, expected one of {', '.join(KINDS)}")
+    PLUGINS[cls.name] = cls
+    return cls
+
+
+@dataclass
+class StageContext:
+    """What the stages of a run share, see stream_targets."""
+    cache: object = None
+    index: object = None
+    report: object = field(default_factory=NullReport)
+    filters: object = None
+    use_tmalign: bool = False
+    # Run defaults of the settings a target can override (number_proteins, num_seq_per_target, ...)
+    defaults: dict = field(default_factory=dict)
+
+    def setting(self, item, key):
+        return item.get(key, self.defaults.get(key))
+
+
+class Stage:
+    """
+    Base class of the stage plugins. run(item) returns the items for the next stage, several
+    of them for a fan-out (one per design or sequence). A batchable stage also has
+    run_batch(items), to handle the pending items of any target in one tool run.
+    """
+    name = None
+    kind = None
+    inputs = ()
+    outputs = ()
+    resources = Resources()
+    workers = 1
+    batchable = False
+
+    def __init__(self, context):
+        self.context = context
+
+    def run(self, item):
+        raise NotImplementedError
+
+    def run_batch(self, items):
+        raise NotImplementedError
+
+
+@register
+class RFdiffusionStage(Stage):
+    """RFdiffusion backbones of a target, one item per design."""
+    name = 'rfdiffusion'
+    kind = 'generator'
+    inputs = ('pdb_code', 'contig', 'name')
+    outputs = ('design', 'scaffold')
+    resources = STAGE_RESOURCES['rfdiffusion']
+    workers = DEFAULT_WORKERS['rfdiffusion']
+
+    def run(self, item):
+        context = self.context
+        first_design = item.get('first_design', 0)
+        with context.report.stage(item['name'], 'rfdiffusion', contig=item['contig']) as record:
+            designs = stage_rfdiffusion(item['pdb_code'], item['contig'], name=item['name'],
+                                        number_proteins=context.setting(item, 'number_proteins'),
+                                        cache=context.cache, index=context.index, first_design=first_design,
+                                        **{key: item[key] for key in RFDIFFUSION_OPTIONS if key in item})
+            record.add_outputs(designs)
+            # Counted from the CA records, numpy is only needed when the filters or scoring are used
+            record.set(designs=len(designs), length=len(structure_residues(designs[0])))
+        outputs = [{**item, 'design': design, 'scaffold': path}
+                   for design, path in enumerate(designs, start=first_design)]
+        if context.filters is not None:
+            native = f"./work_flow/native_proteins/{item['pdb_code'].upper()}.pdb"
+            for output in outputs:
+                reason = context.filters.check_backbone(item['name'], output['design'], output['scaffold'],
+                                                        native, item['contig'])
+                if reason is not None:
+                    output.update(status='rejected', error=f"backbone: {reason}")
+        return outputs
+
+
+@register
+class ProteinMPNNStage(Stage):
+    """ProteinMPNN sequences of a backbone, one item per sequence."""
+    name = 'protein_mpnn'
+    kind = 'designer'
+    inputs = ('name', 'design', 'scaffold')
+    outputs = ('sample', 'sequence', 'mpnn_score', 'header', 'fasta')
+    resources = STAGE_RESOURCES['protein_mpnn']
+    workers = DEFAULT_WORKERS['protein_mpnn']
+
+    def run(self, item):
+        context = self.context
+        with context.report.stage(item['name'], 'protein_mpnn', item['design'], contig=item['contig']) as record:
+            fasta = stage_protein_mpnn(item['name'], item['design'],
+                                       num_seq_per_target=context.setting(item, 'num_seq_per_target'),
+                                       sampling_temp=context.setting(item, 'sampling_temp'),
+                                       cache=context.cache, index=context.index)
+            record.add_outputs([fasta])
+            sequences = read_mpnn_sequences(fasta)
+            record.set(sequences=len(sequences), length=len(sequences[0]['sequence']) if sequences else None)
+        outputs = [{**item, **sequence, 'fasta': fasta} for sequence in sequences]
+        if context.filters is not None:
+            for output in outputs:
+                reason = context.filters.check_sequence(item['name'], item['design'], output['sample'], output['header'])
+                if reason is not None:
+                    output.update(status='rejected', error=f"sequence: {reason}")
+        return outputs
+
+
+@register
+class EvoDiffStage(Stage):
+    """
+    EvoDiff motif-scaffolding sequences of a target, one item per sequence (design).
+    A target makes number_sequences of them, by default as many as the rfdiffusion route
+    folds (number_proteins * num_seq_per_target), so both routes get the same folding budget.
+    """
+    name = 'evodiff'
+    kind = 'generator'
+    inputs = ('pdb_code', 'contig', 'name')
+    outputs = ('design', 'sample', 'sequence', 'layout', 'header', 'fasta')
+    resources = Resources(gpus=1, cpus=2, memory_gb=8)
+
+    def run(self, item):
+        context = self.context
+        number_sequences = item.get('number_sequences') or (context.setting(item, 'number_proteins')
+                                                            * context.setting(item, 'num_seq_per_target'))
+        with context.report.stage(item['name'], 'evodiff', contig=item['contig']) as record:
+            fastas = stage_evodiff(item['pdb_code'], item['contig'], name=item['name'],
+                                   number_sequences=number_sequences, cache=context.cache, index=context.index)
+            record.add_outputs(fastas)
+            sequences = [read_evodiff_sequence(fasta) for fasta in fastas]
+            record.set(designs=len(sequences), length=len(sequences[0]['sequence']) if sequences else None)
+        return [{**item, **sequence, 'design': design, 'fasta': fasta}
+                for design, (fasta, sequence) in enumerate(zip(fastas, sequences))]
+
+
+@register
+class OmegaFoldStage(Stage):
+    """OmegaFold structure of a sequence; in batches, the pending sequences in length buckets."""
+    name = 'omegafold'
+    kind = 'folder'
+    inputs = ('name', 'design', 'sample', 'sequence')
+    outputs = ('model',)
+    resources = STAGE_RESOURCES['omegafold']
+    workers = DEFAULT_WORKERS['omegafold']
+    batchable = True
+
+    def run(self, item):
+        context = self.context
+        with context.report.stage(item['name'], 'omegafold', item['design'], sample=item['sample'],
+                                  contig=item['contig'], length=len(item['sequence'])) as record:
+            model = stage_omegafold(item['name'], item['sequence'], item['design'], item['sample'],
+                                    cache=context.cache, index=context.index)
+            record.add_outputs([model])
+        return [{**item, 'model': model}]
+
+    def run_batch(self, items):
+        from omegafold_batch import fold_records, record_name
+        context = self.context
+        # One record for the whole batch, its tool run can not be split between the sequences
+        names = sorted({item['name'] for item in items})
+        with context.report.stage(','.join(names), 'omegafold', records=len(items),
+                                  length=max(len(item['sequence']) for item in items)) as record:
+            folded, errors = fold_records(items, cache=context.cache, index=context.index)
+            record.add_outputs(folded.values())
+        outputs = []
+        for item in items:
+            if record_name(item) in folded:
+                outputs.append({**item, 'model': folded[record_name(item)]})
+            else:
+                outputs.append({**item, 'status': 'failed', 'error': f"omegafold: {errors.get(record_name(item))}"})
+        return outputs
+
+
+def _scored(item, scores):
+    if scores is None:
+        return [{**item, 'status': 'failed', 'error': 'score: no scores'}]
+    tm_score_1, tm_score_2, rmsd = scores
+    return [{**item, 'tm_score_1': tm_score_1, 'tm_score_2': tm_score_2, 'rmsd': rmsd}]
+
+
+@register
+class ScoreStage(Stage):
+    """TM-scores and RMSD of the folded sequence against its backbone."""
+    name = 'score'
+    kind = 'scorer'
+    inputs = ('name', 'design', 'sample', 'scaffold', 'model')
+    outputs = ('tm_score_1', 'tm_score_2', 'rmsd')
+    resources = STAGE_RESOURCES['score']
+    workers = DEFAULT_WORKERS['score']
+
+    def run(self, item):
+        context = self.context
+        with context.report.stage(item['name'], 'score', item['design'], sample=item['sample'],
+                                  contig=item['contig'], length=len(item['sequence'])):
+            scores = stage_score(item['name'], item['design'], item['sample'], index=context.index,
+                                 use_tmalign=context.use_tmalign)
+        return _scored(item, scores)
+
+
+@register
+class MotifScoreStage(Stage):
+    """TM-score and RMSD of the motif residues of the folded sequence against the native motif."""
+    name = 'motif_score'
+    kind = 'scorer'
+    inputs = ('name', 'pdb_code', 'design', 'sample', 'layout', 'model')
+    outputs = ('tm_score_1', 'tm_score_2', 'rmsd')
+    resources = STAGE_RESOURCES['score']
+    workers = DEFAULT_WORKERS['score']
+
+    def run(self, item):
+        context = self.context
+        with context.report.stage(item['name'], 'motif_score', item['design'], sample=item['sample'],
+                                  contig=item['contig'], length=len(item['sequence'])):
+            scores = stage_motif_score(item['name'], item['pdb_code'], item['layout'], item['design'],
+                                       item['sample'], index=context.index)
+        return _scored(item, scores)
+
+
+# Stages of every route, in order
+ROUTES = {
+    'rfdiffusion': ['rfdiffusion', 'protein_mpnn', 'omegafold', 'score'],
+    'evodiff': ['evodiff', 'omegafold', 'motif_score'],
+}
+DEFAULT_ROUTE = 'rfdiffusion'
+
+
+def route_name(name, route):
+    """Name of a target in a route, see the top of the file."""
+    return name if route == DEFAULT_ROUTE else f"{name}_{route}"
+
+
+def check_route(stages):
+    """Raise a ValueError if a stage is unknown or needs a key that no earlier stage adds."""
+    available = set(TARGET_KEYS)
+    for stage in stages:
+        if stage not in PLUGINS:
+            raise ValueError(f"Unknown stage {stage}, expected one of {', '.join(PLUGINS)}")
+        missing = [key for key in PLUGINS[stage].inputs if key not in available]
+        if missing:
+            raise ValueError(f"Stage {stage} needs {', '.join(missing)}, which no stage before it makes")
+        available.update(PLUGINS[stage].outputs)
+
+
+def _scheduled(scheduler, stage, stages, step):
+    if scheduler is None:
+        return step
+
+    def run(item_or_batch):
+        # A batch runs with the priority of its most urgent item
+        items = item_or_batch if isinstance(item_or_batch, list) else [item_or_batch]
+        priority = min(stage_priority(stage, stages, item) for item in items)
+        with scheduler.acquire(stage, priority):
+            return step(item_or_batch)
+    return run
+
+
+def build_route(route, context, workers=None, scheduler=None, batch_size=1, batch_wait=30.0):
+    """
+    Stages of a route (a name of ROUTES or a list of stage names) for run_stages.
+    workers maps a stage to its number of workers (default: the one of its plugin). Batchable
+    stages get up to batch_size items at once, collected for at most batch_wait seconds.
+    """
+    stages = ROUTES[route] if isinstance(route, str) else list(route)
+    check_route(stages)
+    workers = workers or {}
+
+    built = []
+    for stage in stages:
+        plugin = PLUGINS[stage](context)
+        if scheduler is not None:
+            # The resources given to the Scheduler win over the ones the plugin declares
+            scheduler.stage_resources.setdefault(stage, plugin.resources)
+        count = workers.get(stage) or plugin.workers
+        if plugin.batchable and batch_size > 1:
+            built.append((stage, _scheduled(scheduler, stage, stages, plugin.run_batch), count, batch_size, batch_wait))
+        else:
+            built.append((stage, _scheduled(scheduler, stage, stages, plugin.run), count))
+    return built
+
+
+def run_routes(targets, routes, context, workers=None, scheduler=None, batch_size=1, batch_wait=30.0):
+    """
+    Run every target through every route (names of ROUTES), the routes side by side.
+    Yields the results of all the routes as they finish, see run_stages, each with its route.
+    """
+    unknown = [route for route in routes if route not in ROUTES]
+    if unknown:
+        raise ValueError(f"Unknown routes {', '.join(unknown)}, expected some of {', '.join(ROUTES)}")
+    # Every route is checked before any of them starts
+    pipelines = [(route, build_route(route, context, workers, scheduler, batch_size, batch_wait)) for route in routes]
+    streams = []
+    for route, stages in pipelines:
+        items = [{**target, 'name': route_name(target['name'], route), 'route': route} for target in targets]
+        streams.append(run_stages(items, stages))
+    return merge_streams(streams) if len(streams) > 1 else streams[0]
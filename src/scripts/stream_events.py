@@ -0,0 +1,167 @@
+# Assembly of converse_stream responses
+# The chunks of a response are processed as they arrive: the text and tool-input deltas of
+# every content block (identified by contentBlockIndex, blocks may interleave) are appended
+# to lists and joined once at the end of the block. Tool inputs are parsed incrementally, so
+# a tool call whose required arguments are complete can be started before the message ends.
+import json
+
+
+class IncrementalJSONObject:
+    """
+    Parser of a JSON object received in pieces. feed() returns the names of the top-level
+    fields whose values became complete, their values are in fields.
+    """
+
+    def __init__(self):
+        self.fields = {}
+        self.parts = []
+        # Nesting depth, the object itself is depth 1
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        # Characters of the top-level key being read, the last key, and the characters of its value
+        self._key_parts = None
+        self._key = None
+        self._value_parts = None
+
+    def feed(self, text):
+        self.parts.append(text)
+        completed = []
+        for char in text:
+            if self._in_string:
+                reading_key = self._value_parts is None
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if reading_key:
+                        self._key = json.loads('"' + ''.join(self._key_parts) + '"')
+                        continue
+                (self._key_parts if reading_key else self._value_parts).append(char)
+
+            elif self._depth == 0:
+                if char == '{':
+                    self._depth = 1
+
+            elif self._depth == 1 and self._value_parts is None:
+                # Between the fields of the object
+                if char == '"':
+                    self._in_string = True
+                    self._key_parts = []
+                elif char == ':':
+                    self._value_parts = []
+                elif char == '}':
+                    self._depth = 0
+
+            elif self._depth == 1 and char in ',}':
+                # End of a top-level value
+                self.fields[self._key] = json.loads(''.join(self._value_parts))
+                completed.append(self._key)
+                self._value_parts = None
+                if char == '}':
+                    self._depth = 0
+
+            else:
+                if char in '{[':
+                    self._depth += 1
+                elif char in '}]':
+                    self._depth -= 1
+                elif char == '"':
+                    self._in_string = True
+                self._value_parts.append(char)
+        return completed
+
+    def text(self):
+        return ''.join(self.parts)
+
+
+class StreamAssembler:
+    """
+    Builds the assistant message from the chunks of converse_stream.
+    on_text(text) is called with every text delta. on_tool_ready(tool_use) is called once per
+    tool call as soon as the required arguments of the tool (required maps a tool name to
+    the list of its required arguments) are complete, with the fields known at that time,
+    which may miss optional arguments still to come.
+    """
+
+    def __init__(self, required=None, on_text=None, on_tool_ready=None):
+        self.required = required or {}
+        self.on_text = on_text
+        self.on_tool_ready = on_tool_ready
+        self.role = None
+        self.stop_reason = ""
+        self.metadata = {}
+        # Block index -> {'text': [...]} or {'toolUse': {...}, 'parser': ...}
+        self._blocks = {}
+        self._content = {}
+        self._current = 0
+        self._next = 0
+
+    def _block(self, chunk_body):
+        if 'contentBlockIndex' in chunk_body:
+            self._current = chunk_body['contentBlockIndex']
+        elif self._current not in self._blocks:
+            # Stream without block indexes: a new block starts after the previous one stopped
+            self._current = self._next
+        self._next = max(self._next, self._current + 1)
+        return self._current
+
+    def _ready(self, block):
+        tool_use = block['toolUse']
+        if block['dispatched'] or self.on_tool_ready is None:
+            return
+        required = self.required.get(tool_use['name'])
+        if required is None or not all(name in block['parser'].fields for name in required):
+            return
+        block['dispatched'] = True
+        self.on_tool_ready({**tool_use, 'input': dict(block['parser'].fields)})
+
+    def process(self, chunk):
+        if 'messageStart' in chunk:
+            self.role = chunk['messageStart']['role']
+
+        elif 'contentBlockStart' in chunk:
+            body = chunk['contentBlockStart']
+            index = self._block(body)
+            tool = body.get('start', {}).get('toolUse')
+            if tool is not None:
+                self._blocks[index] = {'toolUse': {'toolUseId': tool['toolUseId'], 'name': tool['name']},
+                                       'parser': IncrementalJSONObject(), 'dispatched': False}
+                # A tool without required arguments is ready right away
+                if not self.required.get(tool['name'], [None]):
+                    self._ready(self._blocks[index])
+
+        elif 'contentBlockDelta' in chunk:
+            body = chunk['contentBlockDelta']
+            index = self._block(body)
+            delta = body['delta']
+            if 'toolUse' in delta:
+                block = self._blocks[index]
+                if block['parser'].feed(delta['toolUse']['input']):
+                    self._ready(block)
+            elif 'text' in delta:
+                # Text blocks have no contentBlockStart
+                self._blocks.setdefault(index, {'text': []})['text'].append(delta['text'])
+                if self.on_text is not None:
+                    self.on_text(delta['text'])
+
+        elif 'contentBlockStop' in chunk:
+            index = self._block(chunk['contentBlockStop'])
+            block = self._blocks.pop(index, {'text': []})
+            if 'toolUse' in block:
+                raw = block['parser'].text()
+                self._content[index] = {'toolUse': {**block['toolUse'], 'input': json.loads(raw) if raw else {}}}
+            else:
+                self._content[index] = {'text': ''.join(block['text'])}
+
+        elif 'messageStop' in chunk:
+            self.stop_reason = chunk['messageStop']['stopReason']
+
+        elif 'metadata' in chunk:
+            self.metadata.update(chunk['metadata'])
+
+    def message(self):
+        """The assembled message, content blocks in index order."""
+        return {'role': self.role, 'content': [self._content[index] for index in sorted(self._content)]}
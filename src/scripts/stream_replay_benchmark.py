@@ -0,0 +1,148 @@
+# Replay benchmark of the chatbot stream assembly
+# Feeds recorded converse_stream chunk streams (saved by the chatbot with CHATBOT_RECORD_DIR set,
+# one {"t": seconds since the request, "chunk": {...}} per line) through the StreamAssembler, and
+# reports when the first speculative tool (SPECULATIVE_TOOLS of the chatbot) can be started:
+# as soon as its required arguments are complete, at the end of its content block, or at the
+# end of the message as before. Without recordings, synthetic streams are generated.
+#
+# Usage:
+#   python stream_replay_benchmark.py                        # synthetic streams
+#   python stream_replay_benchmark.py work_flow/streams/     # recorded streams
+import argparse
+import glob
+import json
+import os
+import random
+import time
+
+from dynamic_chatbot_RFdiffusion import SPECULATIVE_TOOLS, TOOL_CONFIG, required_fields
+from stream_events import StreamAssembler
+
+# Required arguments of the chatbot tools, the same as the chatbot gives its StreamAssembler
+REQUIRED = required_fields(TOOL_CONFIG)
+
+
+def _split(text, rng, low=2, high=10):
+    pieces = []
+    while text:
+        size = rng.randint(low, high)
+        pieces.append(text[:size])
+        text = text[size:]
+    return pieces
+
+
+def synthetic_stream(seed, chunk_interval=0.02):
+    """A text block followed by download_pdb and run_rfdiffusion calls, deltas every chunk_interval seconds."""
+    rng = random.Random(seed)
+    pdb_code = ''.join(rng.choice('0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(4))
+    words = ' '.join(rng.choice(['I', 'will', 'download', 'the', 'structure', 'and', 'design', 'a', 'binder'])
+                     for _ in range(rng.randint(10, 40)))
+    chunks = [{'messageStart': {'role': 'assistant'}}]
+    chunks += [{'contentBlockDelta': {'contentBlockIndex': 0, 'delta': {'text': piece}}} for piece in _split(words, rng)]
+    chunks.append({'contentBlockStop': {'contentBlockIndex': 0}})
+
+    tools = [
+        # The optional target_directory makes the speculative download useless, see replay()
+        ('download_pdb', {'pdb_code': pdb_code} if rng.random() < 0.7 else
+                         {'pdb_code': pdb_code, 'target_directory': './work_flow/native_proteins'}),
+        ('run_rfdiffusion', {'input_file': f"./work_flow/native_proteins/{pdb_code}.pdb",
+                             'output_dir_and_prefix': f"./work_flow/RFdiffusion_output/{pdb_code}/{pdb_code}",
+                             'residues_backbone': '[10-40/A163-181/10-40]', 'number_proteins': 2}),
+    ]
+    for index, (name, tool_input) in enumerate(tools, start=1):
+        chunks.append({'contentBlockStart': {'contentBlockIndex': index,
+                                             'start': {'toolUse': {'toolUseId': f"tooluse_{seed}_{index}", 'name': name}}}})
+        chunks += [{'contentBlockDelta': {'contentBlockIndex': index, 'delta': {'toolUse': {'input': piece}}}}
+                   for piece in _split(json.dumps(tool_input), rng)]
+        chunks.append({'contentBlockStop': {'contentBlockIndex': index}})
+    chunks.append({'messageStop': {'stopReason': 'tool_use'}})
+    chunks.append({'metadata': {'usage': {'inputTokens': 1000, 'outputTokens': len(chunks)}}})
+
+    return [{'t': i * chunk_interval, 'chunk': chunk} for i, chunk in enumerate(chunks)]
+
+
+def load_stream(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def replay(events):
+    """
+    Stream times (seconds) at which the first speculative tool can be started: when its
+    required arguments are complete, at the end of its block and at the end of the message.
+    A speculative start only counts if it got the final input of the tool (the chatbot runs
+    the tool again otherwise). Also returns the processing time per chunk in microseconds.
+    """
+    dispatched = []
+    assembler = StreamAssembler(REQUIRED, on_tool_ready=lambda tool_use: dispatched.append(tool_use))
+    block_stop, message_stop = None, None
+    dispatch_times = {}
+    elapsed = 0.0
+
+    for event in events:
+        chunk = event['chunk']
+        tic = time.perf_counter()
+        assembler.process(chunk)
+        elapsed += time.perf_counter() - tic
+
+        for tool in dispatched:
+            dispatch_times.setdefault(tool['toolUseId'], (event['t'], tool))
+        if block_stop is None and 'contentBlockStop' in chunk:
+            content = assembler.message()['content']
+            if any('toolUse' in block and block['toolUse']['name'] in SPECULATIVE_TOOLS for block in content):
+                block_stop = event['t']
+        if 'messageStop' in chunk:
+            message_stop = event['t']
+
+    tools = [block['toolUse'] for block in assembler.message()['content']
+             if 'toolUse' in block and block['toolUse']['name'] in SPECULATIVE_TOOLS]
+    if not tools:
+        message_stop = None
+    speculative = None
+    for tool in tools:
+        if tool['toolUseId'] in dispatch_times:
+            dispatch_time, started = dispatch_times[tool['toolUseId']]
+            if started['input'] == tool['input']:
+                speculative = min(dispatch_time, speculative if speculative is not None else dispatch_time)
+    return speculative, block_stop, message_stop, elapsed / max(len(events), 1) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay converse_stream recordings and report the time to first tool dispatch")
+    parser.add_argument('recordings', nargs='*', help="Recorded stream files or folders (default: synthetic streams)")
+    parser.add_argument('--streams', type=int, default=20, help="Number of synthetic streams")
+    parser.add_argument('--chunk-interval', type=float, default=0.02, help="Seconds between synthetic chunks")
+    args = parser.parse_args()
+
+    streams = []
+    for path in args.recordings:
+        paths = sorted(glob.glob(os.path.join(path, '*.jsonl'))) if os.path.isdir(path) else [path]
+        streams += [(os.path.basename(p), load_stream(p)) for p in paths]
+    if not args.recordings:
+        streams = [(f"synthetic_{seed}", synthetic_stream(seed, args.chunk_interval)) for seed in range(args.streams)]
+
+    print(f"{'stream':<32}{'chunks':>8}{'speculative':>13}{'block stop':>12}{'message stop':>14}{'us/chunk':>10}")
+    saved = []
+    for name, events in streams:
+        speculative, block_stop, message_stop, per_chunk = replay(events)
+        if message_stop is None:
+            continue
+
+        def show(value):
+            return f"{value * 1000:.0f} ms" if value is not None else '-'
+
+        print(f"{name:<32}{len(events):>8}{show(speculative):>13}{show(block_stop):>12}"
+              f"{show(message_stop):>14}{per_chunk:>10.1f}")
+        if speculative is not None:
+            saved.append(message_stop - speculative)
+
+    if saved:
+        saved.sort()
+        print(f"\nFirst tool started {saved[len(saved) // 2] * 1000:.0f} ms earlier (median) than at the end "
+              f"of the message, in {len(saved)} streams with a speculative tool")
+    else:
+        print("\nNo stream with a speculative tool call")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+# In-process structural scoring (RMSD and TM-score) with NumPy
+# extract_scores forks ./TMalign for every pair of structures. Here the CA coordinates of every
+# PDB file are parsed once into NumPy arrays, and RMSD/TM-score are computed in batch over
+# stacked coordinate arrays, with an all-vs-all mode spread over a process pool.
+#
+# Structures of the same length have their residues paired by index in the chain, like the
+# TMscore program. This is the right comparison for a design against its own refolded
+# structure. Structures of different lengths (a model against the native structure) are
+# first aligned without looking at the sequence, like TMalign does: the best gapless
+# threadings are refined by dynamic programming on the TM-score of the superposed structures
+# (structural_alignment). It is a simplified TMalign (no secondary-structure seeds), use
+# tmalign_reference to cross-check results.
+#
+# Usage:
+#   python structural_scoring.py --models designs/7SH6/0/omegafold/*.pdb --references designs/7SH6/0/rfdiffusion/*.pdb
+import argparse
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+
+
+def _read_ca_coords(path):
+    coords = []
+    with open(path) as f:
+        for line in f:
+            if line.startswith('ENDMDL'):
+                # Only the first model of multi-model files
+                break
+            if not line.startswith('ATOM') or line[12:16].strip() != 'CA':
+                continue
+            # Keep the first alternate location only
+            if line[16] not in (' ', 'A'):
+                continue
+            coords.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+    if not coords:
+        raise ValueError(f"No CA atoms found in {path}")
+    return np.array(coords, dtype=np.float64)
+
+
+@lru_cache(maxsize=4096)
+def _load_cached(path, mtime_ns):
+    coords = _read_ca_coords(path)
+    coords.setflags(write=False)
+    return coords
+
+
+def load_ca_coords(path):
+    """
+    CA coordinates of the first model of a PDB file, as an (L, 3) array.
+    Files are parsed once, the result is cached until the file changes.
+    """
+    path = os.path.abspath(path)
+    return _load_cached(path, os.stat(path).st_mtime_ns)
+
+
+def d0(length):
+    """TM-score distance scale for a protein of the given length."""
+    return max(1.24 * np.cbrt(max(length, 19) - 15) - 1.8, 0.5)
+
+
+def _kabsch(P, Q, weights):
+    # Weighted Kabsch rotation and centers of P onto Q, for stacks of shape (N, L, 3) and weights (N, L)
+    weights = weights / weights.sum(axis=-1, keepdims=True)
+    center_P = np.einsum('nl,nli->ni', weights, P)
+    center_Q = np.einsum('nl,nli->ni', weights, Q)
+    P_centered = P - center_P[:, None, :]
+    Q_centered = Q - center_Q[:, None, :]
+
+    covariance = np.einsum('nl,nli,nlj->nij', weights, P_centered, Q_centered)
+    U, _, Vt = np.linalg.svd(covariance)
+    # Correct for reflections
+    sign = np.sign(np.linalg.det(np.einsum('nij,njk->nik', U, Vt)))
+    Vt[:, -1, :] *= sign[:, None]
+    rotation = np.einsum('nij,njk->nik', U, Vt)
+    return rotation, center_P, center_Q
+
+
+def _superpose(P, Q, weights):
+    # Weighted Kabsch superposition of P onto Q, for stacks of shape (N, L, 3) and weights (N, L)
+    rotation, center_P, center_Q = _kabsch(P, Q, weights)
+    return np.einsum('nli,nij->nlj', P - center_P[:, None, :], rotation) + center_Q[:, None, :]
+
+
+def _as_stacks(P, Q):
+    P = np.asarray(P, dtype=np.float64)
+    Q = np.asarray(Q, dtype=np.float64)
+    if P.ndim == 2:
+        P = P[None]
+    if Q.ndim == 2:
+        Q = Q[None]
+    P, Q = np.broadcast_arrays(P, Q)
+    if P.shape[-2:] != Q.shape[-2:] or P.shape[-1] != 3:
+        raise ValueError(f"Coordinate arrays of shape {P.shape} and {Q.shape} can not be paired")
+    return P, Q
+
+
+def kabsch_rmsd(P, Q):
+    """
+    RMSD after optimal superposition of P onto Q.
+    P and Q are (L, 3) arrays or stacks of shape (N, L, 3) (broadcast against each other),
+    returns an array of N RMSD values.
+    """
+    P, Q = _as_stacks(P, Q)
+    superposed = _superpose(P, Q, np.ones(P.shape[:2]))
+    return np.sqrt(((superposed - Q) ** 2).sum(axis=-1).mean(axis=-1))
+
+
+def tm_score(P, Q, normalize_by=None, iterations=8):
+    """
+    TM-score of P against Q, for (L, 3) arrays or stacks of shape (N, L, 3).
+    The score is normalized by normalize_by residues (default L). The superposition
+    maximizing the score is searched by iteratively re-weighted Kabsch superpositions,
+    starting from the superposition over all residues.
+    Returns (tm_scores, rmsds), two arrays of N values, the RMSD being over all residues
+    for the best TM-score superposition.
+    """
+    P, Q = _as_stacks(P, Q)
+    length = P.shape[1]
+    normalize_by = normalize_by or length
+    scale = d0(normalize_by)
+
+    weights = np.ones(P.shape[:2])
+    best_scores = np.full(P.shape[0], -np.inf)
+    best_rmsds = np.zeros(P.shape[0])
+    for _ in range(iterations):
+        superposed = _superpose(P, Q, weights)
+        squared_distances = ((superposed - Q) ** 2).sum(axis=-1)
+        per_residue = 1.0 / (1.0 + squared_distances / scale ** 2)
+        scores = per_residue.sum(axis=-1) / normalize_by
+
+        improved = scores > best_scores
+        best_scores = np.where(improved, scores, best_scores)
+        best_rmsds = np.where(improved, np.sqrt(squared_distances.mean(axis=-1)), best_rmsds)
+
+        # Residues that are already close get more weight in the next superposition
+        weights = per_residue ** 2 + 1e-6
+
+    return best_scores, best_rmsds
+
+
+# Gap penalty of the dynamic programming of structural_alignment (the gap opening of TMalign)
+GAP_PENALTY = -0.6
+
+
+def _align_dp(similarity, gap=GAP_PENALTY):
+    # Residue pairs maximizing the summed similarity of an (n, m) matrix, linear gap penalty
+    # and free end gaps. Every row is filled at once: along a row,
+    # H[i, j] = max over k <= j of best[k] + gap * (j - k), a running maximum.
+    n, m = similarity.shape
+    H = np.zeros((n + 1, m + 1))
+    # 0: pair, 1: residue of P unpaired, 2: residue of Q unpaired
+    pointer = np.zeros((n + 1, m + 1), dtype=np.int8)
+    steps = np.arange(m + 1) * gap
+    for i in range(1, n + 1):
+        diagonal = H[i - 1, :-1] + similarity[i - 1]
+        up = H[i - 1, 1:] + gap
+        best = np.concatenate(([0.0], np.maximum(diagonal, up)))
+        H[i] = np.maximum.accumulate(best - steps) + steps
+        pointer[i, 1:] = np.where(H[i, 1:] > best[1:] + 1e-9, 2, np.where(diagonal >= up, 0, 1))
+
+    # Free end gaps: the alignment ends at the best cell of the last row or column
+    i, j = n, int(np.argmax(H[n]))
+    if H[:, m].max() > H[n, j]:
+        i, j = int(np.argmax(H[:, m])), m
+    pairs = []
+    while i > 0 and j > 0:
+        if pointer[i, j] == 0:
+            pairs.append((i - 1, j - 1))
+            i, j = i - 1, j - 1
+        elif pointer[i, j] == 1:
+            i -= 1
+        else:
+            j -= 1
+    pairs.reverse()
+    return np.array([p for p, _ in pairs], dtype=int), np.array([q for _, q in pairs], dtype=int)
+
+
+def _tm_transform(P, Q, scale, iterations=4):
+    # Superposition of the paired residues P onto Q with the best TM-score sum (re-weighted as in
+    # tm_score), returns the sum and the (rotation, center of P, center of Q) to apply to all of P
+    weights = np.ones(len(P))
+    best_sum, best_transform = -1.0, None
+    for _ in range(iterations):
+        rotation, center_P, center_Q = _kabsch(P[None], Q[None], weights[None])
+        superposed = (P - center_P[0]) @ rotation[0] + center_Q[0]
+        per_residue = 1.0 / (1.0 + ((superposed - Q) ** 2).sum(axis=-1) / scale ** 2)
+        if per_residue.sum() > best_sum:
+            best_sum, best_transform = per_residue.sum(), (rotation[0], center_P[0], center_Q[0])
+        weights = per_residue ** 2 + 1e-6
+    return best_sum, best_transform
+
+
+def structural_alignment(P, Q, seeds=3, iterations=10):
+    """
+    Sequence-independent alignment of two CA traces of any lengths, (L, 3) arrays.
+    The seeds best gapless threadings (residue i of P on residue i + shift of Q) are refined by
+    dynamic programming on the TM-score similarity of the superposed structures until the
+    alignment stops changing. Returns the indices of the paired residues in P and in Q.
+    """
+    P = np.asarray(P, dtype=np.float64)
+    Q = np.asarray(Q, dtype=np.float64)
+    n, m = len(P), len(Q)
+    if min(n, m) < 3:
+        raise ValueError(f"Structures of {n} and {m} residues are too short to align")
+    scale = d0(min(n, m))
+
+    # Threadings overlapping at least half of the shorter structure
+    overlap = max(min(n, m) // 2, 3)
+    threadings = []
+    for shift in range(overlap - n, m - overlap + 1):
+        a = np.arange(max(0, -shift), min(n, m - shift))
+        threadings.append((_tm_transform(P[a], Q[a + shift], scale, iterations=2)[0], a, a + shift))
+    threadings.sort(key=lambda threading: -threading[0])
+
+    best_sum, best_a, best_b = -1.0, None, None
+    for _, a, b in threadings[:seeds]:
+        for _ in range(iterations):
+            _, (rotation, center_P, center_Q) = _tm_transform(P[a], Q[b], scale)
+            superposed = (P - center_P) @ rotation + center_Q
+            distances = ((superposed[:, None, :] - Q[None, :, :]) ** 2).sum(axis=-1)
+            new_a, new_b = _align_dp(1.0 / (1.0 + distances / scale ** 2))
+            if len(new_a) < 3 or (np.array_equal(new_a, a) and np.array_equal(new_b, b)):
+                break
+            a, b = new_a, new_b
+        score_sum = _tm_transform(P[a], Q[b], scale)[0]
+        if score_sum > best_sum:
+            best_sum, best_a, best_b = score_sum, a, b
+    return best_a, best_b
+
+
+def aligned_scores(ref, generated):
+    """
+    (tm_score_1, tm_score_2, rmsd) of two CA traces of any lengths after structural_alignment,
+    the TM-scores normalized by the length of ref and of generated, the RMSD over the aligned pairs.
+    """
+    a, b = structural_alignment(generated, ref)
+    scores_1, rmsds = tm_score(generated[a], ref[b], normalize_by=len(ref))
+    scores_2, _ = tm_score(generated[a], ref[b], normalize_by=len(generated))
+    return float(scores_1[0]), float(scores_2[0]), float(rmsds[0])
+
+
+def score_pair(ref_protein, generated_protein):
+    """
+    Same output as extract_scores: (tm_score_1, tm_score_2, rmsd), the TM-scores being
+    normalized by the length of the first and the second structure. Structures of different
+    lengths are compared after a structural alignment (see aligned_scores).
+    """
+    ref = load_ca_coords(ref_protein)
+    generated = load_ca_coords(generated_protein)
+    if len(ref) != len(generated):
+        return aligned_scores(ref, generated)
+    scores, rmsds = tm_score(generated, ref)
+    return float(scores[0]), float(scores[0]), float(rmsds[0])
+
+
+def tmalign_reference(ref_protein, generated_protein):
+    """Scores of the same pair from the TMalign binary (see extract_scores), for cross-checking."""
+    from rfdiffusion_pipeline import extract_scores
+    return extract_scores(ref_protein, generated_protein)
+
+
+def _score_against(reference, models):
+    # Worker of all_vs_all: one reference against a stack of models of the same length
+    scores, rmsds = tm_score(models, reference)
+    return scores, rmsds
+
+
+def _align_against(reference, models):
+    # Worker of all_vs_all: one reference against models of other lengths, aligned one by one
+    scores = [aligned_scores(reference, model) for model in models]
+    return np.array([score[0] for score in scores]), np.array([score[2] for score in scores])
+
+
+def all_vs_all(models, references, processes=None):
+    """
+    TM-score (normalized by the reference) and RMSD of every model (list of PDB paths) against
+    every reference. Returns two (len(models), len(references)) arrays. Models of the length of
+    a reference are scored as a stack, the others after a structural alignment (slower).
+    The references are scored in parallel by a pool of processes (None = number of CPUs).
+    """
+    model_coords = [load_ca_coords(path) for path in models]
+    reference_coords = [load_ca_coords(path) for path in references]
+
+    tm_matrix = np.full((len(models), len(references)), np.nan)
+    rmsd_matrix = np.full((len(models), len(references)), np.nan)
+
+    # Stack the models by length, every reference is scored against the stack of its length
+    by_length = {}
+    for i, coords in enumerate(model_coords):
+        by_length.setdefault(len(coords), []).append(i)
+    stacks = {length: np.stack([model_coords[i] for i in rows]) for length, rows in by_length.items()}
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = []
+        for j, reference in enumerate(reference_coords):
+            if len(reference) in stacks:
+                rows = by_length[len(reference)]
+                futures.append((j, rows, pool.submit(_score_against, reference, stacks[len(reference)])))
+            other_rows = [i for i, coords in enumerate(model_coords) if len(coords) != len(reference)]
+            if other_rows:
+                futures.append((j, other_rows, pool.submit(_align_against, reference,
+                                                           [model_coords[i] for i in other_rows])))
+        for j, rows, future in futures:
+            scores, rmsds = future.result()
+            tm_matrix[rows, j] = scores
+            rmsd_matrix[rows, j] = rmsds
+
+    return tm_matrix, rmsd_matrix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="All-vs-all TM-score and RMSD between PDB files")
+    parser.add_argument('--models', nargs='+', required=True, help="PDB files of the models")
+    parser.add_argument('--references', nargs='+', required=True, help="PDB files to compare the models to")
+    parser.add_argument('--processes', type=int, default=None, help="Number of worker processes")
+    parser.add_argument('--output', default=None, help="CSV file for the scores (default: print them)")
+    parser.add_argument('--cross-check', action='store_true', help="Also run TMalign on every pair")
+    args = parser.parse_args()
+
+    tm_matrix, rmsd_matrix = all_vs_all(args.models, args.references, args.processes)
+
+    rows = []
+    for i, model in enumerate(args.models):
+        for j, reference in enumerate(args.references):
+            row = {'model': model, 'reference': reference,
+                   'tm_score': tm_matrix[i, j], 'rmsd': rmsd_matrix[i, j]}
+            if args.cross_check:
+                tmalign_scores = tmalign_reference(reference, model)
+                # Normalized by the reference (chain 1 of TMalign), like tm_matrix
+                row['tmalign_tm_score'] = tmalign_scores[0] if tmalign_scores else None
+                row['tmalign_rmsd'] = tmalign_scores[2] if tmalign_scores else None
+            rows.append(row)
+
+    if args.output is None:
+        for row in rows:
+            print(', '.join(f"{key}={value}" for key, value in row.items()))
+    else:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
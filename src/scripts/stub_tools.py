@@ -0,0 +1,255 @@
+# Stand-ins for the model tools, for testing the pipeline on a CPU-only machine
+# They take the same arguments as the real tools and write output files with the same names
+# and formats (a CA-only backbone and a .trb file for RFdiffusion, an MPNN-style FASTA for
+# ProteinMPNN, one structure per record for OmegaFold, the score lines of TMalign, a FASTA with
+# the layout of every record for EvoDiff),
+# deterministically from their inputs, after an optional artificial latency.
+#
+# install_stubs(root_dir) writes executables at the paths the pipeline calls
+# (./RFdiffusion/scripts/run_inference.py, ./ProteinMPNN/protein_mpnn_run.py, ./TMalign,
+# ./EvoDiff/evodiff_generate.py and bin/omegafold, to put first in PATH), see pipeline_benchmark.py. They can also be run directly:
+#   python stub_tools.py omegafold input.fa output_dir
+import hashlib
+import json
+import math
+import os
+import pickle
+import random
+import stat
+import sys
+import time
+
+from contigs import ChainBreak, MotifSegment, parse_contig
+from evodiff_generate import format_record, scaffold_layout
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+def _rng(*parts):
+    # Same inputs, same outputs
+    seed = hashlib.sha256('|'.join(str(part) for part in parts).encode()).hexdigest()
+    return random.Random(int(seed[:16], 16))
+
+
+def contig_length(contigs):
+    """Length of a design from a contig string like [10-20/A157-163/5], taking the lower bounds."""
+    # Motif residues are copied, generated segments use their minimum length
+    return max(parse_contig(contigs).length_bounds()[0], 1)
+
+
+def chain_lengths(contigs):
+    """Length of every chain of a design (chains separated by '/0 '), taking the lower bounds."""
+    lengths = [0]
+    for segment in parse_contig(contigs).segments:
+        if isinstance(segment, ChainBreak):
+            lengths.append(0)
+        else:
+            lengths[-1] += segment.length if isinstance(segment, MotifSegment) else segment.min_length
+    return [length for length in lengths if length] or [1]
+
+
+def motif_indexes(contigs):
+    """con_ref_pdb_idx and con_hal_pdb_idx of the .trb file: motif residues in the input and the design."""
+    contig = parse_contig(contigs)
+    pairs = contig.motif_mapping([segment.min_length for segment in contig.generated])
+    # The designs are written as chains A, B, ... numbered from 1 through all of them
+    lengths = chain_lengths(contigs)
+    ends = [sum(lengths[:i + 1]) for i in range(len(lengths))]
+    chains = [chr(ord('A') + sum(position >= end for end in ends)) for _, position in pairs]
+    return [residue for residue, _ in pairs], [(chain, position + 1) for chain, (_, position) in zip(chains, pairs)]
+
+
+def write_backbone(path, length, rng, chains=None):
+    """
+    Write a CA-only helical backbone of the given length, slightly perturbed. chains are the
+    lengths of its chains A, B, ... (default one chain), side by side 12 A apart.
+    """
+    lines = []
+    chain_of = [chr(ord('A') + n) for n, chain_length in enumerate(chains or [length]) for _ in range(chain_length)]
+    for i in range(length):
+        chain = chain_of[i]
+        # Position in the chain
+        k = i - chain_of.index(chain)
+        angle = math.radians(100 * k)
+        x = 2.3 * math.cos(angle) + 12.0 * (ord(chain) - ord('A')) + rng.gauss(0, 0.1)
+        y = 2.3 * math.sin(angle) + rng.gauss(0, 0.1)
+        z = 1.5 * k + rng.gauss(0, 0.1)
+        lines.append("ATOM  %5d  CA  GLY %s%4d    %8.3f%8.3f%8.3f  1.00  0.00           C\n"
+                     % (i + 1, chain, i + 1, x, y, z))
+    lines.append("END\n")
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        f.writelines(lines)
+
+
+def read_sequence_length(pdb_path):
+    with open(pdb_path) as f:
+        return sum(1 for line in f if line.startswith('ATOM') and line[12:16].strip() == 'CA')
+
+
+def _hydra_args(args):
+    # key=value arguments of run_inference.py
+    return dict(arg.split('=', 1) for arg in args if '=' in arg)
+
+
+def rfdiffusion(args, latency=0.0, cwd='.'):
+    """Stand-in for RFdiffusion/scripts/run_inference.py, relative paths are taken from cwd."""
+    options = _hydra_args(args)
+    prefix = os.path.join(cwd, options['inference.output_prefix'])
+    num_designs = int(options.get('inference.num_designs', 1))
+    start = int(options.get('inference.design_startnum', 0))
+    length = contig_length(options.get('contigmap.contigs', '[100-100]'))
+
+    for design in range(start, start + num_designs):
+        time.sleep(latency)
+        rng = _rng('rfdiffusion', options.get('contigmap.contigs'), options.get('inference.input_pdb'), design)
+        write_backbone(f"{prefix}_{design}.pdb", length, rng,
+                       chain_lengths(options.get('contigmap.contigs', '[100-100]')))
+        reference, design_indexes = motif_indexes(options.get('contigmap.contigs', '[100-100]'))
+        with open(f"{prefix}_{design}.trb", 'wb') as f:
+            pickle.dump({'con_ref_pdb_idx': reference, 'con_hal_pdb_idx': design_indexes,
+                         'config': options}, f)
+
+
+def _flag_args(args):
+    # --flag value arguments of protein_mpnn_run.py
+    options = {}
+    for i, arg in enumerate(args):
+        if arg.startswith('--') and i + 1 < len(args) and not args[i + 1].startswith('--'):
+            options[arg[2:]] = args[i + 1]
+    return options
+
+
+def protein_mpnn(args, latency=0.0, cwd='.'):
+    """Stand-in for ProteinMPNN/protein_mpnn_run.py, relative paths are taken from cwd."""
+    options = _flag_args(args)
+    pdb_path = os.path.join(cwd, options['pdb_path'])
+    out_folder = os.path.join(cwd, options['out_folder'])
+    num_seqs = int(options.get('num_seq_per_target', 1))
+    temperatures = options.get('sampling_temp', '0.1').split()
+    seed = options.get('seed', '0')
+    model_name = options.get('model_name', 'v_48_020')
+
+    name = os.path.splitext(os.path.basename(pdb_path))[0]
+    length = read_sequence_length(pdb_path)
+    rng = _rng('protein_mpnn', name, length, seed)
+
+    time.sleep(latency)
+    # First record is the input backbone (poly-glycine for RFdiffusion designs), then the samples
+    records = [f">{name}, score=3.0000, global_score=3.0000, fixed_chains=[], designed_chains=['A'], "
+               f"model_name={model_name}, git_hash=stub, seed={seed}\n{'G' * length}\n"]
+    sample = 0
+    for temperature in temperatures:
+        for _ in range(num_seqs):
+            sample += 1
+            score = 0.8 + rng.random()
+            sequence = ''.join(rng.choice(AMINO_ACIDS) for _ in range(length))
+            records.append(f">T={temperature}, sample={sample}, score={score:.4f}, global_score={score:.4f}, "
+                           f"seq_recovery={rng.random() * 0.1:.4f}\n{sequence}\n")
+
+    os.makedirs(os.path.join(out_folder, 'seqs'), exist_ok=True)
+    with open(os.path.join(out_folder, 'seqs', f"{name}.fa"), 'w') as f:
+        f.writelines(records)
+
+
+def evodiff(args, latency=0.0, cwd='.'):
+    """Stand-in for evodiff_generate.py, random sequences of the drawn layouts."""
+    options = _flag_args(args)
+    out_file = os.path.join(cwd, options['out_file'])
+    contig = parse_contig(options['contig'])
+    prefix = options.get('prefix') or os.path.splitext(os.path.basename(out_file))[0]
+    first_seed = int(options.get('seed', 0))
+
+    records = []
+    for n in range(int(options.get('num_seqs', 1))):
+        # Latency per sequence, like the decoding of the real model
+        time.sleep(latency)
+        seed = first_seed + n
+        layout = scaffold_layout(contig, random.Random(seed))
+        rng = _rng('evodiff', options['contig'], seed)
+        sequence = ''.join(rng.choice(AMINO_ACIDS) for _ in range(layout.length_bounds()[0]))
+        records.append(format_record(f"{prefix}_{n}", sequence, layout, seed))
+
+    os.makedirs(os.path.dirname(out_file) or '.', exist_ok=True)
+    with open(out_file, 'w') as f:
+        f.writelines(records)
+
+
+def omegafold(args, latency=0.0, cwd='.'):
+    """Stand-in for the omegafold command (input FASTA, output folder), one structure per record."""
+    input_file, output_dir = (os.path.join(cwd, arg) for arg in args[:2])
+    records = []
+    with open(input_file) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                records.append([line[1:], ''])
+            elif line and records:
+                records[-1][1] += line
+
+    for header, sequence in records:
+        # Latency per record, folding time grows with the number of sequences
+        time.sleep(latency)
+        write_backbone(os.path.join(output_dir, f"{header}.pdb"), len(sequence), _rng('omegafold', sequence))
+
+
+def tmalign(args, latency=0.0, cwd='.'):
+    """Stand-in for TMalign: prints the alignment summary lines parsed by extract_scores."""
+    lengths = [read_sequence_length(os.path.join(cwd, path)) for path in args[:2]]
+    rng = _rng('tmalign', *lengths, *(os.path.basename(path) for path in args[:2]))
+    time.sleep(latency)
+    tm_score, rmsd = 0.5 + 0.5 * rng.random(), 3 * rng.random()
+    print(f"Aligned length= {min(lengths):4d}, RMSD= {rmsd:6.2f}, Seq_ID=n_identical/n_aligned= 0.050")
+    for chain, length in enumerate(lengths, start=1):
+        print(f"TM-score= {tm_score:.5f} (if normalized by length of Chain_{chain}, i.e., LN={length})")
+
+
+TOOLS = {'rfdiffusion': rfdiffusion, 'protein_mpnn': protein_mpnn, 'omegafold': omegafold, 'tmalign': tmalign,
+         'evodiff': evodiff}
+
+# Where the pipeline calls every tool, relative to its root folder
+STUB_PATHS = {
+    'rfdiffusion': 'RFdiffusion/scripts/run_inference.py',
+    'protein_mpnn': 'ProteinMPNN/protein_mpnn_run.py',
+    'omegafold': 'bin/omegafold',
+    'tmalign': 'TMalign',
+    'evodiff': 'EvoDiff/evodiff_generate.py',
+}
+
+
+def install_stubs(root_dir, latencies=None):
+    """
+    Write the stand-in executables under root_dir, latencies maps a tool to seconds (per design
+    for RFdiffusion, per record for OmegaFold, per sequence for EvoDiff, per call for the others). Returns the bin folder
+    to put first in PATH for omegafold.
+    """
+    config_path = os.path.join(root_dir, 'stub_tools.json')
+    with open(config_path, 'w') as f:
+        json.dump({'latencies': latencies or {}}, f)
+
+    for tool, relative_path in STUB_PATHS.items():
+        path = os.path.join(root_dir, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(f"#!{sys.executable}\n"
+                    f"import sys\n"
+                    f"sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r})\n"
+                    f"import stub_tools\n"
+                    f"stub_tools.main([{tool!r}] + sys.argv[1:], config_path={config_path!r})\n")
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return os.path.join(root_dir, 'bin')
+
+
+def main(argv=None, config_path=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in TOOLS:
+        sys.exit(f"Usage: stub_tools.py {{{','.join(TOOLS)}}} <tool arguments>")
+    latency = 0.0
+    if config_path is not None and os.path.exists(config_path):
+        with open(config_path) as f:
+            latency = json.load(f)['latencies'].get(argv[0], 0.0)
+    TOOLS[argv[0]](argv[1:], latency=latency)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+# Sampling sweeps over the RFdiffusion / ProteinMPNN settings, with successive halving
+# Instead of editing rfdiffusion_run.py for every setting, a sweep takes a search space per
+# target (guide_scale, guiding_potentials, model_weights, substrate_name, contig_length,
+# sampling_temp, num_seq_per_target) and runs its configurations together through the
+# pipeline stages (stream_targets), each configuration being a target of its own.
+#
+# The budget goes to the configurations that win: in the first rung every configuration
+# makes min_designs RFdiffusion designs, then only the best 1/eta of them (by TM-score, RMSD
+# or success rate of their folded sequences) go on to the next rung, with eta times more
+# designs, and so on. A configuration keeps its designs from one rung to the next: a rung only
+# makes the designs it adds (min_designs * (eta**rung - eta**(rung - 1))), and the ranking is
+# on all of them. The results and a leaderboard are kept in work_flow/sweeps/<name>.
+#
+# The sweep file is JSON, e.g.
+#   {"name": "7SH6_guides", "targets": [{"pdb_code": "7SH6", "contig": "[10-40/A163-181/10-40]"}],
+#    "space": {"guide_scale": [1, 2, 5], "sampling_temp": {"choice": ["0.1", "0.2", "0.1 0.3"]},
+#              "num_seq_per_target": 4},
+#    "samples": 8, "eta": 2, "rungs": 3, "min_designs": 1, "metric": "success"}
+# A list is a grid axis, {"choice": [...]}, {"uniform": [low, high]} and {"loguniform": [low, high]}
+# are sampled (samples configurations in total), other values are fixed.
+#
+# Usage:
+#   python sweep.py sweep.json --root-dir /home/ubuntu
+#   python sweep.py --leaderboard work_flow/sweeps/7SH6_guides
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import time
+
+import pipeline_config
+from results_store import ResultsStore
+from rfdiffusion_pipeline import RFDIFFUSION_OPTIONS, setup_folder, stream_targets
+from workflow_index import WorkflowIndex
+
+# Settings a sweep can vary, the MPNN ones are per target keys of stream_targets too
+SWEEP_PARAMS = RFDIFFUSION_OPTIONS + ['sampling_temp', 'num_seq_per_target']
+METRICS = ('tm_score', 'rmsd', 'success')
+DEFAULT_SWEEP_DIR = './work_flow/sweeps'
+# A folded sequence is a success with at least this TM-score and at most this RMSD
+SUCCESS_TM_SCORE = 0.8
+SUCCESS_RMSD = 2.0
+
+
+def _sample(distribution, rng):
+    (kind, values), = distribution.items()
+    if kind == 'choice':
+        return rng.choice(values)
+    if kind == 'uniform':
+        return rng.uniform(*values)
+    if kind == 'loguniform':
+        return math.exp(rng.uniform(math.log(values[0]), math.log(values[1])))
+    raise ValueError(f"Unknown distribution {kind}, use choice, uniform or loguniform")
+
+
+def expand_space(space, samples=None, seed=0):
+    """
+    Configurations (dicts) of a search space. Without distributions, the whole grid of the
+    list values; with distributions, samples random configurations (grid axes drawn as choices).
+    """
+    unknown = set(space) - set(SWEEP_PARAMS)
+    if unknown:
+        raise ValueError(f"Unknown sweep parameters {', '.join(sorted(unknown))}, "
+                         f"expected some of {', '.join(SWEEP_PARAMS)}")
+    fixed = {key: value for key, value in space.items() if not isinstance(value, (list, dict))}
+    grid = {key: value for key, value in space.items() if isinstance(value, list)}
+    distributions = {key: value for key, value in space.items() if isinstance(value, dict)}
+
+    if not distributions:
+        configs = [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+    else:
+        rng = random.Random(seed)
+        configs = []
+        for _ in range(samples or 8):
+            config = {key: rng.choice(values) for key, values in grid.items()}
+            config.update({key: _sample(distribution, rng) for key, distribution in distributions.items()})
+            configs.append(config)
+
+    unique = {}
+    for config in configs:
+        config = {**fixed, **config}
+        if 'sampling_temp' in config:
+            # ProteinMPNN takes the temperatures as a string, several separated by spaces
+            config['sampling_temp'] = str(config['sampling_temp'])
+        unique.setdefault(config_id(config), config)
+    return unique
+
+
+def config_id(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:8]
+
+
+def config_stats(results):
+    """Metrics of the folded sequences of one configuration, failed and rejected ones included."""
+    done = [result for result in results if result['status'] == 'done']
+    successes = [result for result in done
+                 if result['tm_score_1'] >= SUCCESS_TM_SCORE and result['rmsd'] <= SUCCESS_RMSD]
+    return {
+        'sequences': len(results),
+        'done': len(done),
+        # Failed and rejected sequences count as a TM-score of 0
+        'tm_score': sum(result['tm_score_1'] for result in done) / len(results) if results else 0.0,
+        'rmsd': sum(result['rmsd'] for result in done) / len(done) if done else None,
+        'success': len(successes) / len(results) if results else 0.0,
+    }
+
+
+def rank_key(stats, metric):
+    """Sort key of a configuration, best first."""
+    if metric == 'rmsd':
+        return stats['rmsd'] if stats['rmsd'] is not None else float('inf')
+    return -stats[metric]
+
+
+class Sweep:
+    """
+    Successive-halving sweep of the configurations of a search space over targets (dicts with
+    pdb_code, contig and name). pipeline_options go to stream_targets (workers, cache, index,
+    report, scheduler, filters, ...).
+    """
+
+    def __init__(self, targets, space, name=None, eta=2, rungs=3, min_designs=1, metric='success',
+                 samples=None, seed=0, sweep_dir=DEFAULT_SWEEP_DIR, **pipeline_options):
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric {metric}, expected one of {', '.join(METRICS)}")
+        if eta < 2:
+            raise ValueError("eta must be at least 2")
+        self.targets = [{**target, 'name': target.get('name') or target['pdb_code']} for target in targets]
+        self.configs = expand_space(space, samples, seed)
+        self.name = name or time.strftime('sweep_%Y%m%d-%H%M%S')
+        self.eta = eta
+        self.rungs = rungs
+        self.min_designs = min_designs
+        self.metric = metric
+        self.directory = os.path.join(sweep_dir, self.name)
+        self.pipeline_options = pipeline_options
+        # (target name, config id) -> results of all its rungs, and the last rung it ran in
+        self.results = {}
+        self.reached = {}
+
+    def designs(self, rung):
+        """Number of designs of a configuration once it ran up to this rung."""
+        return self.min_designs * self.eta ** rung
+
+    def _item(self, target, cid, rung):
+        # A configuration is a target of its own, every rung adds designs after those of the earlier ones
+        first_design = self.designs(rung - 1) if rung else 0
+        return {**target, **self.configs[cid], 'number_proteins': self.designs(rung) - first_design,
+                'first_design': first_design, 'name': f"{target['name']}_sw{cid}",
+                'sweep_target': target['name'], 'config_id': cid}
+
+    def run_rung(self, rung, alive):
+        """Run the (target name, config id) pairs of alive in one pipeline run."""
+        targets = {target['name']: target for target in self.targets}
+        items = [self._item(targets[name], cid, rung) for name, cid in alive]
+        print(f"Sweep {self.name} rung {rung}: {len(items)} configurations, "
+              f"{self.designs(rung)} designs each")
+
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, 'results.jsonl'), 'a') as f:
+            for result in stream_targets(items, **self.pipeline_options):
+                key = (result['sweep_target'], result['config_id'])
+                self.results.setdefault(key, []).append(result)
+                f.write(json.dumps({**result, 'rung': rung}, default=str) + '\n')
+        for key in alive:
+            self.reached[key] = rung
+
+    def leaderboard(self):
+        """One entry per (target, configuration), best first within every target."""
+        entries = []
+        for (name, cid), rung in self.reached.items():
+            stats = config_stats(self.results.get((name, cid), []))
+            entries.append({'target': name, 'config_id': cid, 'params': self.configs[cid],
+                            'rung': rung, **stats})
+        entries.sort(key=lambda entry: (entry['target'], -entry['rung'], rank_key(entry, self.metric)))
+        return entries
+
+    def _save_leaderboard(self):
+        path = os.path.join(self.directory, 'leaderboard.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'name': self.name, 'metric': self.metric, 'eta': self.eta, 'rungs': self.rungs,
+                       'min_designs': self.min_designs, 'entries': self.leaderboard()}, f, indent=1)
+        os.replace(path + '.tmp', path)
+        return path
+
+    def run(self):
+        """Run all the rungs, returns the leaderboard."""
+        alive = [(target['name'], cid) for target in self.targets for cid in self.configs]
+        for rung in range(self.rungs):
+            self.run_rung(rung, alive)
+            self._save_leaderboard()
+            if rung == self.rungs - 1:
+                break
+            # Keep the best 1/eta configurations of every target
+            survivors = []
+            for target in self.targets:
+                keys = [key for key in alive if key[0] == target['name']]
+                keys.sort(key=lambda key: rank_key(config_stats(self.results.get(key, [])), self.metric))
+                survivors += keys[:max(1, len(keys) // self.eta)]
+            alive = survivors
+        print(f"Leaderboard written to {self._save_leaderboard()}")
+        return self.leaderboard()
+
+
+def format_leaderboard(entries, limit=10):
+    lines = [f"{'target':<12}{'config':<10}{'rung':>5}{'seqs':>6}{'tm_score':>10}{'rmsd':>8}{'success':>9}  params"]
+    shown = {}
+    for entry in entries:
+        shown[entry['target']] = shown.get(entry['target'], 0) + 1
+        if shown[entry['target']] > limit:
+            continue
+        rmsd = f"{entry['rmsd']:.2f}" if entry['rmsd'] is not None else '-'
+        lines.append(f"{entry['target']:<12}{entry['config_id']:<10}{entry['rung']:>5}{entry['sequences']:>6}"
+                     f"{entry['tm_score']:>10.3f}{rmsd:>8}{entry['success']:>9.0%}  {json.dumps(entry['params'])}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Successive-halving sweep of RFdiffusion / ProteinMPNN settings")
+    parser.add_argument('sweep', nargs='?', help="JSON sweep file (see the top of sweep.py)")
+    parser.add_argument('--root-dir', default=pipeline_config.root_dir(), help="Folder containing work_flow and the tools")
+    parser.add_argument('--leaderboard', default=None, help="Print the leaderboard of a sweep folder and exit")
+    parser.add_argument('--top', type=int, default=10, help="Configurations shown per target")
+    args = parser.parse_args()
+
+    if args.leaderboard:
+        with open(os.path.join(args.leaderboard, 'leaderboard.json')) as f:
+            print(format_leaderboard(json.load(f)['entries'], args.top))
+        return
+    if not args.sweep:
+        parser.error("a sweep file or --leaderboard is needed")
+
+    with open(args.sweep) as f:
+        spec = json.load(f)
+    os.chdir(args.root_dir)
+    setup_folder(args.root_dir)
+
+    sweep = Sweep(spec['targets'], spec['space'], name=spec.get('name'), eta=spec.get('eta', 2),
+                  rungs=spec.get('rungs', 3), min_designs=spec.get('min_designs', 1),
+                  metric=spec.get('metric', 'success'), samples=spec.get('samples'), seed=spec.get('seed', 0),
+                  index=WorkflowIndex(), store=ResultsStore())
+    print(f"{len(sweep.configs)} configurations x {len(sweep.targets)} targets")
+    print(format_leaderboard(sweep.run(), args.top))
+
+
+if __name__ == '__main__':
+    main()
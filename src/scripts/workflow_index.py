@@ -0,0 +1,233 @@
+# Persistent index of the files created in the work_flow folder
+# Every (target, stage, design) is recorded in a SQLite database together with its output
+# file, the parameters it was run with, the checksum of the output and its status.
+# The pipeline checks the index before running a stage, so an interrupted run can be
+# resumed without redoing the finished designs, and "what exists for 7SH6?" is a single
+# indexed query instead of a walk through the folders.
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+DEFAULT_INDEX_PATH = './work_flow/index.sqlite'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    target   TEXT NOT NULL,
+    stage    TEXT NOT NULL,
+    design   TEXT NOT NULL,
+    status   TEXT NOT NULL,
+    path     TEXT,
+    params   TEXT,
+    metrics  TEXT,
+    checksum TEXT,
+    size     INTEGER,
+    updated  REAL NOT NULL,
+    PRIMARY KEY (target, stage, design)
+)
+"""
+
+
+# Names of the files of the folders of a stage and target made before artifact_store.py, after the
+# target name: <target>_scaffold_<design>.pdb / .fa and <target>_<design>_<sample>.pdb
+_LEGACY_NAMES = {'rfdiffusion': r'_scaffold_(\d+)', 'protein_mpnn': r'_scaffold_(\d+)', 'omegafold': r'_(\d+)_(\d+)'}
+
+
+def file_checksum(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def _params_json(params):
+    # Same normalization as the result cache: arguments set to None are left out
+    if params is None:
+        return None
+    return json.dumps({name: value for name, value in params.items() if value is not None},
+                      sort_keys=True, default=str)
+
+
+class WorkflowIndex:
+    """
+    SQLite index of the work_flow folder, safe to share between threads.
+    Status of an entry is 'running', 'done' or 'failed'.
+    The WAL journal lets the processes of one host read while a stage writes, but needs memory
+    they share: an index on a folder shared between hosts (NFS, EFS) is opened with
+    journal_mode='DELETE' and used by a single process (see sharded_run.py).
+    """
+
+    def __init__(self, index_path=DEFAULT_INDEX_PATH, journal_mode='WAL'):
+        self.index_path = index_path
+        os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(index_path, check_same_thread=False, timeout=30)
+        self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            self._db.execute(f"PRAGMA journal_mode={journal_mode}")
+            self._db.execute(_SCHEMA)
+
+    def _upsert(self, target, stage, design, status, path=None, params=None, metrics=None):
+        checksum = None
+        size = None
+        if path is not None and os.path.isfile(path):
+            checksum = file_checksum(path)
+            size = os.path.getsize(path)
+
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (target, stage, str(design), status, path, _params_json(params),
+                 json.dumps(metrics) if metrics is not None else None, checksum, size, time.time())
+            )
+
+    def start(self, target, stage, design=0, params=None):
+        self._upsert(target, stage, design, 'running', params=params)
+
+    def record(self, target, stage, path, design=0, params=None, metrics=None):
+        """Mark a stage as done, with its output file (checksummed) and metrics."""
+        self._upsert(target, stage, design, 'done', path=path, params=params, metrics=metrics)
+
+    def fail(self, target, stage, design=0, params=None):
+        self._upsert(target, stage, design, 'failed', params=params)
+
+    def get(self, target, stage, design=0):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT * FROM artifacts WHERE target = ? AND stage = ? AND design = ?",
+                (target, stage, str(design))
+            ).fetchone()
+        return _row_to_dict(row) if row is not None else None
+
+    def is_complete(self, target, stage, design=0, params=None, verify=False):
+        """
+        True if the stage finished with the same parameters and its output is still on disk.
+        Entries recorded without parameters (the files found by scan) have unknown parameters,
+        their file is trusted whatever the parameters asked for.
+        With verify=True the checksum of the output is recomputed as well.
+        """
+        entry = self.get(target, stage, design)
+        if entry is None or entry['status'] != 'done':
+            return False
+        if (params is not None and entry['params'] is not None
+                and entry['params'] != json.loads(_params_json(params))):
+            return False
+        path = entry['path']
+        if path is not None:
+            if not os.path.isfile(path) or os.path.getsize(path) != entry['size']:
+                return False
+            if verify and file_checksum(path) != entry['checksum']:
+                return False
+        return True
+
+    def lookup(self, target):
+        """All the entries of a target, ordered by stage and design."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM artifacts WHERE target = ? ORDER BY stage, design", (target,)
+            ).fetchall()
+        return [_row_to_dict(row) for row in rows]
+
+    def targets(self):
+        with self._lock:
+            rows = self._db.execute("SELECT DISTINCT target FROM artifacts ORDER BY target").fetchall()
+        return [row['target'] for row in rows]
+
+    def merge(self, paths, targets=None):
+        """
+        Copy the entries of other index files (e.g. those of the workers of a sharded run) into
+        this one, only the entries of targets if given. The latest entry of a (target, stage,
+        design) wins. Returns the number of entries copied.
+        """
+        merged = 0
+        for path in paths:
+            source = sqlite3.connect(path, timeout=30)
+            try:
+                rows = source.execute("SELECT * FROM artifacts").fetchall()
+            finally:
+                source.close()
+            with self._lock, self._db:
+                for row in rows:
+                    if targets is not None and row[0] not in targets:
+                        continue
+                    cursor = self._db.execute(
+                        "INSERT OR REPLACE INTO artifacts SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, ? WHERE NOT EXISTS "
+                        "(SELECT 1 FROM artifacts WHERE target = ? AND stage = ? AND design = ? AND updated >= ?)",
+                        (*row, row[0], row[1], row[2], row[9]))
+                    merged += cursor.rowcount
+        return merged
+
+    def scan(self, work_flow_dir='./work_flow', targets=None):
+        """
+        Add the files already present in the work_flow folder (e.g. from runs made before the
+        index existed), only those of targets if given. Entries that are already in the index
+        are left untouched.
+        The files are recorded without parameters, so is_complete takes them as done for any
+        parameters: only scan folders made with the settings the resumed run will use.
+        Returns the number of entries added.
+        """
+        found = []
+        native_dir = os.path.join(work_flow_dir, 'native_proteins')
+        if os.path.isdir(native_dir):
+            for filename in sorted(os.listdir(native_dir)):
+                if filename.endswith('.pdb'):
+                    found.append((filename[:-4], 'native', 0, os.path.join(native_dir, filename)))
+
+        # Stage folder, sub folder of the target folder, file extension
+        layouts = [('rfdiffusion', 'RFdiffusion_output', '', '.pdb'),
+                   ('protein_mpnn', 'mpnn_output', 'seqs', '.fa'),
+                   ('omegafold', 'omegafold_output', '', '.pdb')]
+        for stage, stage_folder, sub_folder, extension in layouts:
+            stage_dir = os.path.join(work_flow_dir, stage_folder)
+            if not os.path.isdir(stage_dir):
+                continue
+            for target in sorted(os.listdir(stage_dir)):
+                target_dir = os.path.join(stage_dir, target, sub_folder)
+                if (targets is not None and target not in targets) or not os.path.isdir(target_dir):
+                    continue
+                # The design (and sample) number is in the file name, files of other names are skipped
+                pattern = re.compile(re.escape(target) + _LEGACY_NAMES[stage] + re.escape(extension))
+                for filename in sorted(os.listdir(target_dir)):
+                    match = pattern.fullmatch(filename)
+                    if match:
+                        design = '_'.join(match.groups()) if stage == 'omegafold' else int(match.group(1))
+                        found.append((target, stage, design, os.path.join(target_dir, filename)))
+
+        # Layout of artifact_store.py: designs/<target>/<design>/<stage>/
+        designs_dir = os.path.join(work_flow_dir, 'designs')
+        for target in sorted(os.listdir(designs_dir)) if os.path.isdir(designs_dir) else []:
+            if targets is not None and target not in targets:
+                continue
+            for design in sorted(os.listdir(os.path.join(designs_dir, target))):
+                for stage, extension in [(stage, extension) for stage, _, _, extension in layouts] + [('evodiff', '.fa')]:
+                    stage_dir = os.path.join(designs_dir, target, design, stage)
+                    if not os.path.isdir(stage_dir):
+                        continue
+                    for filename in sorted(f for f in os.listdir(stage_dir) if f.endswith(extension)):
+                        key = design
+                        if stage == 'omegafold':
+                            # One structure per sequence, {target}_{design}_{sample}.pdb
+                            key = '_'.join(filename[:-len(extension)].rsplit('_', 2)[1:])
+                        found.append((target, stage, key, os.path.join(stage_dir, filename)))
+
+        added = 0
+        for target, stage, design, path in found:
+            if self.get(target, stage, design) is None:
+                self.record(target, stage, path, design=design)
+                added += 1
+        return added
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def _row_to_dict(row):
+    entry = dict(row)
+    entry['params'] = json.loads(entry['params']) if entry['params'] is not None else None
+    entry['metrics'] = json.loads(entry['metrics']) if entry['metrics'] is not None else None
+    return entry